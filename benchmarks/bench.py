@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Deployment benchmarks.
+
+Generates synthetic source trees and deploys each of them several times with
+each deployment type (``local``, ``git``, ``git-archive`` and ``git-bundle``),
+recording the total time and the time spent in each phase. Results are written
+as JSON so that they can be compared between fumi versions::
+
+    $ python benchmarks/bench.py -o before.json
+    $ git checkout my-branch
+    $ python benchmarks/bench.py -o after.json --compare before.json
+
+By default the hosts are simulated with the ``local`` transport, which runs
+the same commands as a remote host would, waiting ``--rtt`` seconds before
+each of them and limiting uploads to ``--bandwidth``. Use ``--ssh`` to deploy
+to a real SSH server instead (e.g. ``sshd`` in ``localhost``).
+"""
+
+from __future__ import print_function
+
+import argparse
+import binascii
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Installs the translation function used by the rest of the modules
+from fumi.launcher import __version__
+from fumi.deployer import build_deployer
+
+# Words used for compressible content
+WORDS = (
+    'alpha bravo charlie delta echo foxtrot golf hotel india juliett kilo '
+    'lima mike november oscar papa quebec romeo sierra tango uniform victor '
+    'whiskey xray yankee zulu function return import export const module'
+).split()
+
+SOURCE_TYPES = ('local', 'git', 'git-archive', 'git-bundle')
+
+
+def noise(rng, size):
+    """Generate incompressible bytes.
+
+    Arguments:
+        rng (``random.Random``): Random generator.
+        size (int): Size in bytes.
+
+    Returns:
+        Bytes.
+    """
+    if size <= 0:
+        return b''
+
+    return binascii.unhexlify('%0*x' % (2 * size, rng.getrandbits(8 * size)))
+
+def text(rng, size):
+    """Generate compressible text.
+
+    Arguments:
+        rng (``random.Random``): Random generator.
+        size (int): Approximate size in bytes.
+
+    Returns:
+        Bytes of text.
+    """
+    words = []
+    length = 0
+
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    return ' '.join(words).encode('ascii')
+
+def write(path, data):
+    """Write a file, creating its directory if needed.
+
+    Arguments:
+        path (str): Path of the file.
+        data (bytes): Content of the file.
+    """
+    parent = os.path.dirname(path)
+
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def small_files(root, rng, scale):
+    """Many small text files spread in a few directories."""
+    for i in range(int(4000 * scale)):
+        write(
+            os.path.join(root, 'src', 'pkg%02d' % (i % 40), 'mod%04d.py' % i),
+            text(rng, rng.randint(512, 4096)))
+
+def large_files(root, rng, scale):
+    """A few large incompressible files."""
+    for i in range(4):
+        write(
+            os.path.join(root, 'assets', 'blob%d.bin' % i),
+            noise(rng, int(16 * 1024 * 1024 * scale)))
+
+def mixed(root, rng, scale):
+    """Text sources, incompressible media and large compressible logs."""
+    for i in range(int(1000 * scale)):
+        write(
+            os.path.join(root, 'app', 'views', 'view%04d.html' % i),
+            text(rng, rng.randint(1024, 8192)))
+
+    for i in range(int(200 * scale)):
+        write(
+            os.path.join(root, 'static', 'img', 'img%03d.png' % i),
+            noise(rng, 64 * 1024))
+
+    for i in range(2):
+        write(
+            os.path.join(root, 'data', 'fixture%d.sql' % i),
+            text(rng, int(8 * 1024 * 1024 * scale)))
+
+def node_modules(root, rng, scale, depth=6):
+    """Deeply nested packages, as in a ``node_modules`` directory."""
+    width = max(1, int(round(3 * scale)))
+
+    def package(path, level):
+        write(
+            os.path.join(path, 'package.json'),
+            ('{"name": "%s", "version": "1.0.%d"}' % (
+                os.path.basename(path), level)).encode('ascii'))
+        write(os.path.join(path, 'index.js'), text(rng, 2048))
+        write(os.path.join(path, 'lib', 'util.js'), text(rng, 1024))
+
+        if level < depth:
+            for i in range(width):
+                package(
+                    os.path.join(path, 'node_modules', 'dep-%d-%d' % (level, i)),
+                    level + 1)
+
+    package(os.path.join(root, 'node_modules', 'app'), 1)
+
+SCENARIOS = [
+    ('small-files', small_files),
+    ('large-files', large_files),
+    ('mixed', mixed),
+    ('node-modules', node_modules),
+]
+
+def generate(name, func, work_dir, scale):
+    """Generate the source tree of a scenario as a git repository.
+
+    Arguments:
+        name (str): Name of the scenario.
+        func: Function that writes the files of the tree.
+        work_dir (str): Directory in which to create the tree.
+        scale (float): Factor applied to the number or size of files.
+
+    Returns:
+        Path to the tree, number of files and total size in bytes.
+    """
+    root = os.path.join(work_dir, 'src', name)
+    func(root, random.Random(name), scale)
+
+    files = 0
+    size = 0
+
+    for path, dirs, names in os.walk(root):
+        files += len(names)
+        size += sum(os.path.getsize(os.path.join(path, n)) for n in names)
+
+    git = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost']
+
+    with open(os.devnull, 'w') as null:
+        subprocess.check_call(['git', 'init', '-q', root], stdout=null)
+        subprocess.check_call(git + ['add', '-A'], cwd=root)
+        subprocess.check_call(git + ['commit', '-q', '-m', name], cwd=root)
+
+    return root, files, size
+
+def config(source_type, source_path, deploy_path, args):
+    """Build the deployment configuration of a benchmark.
+
+    Arguments:
+        source_type (str): One of ``SOURCE_TYPES`` (``local``, ``git``,
+            ``git-archive`` or ``git-bundle``).
+        source_path (str): Path to the source tree.
+        deploy_path (str): Path in which to deploy.
+        args: Parsed command line arguments.
+
+    Returns:
+        Configuration dict, as read from a ``fumi.yml`` file.
+    """
+    conf = {
+        'source-type': source_type,
+        # A file URL makes git transfer a pack instead of hardlinking objects
+        'source-path': (
+            'file://' + source_path if source_type == 'git' else source_path),
+        'host': 'localhost',
+        'user': os.environ.get('USER', 'fumi'),
+        'deploy-path': deploy_path,
+        'host-tmp': os.path.join(deploy_path, 'tmp'),
+        'keep-max': 2,
+        'transport': 'local',
+        'transport-latency': args.rtt,
+        'transport-bandwidth': args.bandwidth,
+    }
+
+    if args.ssh:
+        user, _, host = args.ssh.rpartition('@')
+        conf.update({
+            'host': host,
+            'user': user or conf['user'],
+            'transport': 'ssh',
+        })
+
+    return conf
+
+def quiet():
+    """Silence the output of fumi during a deployment.
+
+    Returns:
+        Previous ``sys.stdout``, to be restored afterwards.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+    return stdout
+
+def restore(stdout):
+    """Restore the output silenced by ``quiet()``.
+
+    Arguments:
+        stdout: Previous ``sys.stdout``.
+    """
+    sys.stdout.close()
+    sys.stdout = stdout
+
+def deploy(conf):
+    """Deploy once and measure it.
+
+    Arguments:
+        conf (dict): Deployment configuration.
+
+    Returns:
+        Dict with the result, total time, phases and bytes uploaded.
+    """
+    # Revisions are named after the second in which they are created
+    time.sleep(1 - time.time() % 1)
+
+    stdout = quiet()
+
+    try:
+        status, deployer = build_deployer(conf)
+
+        if status:
+            started = time.time()
+            ok = deployer.deploy()
+            seconds = time.time() - started
+
+            deployer.timer.stop()
+
+    finally:
+        restore(stdout)
+
+    if not status:
+        # Invalid configuration, nothing was measured
+        return {
+            'ok': False,
+            'seconds': 0,
+            'phases': {},
+            'commands': [],
+            'transferred': 0,
+        }
+
+    phases = {}
+
+    for name, secs in deployer.timer.phases:
+        phases[name] = phases.get(name, 0) + secs
+
+    return {
+        'ok': bool(ok),
+        'seconds': seconds,
+        'phases': phases,
+        'commands': [
+            [c, s] for p, c, s in deployer.timer.commands],
+        'transferred': deployer.timer.transferred,
+    }
+
+def median(values):
+    """Obtain the median of a list of numbers."""
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def summarize(runs):
+    """Compute the median total and per phase time of several runs.
+
+    Arguments:
+        runs (list[dict]): Results of ``deploy()``.
+
+    Returns:
+        Dict with the median ``seconds`` and ``phases``.
+    """
+    names = []
+
+    for run in runs:
+        names.extend(n for n in run['phases'] if n not in names)
+
+    return {
+        'seconds': median([r['seconds'] for r in runs]),
+        'phases': dict(
+            (n, median([r['phases'].get(n, 0) for r in runs]))
+            for n in names),
+    }
+
+def revision():
+    """Obtain the git commit of the fumi source being benchmarked.
+
+    Returns:
+        Commit hash or ``None``.
+    """
+    try:
+        with open(os.devnull, 'w') as null:
+            out = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=null)
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return out.decode('ascii').strip()
+
+def compare(results, baseline):
+    """Print the change in median times with respect to a baseline.
+
+    Arguments:
+        results (dict): Results of this run.
+        baseline (dict): Results of a previous run.
+    """
+    before = dict(
+        ((r['scenario'], r['source_type']), r['median'])
+        for r in baseline['results'])
+
+    print('\n%-14s %-11s %-16s %9s %9s %8s' % (
+        'scenario', 'type', 'phase', 'before', 'after', 'change'))
+
+    for result in results['results']:
+        old = before.get((result['scenario'], result['source_type']))
+
+        if not old:
+            continue
+
+        new = result['median']
+        rows = [('total', old['seconds'], new['seconds'])]
+        # Phases that take no time are left out
+        rows.extend(
+            (n, old['phases'].get(n, 0), s)
+            for n, s in sorted(new['phases'].items())
+            if max(s, old['phases'].get(n, 0)) >= 0.001)
+
+        for name, old_secs, new_secs in rows:
+            change = (
+                '%+7.1f%%' % (100 * (new_secs - old_secs) / old_secs)
+                if old_secs else '')
+
+            print('%-14s %-11s %-16s %8.3fs %8.3fs %8s' % (
+                result['scenario'], result['source_type'], name,
+                old_secs, new_secs, change))
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='fumi deployment benchmarks')
+
+    parser.add_argument(
+        '-o', '--output', default='bench.json',
+        help='JSON file in which to write the results')
+    parser.add_argument(
+        '-s', '--scenario', action='append',
+        choices=[n for n, f in SCENARIOS],
+        help='scenario to run (may be repeated, default: all)')
+    parser.add_argument(
+        '-t', '--source-type', action='append', choices=SOURCE_TYPES,
+        help='deployment type to run (may be repeated, default: all)')
+    parser.add_argument(
+        '-n', '--repeat', type=int, default=3,
+        help='deployments per scenario and type')
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='factor applied to the number and size of files')
+    parser.add_argument(
+        '--rtt', type=float, default=0.02,
+        help='simulated round trip time in seconds')
+    parser.add_argument(
+        '--bandwidth', default=None,
+        help='simulated upload bandwidth in bytes per second (e.g. 100M)')
+    parser.add_argument(
+        '--ssh', metavar='[USER@]HOST',
+        help='deploy to a real SSH server instead of simulating the host')
+    parser.add_argument(
+        '--work-dir',
+        help='directory for the source trees and deployments '
+             '(default: temporary directory, removed afterwards)')
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help='previous results to compare with')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='fumi-bench-')
+    scenarios = [(n, f) for n, f in SCENARIOS
+                 if not args.scenario or n in args.scenario]
+    source_types = args.source_type or SOURCE_TYPES
+
+    results = {
+        'fumi': __version__,
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'settings': {
+            'repeat': args.repeat,
+            'scale': args.scale,
+            'rtt': args.rtt,
+            'bandwidth': args.bandwidth,
+            'ssh': args.ssh,
+        },
+        'results': [],
+    }
+
+    try:
+        for name, func in scenarios:
+            source_path, files, size = generate(
+                name, func, work_dir, args.scale)
+
+            for source_type in source_types:
+                deploy_path = os.path.join(
+                    work_dir, 'deploy', name, source_type)
+                conf = config(source_type, source_path, deploy_path, args)
+
+                stdout = quiet()
+
+                try:
+                    status, deployer = build_deployer(conf)
+
+                    if status:
+                        deployer.prepare()
+
+                finally:
+                    restore(stdout)
+
+                runs = []
+
+                for i in range(args.repeat):
+                    run = deploy(conf)
+                    runs.append(run)
+
+                    print('%-14s %-11s %d/%d %8.3fs%s' % (
+                        name, source_type, i + 1, args.repeat,
+                        run['seconds'], '' if run['ok'] else '  FAILED'))
+
+                results['results'].append({
+                    'scenario': name,
+                    'source_type': source_type,
+                    'files': files,
+                    'bytes': size,
+                    'runs': runs,
+                    'median': summarize(runs),
+                })
+
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print('Results written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if not all(r['ok'] for res in results['results'] for r in res['runs']):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Loading of the ``fumi.yml`` deployment file.
+
+Parsed files are validated, indexed and stored in a cache (in
+``~/.cache/fumi``) keyed on the path, modification time and size of the file,
+so that subsequent commands do not need to parse the YAML again.
+
+The ``inventory`` section is reserved for the host inventory (see
+``fumi.inventory``) and is indexed when the file is loaded.
+
+Configurations may inherit fields from other configurations through the
+``extends`` field. Configurations with ``template: true`` are only used as
+base for others and cannot be deployed. Inheritance is resolved once, when
+the file is loaded, and the result is cached as well.
+"""
+
+import hashlib
+import os
+
+from six.moves import cPickle as pickle
+
+from fumi import messages as m
+from fumi import util
+from fumi.inventory import Inventory
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'fumi')
+
+# Increased whenever the structure of the cached objects changes
+CACHE_VERSION = 3
+
+# Top level sections that are not configurations
+RESERVED = ('inventory',)
+
+# Fields that are not inherited through ``extends``
+NOT_INHERITED = ('default', 'extends', 'template')
+
+
+class ConfigError(Exception):
+    """Error in the structure of the deployment file."""
+    pass
+
+
+class ConfigFile(object):
+    """Parsed and indexed deployment file.
+
+    Attributes:
+        path (str): Path to the ``fumi.yml`` file.
+        content (dict): Parsed content of the file, as written by the user.
+        resolved (dict): Deployable configurations with inheritance resolved.
+        names (list[str]): Names of the deployable configurations, in file
+            order.
+        default (str): Name of the default configuration or ``None``.
+        inventory (``Inventory``): Indexed host inventory.
+    """
+
+    def __init__(self, path, content):
+        self.path = path
+        self.content = content
+
+        try:
+            self.inventory = Inventory(content.get('inventory'))
+
+        except ValueError as e:
+            raise ConfigError(e)
+
+        memo = {}
+        self.resolved = {}
+        self.names = []
+
+        for name, section in content.items():
+            if name in RESERVED or section.get('template'):
+                # Not deployable
+                continue
+
+            self.resolved[name] = _resolve(content, name, memo, [])
+            self.names.append(name)
+
+        self.default = None
+        for name in self.names:
+            if content[name].get('default'):
+                self.default = name
+                break
+
+    def __contains__(self, name):
+        return name in self.resolved
+
+    def get(self, name):
+        """Obtain the resolved configuration with the given name.
+
+        Arguments:
+            name (str): Name of the configuration.
+
+        Returns:
+            ``dict`` with the configuration or ``None``.
+        """
+        return self.resolved.get(name)
+
+def load(path):
+    """Load a deployment file, using the cache when possible.
+
+    Arguments:
+        path (str): Path to the file (fumi.yml).
+
+    Returns:
+        Boolean indicating result and ``ConfigFile`` instance or ``None`` if
+        the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        # No file
+        return True, None
+
+    key = (CACHE_VERSION, os.path.abspath(path), stat.st_mtime, stat.st_size)
+    cache_path = _cache_path(path)
+
+    # Try the cache first
+    try:
+        with open(cache_path, 'rb') as cache:
+            cached_key, conf = pickle.load(cache)
+
+        if cached_key == key:
+            return True, conf
+
+    except Exception:
+        # Missing or invalid cache
+        pass
+
+    status, content = util.read_yaml(path)
+
+    if not status:
+        return False, None
+
+    if content is None:
+        content = {}
+
+    # Validate structure
+    if not isinstance(content, dict):
+        util.cprint(m.YML_ERR % m.YML_NOT_MAPPING, 'red')
+        return False, None
+
+    for name, section in content.items():
+        if not isinstance(section, dict):
+            util.cprint(m.YML_ERR % (m.YML_BAD_CONF % name), 'red')
+            return False, None
+
+    try:
+        conf = ConfigFile(path, content)
+
+    except ConfigError as e:
+        util.cprint(m.YML_ERR % e, 'red')
+        return False, None
+
+    _write_cache(cache_path, key, conf)
+
+    return True, conf
+
+def _cache_path(path):
+    """Obtain the path of the cache file for a deployment file.
+
+    Arguments:
+        path (str): Path to the deployment file.
+
+    Returns:
+        Path to the cache file.
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+
+    return os.path.join(CACHE_DIR, digest + '.pickle')
+
+def _resolve(content, name, memo, chain):
+    """Resolve the inheritance of a configuration.
+
+    Resolved configurations are memoized, so bases shared by many
+    configurations are only resolved once.
+
+    Arguments:
+        content (dict): Parsed content of the deployment file.
+        name (str): Name of the configuration to resolve.
+        memo (dict): Configurations resolved so far.
+        chain (list[str]): Configurations being resolved, used to detect
+            circular inheritance.
+
+    Returns:
+        ``dict`` with the resolved configuration.
+
+    Raises:
+        ConfigError: if a base does not exist or inheritance is circular.
+    """
+    if name in memo:
+        return memo[name]
+
+    if name in chain:
+        raise ConfigError(m.YML_CIRCULAR % ' -> '.join(chain + [name]))
+
+    section = content[name]
+    bases = section.get('extends') or []
+
+    if not isinstance(bases, list):
+        bases = [bases]
+
+    resolved = {}
+
+    # Later bases override earlier ones
+    for base in bases:
+        if base not in content:
+            raise ConfigError(m.YML_BAD_BASE % (name, base))
+
+        for k, v in _resolve(content, base, memo, chain + [name]).items():
+            if k not in NOT_INHERITED:
+                resolved[k] = v
+
+    resolved.update(section)
+    resolved.pop('extends', None)
+
+    memo[name] = resolved
+    return resolved
+
+def _write_cache(cache_path, key, conf):
+    """Store a parsed deployment file in the cache.
+
+    The file is written to a temporary path and then renamed, so concurrent
+    invocations never read a partial cache. Errors are ignored, as the cache
+    is only an optimization.
+
+    Arguments:
+        cache_path (str): Path to the cache file.
+        key (tuple): Key identifying the version of the deployment file.
+        conf (``ConfigFile``): Parsed deployment file.
+    """
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+
+        with open(tmp_path, 'wb') as cache:
+            pickle.dump((key, conf), cache, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp_path, cache_path)
+
+    except Exception:
+        # Cache is optional
+        pass
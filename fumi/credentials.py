@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""SSH credentials shared by all the connections of a run.
+
+Private keys (from the SSH agent and the default key files) and the
+``known_hosts`` file are loaded only once, the first time a connection is
+made. The key that succeeds for each host is remembered and tried first, and
+the key that succeeded last is tried first for new hosts, since hosts of the
+same deployment usually accept the same key.
+"""
+
+import os
+import threading
+
+# Default private key files and the paramiko class used to load them
+KEY_FILES = (
+    ('id_ed25519', 'Ed25519Key'),
+    ('id_ecdsa', 'ECDSAKey'),
+    ('id_rsa', 'RSAKey'),
+    ('id_dsa', 'DSSKey'),
+)
+
+# Credentials of the current run, see ``get()``
+_CONTEXT = None
+_CONTEXT_LOCK = threading.Lock()
+
+
+class Credentials(object):
+    """Keys and known host keys shared by all the connections.
+
+    Attributes:
+        keys (list): Private keys (``paramiko.PKey``) available for public key
+            authentication, agent keys first.
+        locked (bool): Whether some key file could not be loaded because it
+            is protected with a passphrase.
+        host_keys (``paramiko.HostKeys``): Known host keys, read from
+            ``~/.ssh/known_hosts`` and extended with new hosts during the run.
+        preferred (dict): Key that succeeded for each host.
+        last: Key that succeeded last, or ``None``.
+    """
+
+    def __init__(self, ssh_dir=None):
+        import paramiko
+
+        ssh_dir = ssh_dir or os.path.expanduser('~/.ssh')
+
+        self.keys = []
+        self.locked = False
+        self.host_keys = paramiko.HostKeys()
+        self.preferred = {}
+        self.last = None
+        self._lock = threading.Lock()
+
+        # Agent identities
+        try:
+            self.keys.extend(paramiko.Agent().get_keys())
+
+        except Exception:
+            pass
+
+        # Default key files
+        for name, cls_name in KEY_FILES:
+            path = os.path.join(ssh_dir, name)
+            cls = getattr(paramiko, cls_name, None)
+
+            if not cls or not os.path.isfile(path):
+                continue
+
+            try:
+                self.keys.append(cls.from_private_key_file(path))
+
+            except paramiko.ssh_exception.PasswordRequiredException:
+                self.locked = True
+
+            except Exception:
+                # Not a valid key of this type
+                pass
+
+        # Known hosts
+        known_hosts = os.path.join(ssh_dir, 'known_hosts')
+
+        if os.path.isfile(known_hosts):
+            try:
+                self.host_keys.load(known_hosts)
+
+            except IOError:
+                pass
+
+    def candidates(self, host):
+        """Obtain the keys to try for a host, most likely to succeed first.
+
+        Arguments:
+            host (str): Name of the host.
+
+        Returns:
+            List of keys.
+        """
+        with self._lock:
+            first = [self.preferred.get(host), self.last]
+
+        ordered = [k for k in first if k is not None]
+
+        for key in self.keys:
+            if all(key is not k for k in ordered):
+                ordered.append(key)
+
+        return ordered
+
+    def missing_host_key(self, client, hostname, key):
+        """Check the key of a host against the known host keys.
+
+        The instance is used as host key policy of the connections, since the
+        known host keys are not loaded in each ``paramiko.SSHClient``. Unknown
+        hosts are accepted and their key is remembered for the rest of the
+        run.
+
+        Arguments:
+            client (``paramiko.SSHClient``): Client being connected.
+            hostname (str): Name of the host, as reported by paramiko.
+            key (``paramiko.PKey``): Key presented by the host.
+
+        Raises:
+            paramiko.BadHostKeyException: if the host is known and the key
+                does not match.
+        """
+        import paramiko
+
+        with self._lock:
+            known = self.host_keys.lookup(hostname)
+
+            if known is None or key.get_name() not in known:
+                self.host_keys.add(hostname, key.get_name(), key)
+                return
+
+        if known[key.get_name()] != key:
+            raise paramiko.ssh_exception.BadHostKeyException(
+                hostname, key, known[key.get_name()])
+
+    def success(self, host, key):
+        """Remember the key that succeeded for a host.
+
+        Arguments:
+            host (str): Name of the host.
+            key (``paramiko.PKey``): Key used.
+        """
+        with self._lock:
+            self.preferred[host] = key
+            self.last = key
+
+def get():
+    """Obtain the credentials of the current run, loading them if needed.
+
+    Returns:
+        ``Credentials`` instance.
+    """
+    global _CONTEXT
+
+    with _CONTEXT_LOCK:
+        if _CONTEXT is None:
+            _CONTEXT = Credentials()
+
+        return _CONTEXT
@@ -27,11 +27,13 @@
 
 """Code for the ``Deployer`` class, which acts as proxy for configurations."""
 
+import getpass
 import gettext
 import types
 
 from fumi import messages as m
 from fumi import deployments
+from fumi.timing import Timer
 from fumi.util import cprint
 
 
@@ -41,6 +43,9 @@ class Deployer(object):
     Attributes:
         source_type (str): Source type (e.g. 'local' or 'git'). Required.
         source_path (str): Path to the source files in local machine. Required.
+        ref (str): In ``git-archive`` and ``git-bundle`` deployments, git
+            reference (branch, tag or commit) to deploy. Defaults to
+            ``'HEAD'``.
         host (str): Host to perform the deployment in. Required.
         user (str): User to use for the deployment. Required.
         use_password (bool): Whether or not to use password. If set to ``False``
@@ -51,58 +56,261 @@ class Deployer(object):
             be used to specify the password used for the connection. Otherwise
             it will be asked for during deployment.
         deploy_path (str): Remote host path in which to deploy files. Required.
+        direct (bool): Whether the host is the local machine (``host: local``).
+            ``local`` deployments then copy the source directly to the new
+            revision, without compressing and uploading it.
+        bastion (tuple): ``(user, host, port)`` of the bastion (jump) host
+            used to reach the remote host, or ``None``. Written as
+            ``[user@]host[:port]`` in the configuration file.
+        connect_timeout (float): Seconds to wait for the connection and each
+            step of the SSH handshake. Defaults to 10.
+        connect_retries (int): Number of times a failed connection is
+            retried. Defaults to 2.
+        connect_backoff (float): Maximum seconds to wait before the first
+            retry, doubled on each following retry. Defaults to 1.
+        max_handshakes (int): Maximum number of SSH handshakes in progress at
+            the same time during the run. Defaults to 10.
+        transport (str): How the host is reached: ``'ssh'`` (default) or
+            ``'local'``, which runs the commands and copies the files in the
+            local machine.
+        transport_latency (float): With the ``local`` transport, seconds to
+            wait before each command or upload to simulate a network link.
+        transport_bandwidth (int): With the ``local`` transport, maximum
+            upload speed in bytes per second. May be written with a ``K``,
+            ``M`` or ``G`` suffix in the configuration file.
+        transport_root (str): With the ``local`` transport, working (and
+            home) directory of the commands, or ``None`` to use the current
+            ones.
         predep (list[str]): List of commands to execute before deploying.
         postdep (list[str]): List of commands to execute after deploying.
+        rollback_postdep (list[str]): List of commands to execute after
+            rolling back to a previous revision.
         host_tmp (str): In ``local`` deployments, the remote directory to use
             for uploading the compressed files (defaults to ``'/tmp'``).
         keep_max (int): Maximum revisions to keep in the remote server.
+        keep_size (int): Maximum size (in bytes) of all the revisions kept in
+            the remote server. May be written with a ``K``, ``M`` or ``G``
+            suffix in the configuration file.
+        keep_days (int): Maximum age (in days) of the revisions kept in the
+            remote server.
+        keep_min (int): Number of most recent successful revisions that are
+            always kept, regardless of other retention fields.
         local_ignore (list[str]): List of files (or directories) to ignore in
             ``local`` deployments.
+        hard_links (bool): With ``host: local``, hard link the files that did
+            not change since the current revision instead of copying them.
+            Defaults to ``False``.
         buffer_size (int): Buffer size (in bytes) for file copying in ``local``
             deployments. Defaults to 1 MB.
         shared_paths (list[str]): List of file and directory paths that
             should be shared accross deployments. These are relative to the
             root of the project and are linked to the current revision.
+        submodule_jobs (int): In ``git`` deployments, number of submodules
+            fetched in parallel, or ``None`` to not fetch submodules.
+        lfs (bool): In ``git`` deployments, whether to fetch Git LFS objects.
+        lfs_jobs (int): Number of concurrent Git LFS transfers. Defaults to 8.
+        batch_size (int or str): In multi-host deployments, number of hosts
+            (or percentage of hosts, e.g. ``'25%'``) deployed to at the same
+            time. Defaults to 1.
+        batch_pause (float): Seconds to wait between batches.
+        max_parallel (int): Maximum number of hosts processed at the same
+            time, regardless of the ``batch_size``. Defaults to 10.
+        max_fail (float): Maximum ratio of failed hosts (e.g. ``0.1`` or
+            ``'10%'`` in the configuration file) before aborting a multi-host
+            deployment. Hosts already deployed are rolled back on abort.
+        relay (bool): In multi-host ``local`` deployments, upload the
+            compressed source once per group of hosts and let the hosts that
+            already have it forward it to the rest.
+        relay_group (str): Inventory tag used to group hosts for ``relay``
+            (e.g. the datacenter). Defaults to ``'site'``.
+        name (str): Name of the configuration.
+        tags (dict): Inventory tags of the host.
+        metrics_file (str): Path to the Prometheus metrics file to write after
+            each deployment, or ``None``.
+        revision (str): Timestamp of the revision created by the last
+            successful deployment or ``None``.
+        previous_revision (str): Timestamp of the revision that was linked
+            to ``current`` before the last deployment, or ``None``.
+        timer (``Timer``): Duration of each phase of the deployment.
+        usage (tuple): ``(count, size)`` of the revisions in the remote host
+            after deploying, when ``metrics_file`` is set.
+        artifact_size (int): Size in bytes of the compressed source (archive
+            or bundle) built for the last deployment, or ``None``.
+        artifact (tuple): ``(timestamp, path)`` of a compressed source shared
+            by several hosts, or ``None``.
+        artifact_uploaded (bool): Whether the shared compressed source has
+            already been distributed to the host.
     """
 
     def __init__(self, **kwargs):
         # Source information
         self.source_type = kwargs['source-type']
         self.source_path = kwargs['source-path']
+        self.ref = kwargs.get('ref', 'HEAD')
 
         # Destination host information
         self.host = kwargs['host']
-        self.user = kwargs['user']
+        self.direct = self.host == 'local'
+        self.user = kwargs['user'] if not self.direct else kwargs.get(
+            'user', getpass.getuser())
         self.use_password = kwargs.get('use-password', False)
         self.password = kwargs.get('password')
         self.deploy_path = kwargs['deploy-path']
+        self.bastion = _parse_address(kwargs.get('bastion'))
 
-        # Pre-deployment commands
-        predep = kwargs.get('predep', [])
-        self.predep = []
+        # Connection settings
+        self.connect_timeout = float(kwargs.get('connect-timeout', 10))
+        self.connect_retries = int(kwargs.get('connect-retries', 2))
+        self.connect_backoff = float(kwargs.get('connect-backoff', 1))
+        self.max_handshakes = int(kwargs.get('max-handshakes', 10))
+        self.transport = 'local' if self.direct else kwargs.get(
+            'transport', 'ssh')
+        self.transport_latency = float(kwargs.get('transport-latency', 0))
+        self.transport_bandwidth = _parse_size(
+            kwargs.get('transport-bandwidth'))
+        self.transport_root = kwargs.get('transport-root')
+
+        if self.transport not in ('ssh', 'local'):
+            raise ValueError(m.DEP_UNKNOWN_TRANSPORT % self.transport)
 
-        for p in predep:
-            # Single key dicts
-            for k, v in p.items():
-                self.predep.append((k, v))
+        # Pre-deployment commands
+        self.predep = _command_list(kwargs.get('predep', []))
 
         # Post-deployment commands
-        postdep = kwargs.get('postdep', [])
-        self.postdep = []
+        self.postdep = _command_list(kwargs.get('postdep', []))
 
-        for p in postdep:
-            # Single key dicts
-            for k, v in p.items():
-                self.postdep.append((k, v))
+        # Post-rollback commands
+        self.rollback_postdep = _command_list(
+            kwargs.get('rollback-postdep', []))
 
 
         # Optional information
         self.host_tmp = kwargs.get('host-tmp', '/tmp')
         self.keep_max = kwargs.get('keep-max')
+        self.keep_size = _parse_size(kwargs.get('keep-size'))
+        self.keep_days = kwargs.get('keep-days')
+        self.keep_min = kwargs.get('keep-min')
         self.local_ignore = kwargs.get('local-ignore')
         self.buffer_size = int(kwargs.get('buffer-size', 1024 * 1024))
+        self.hard_links = kwargs.get('hard-links', False)
         self.shared_paths = kwargs.get('shared-paths', [])
 
+        # Git deployments
+        self.submodule_jobs = kwargs.get('submodule-jobs')
+        self.lfs = kwargs.get('lfs', False)
+        self.lfs_jobs = int(kwargs.get('lfs-jobs', 8))
+
+        if self.submodule_jobs is not None:
+            self.submodule_jobs = int(self.submodule_jobs)
+
+        # Multi-host deployments
+        self.batch_size = kwargs.get('batch-size', 1)
+        self.batch_pause = float(kwargs.get('batch-pause', 0))
+        self.max_fail = _parse_ratio(kwargs.get('max-fail'))
+        self.max_parallel = int(kwargs.get('max-parallel', 10))
+        self.relay = kwargs.get('relay', False)
+        self.relay_group = kwargs.get('relay-group', 'site')
+        self.name = None
+        self.tags = {}
+
+        # Metrics
+        self.metrics_file = kwargs.get('metrics-file')
+
+        # Set during multi-host deployments
+        self.artifact = None
+        self.artifact_uploaded = False
+
+        # Set after deploying
+        self.revision = None
+        self.previous_revision = None
+        self.timer = Timer(self.host)
+        self.usage = None
+        self.artifact_size = None
+
+def _command_list(commands):
+    """Flatten a list of single key command dicts.
+
+    Arguments:
+        commands (list[dict]): Commands as read from the YAML file.
+
+    Returns:
+        List of ``(type, command)`` tuples.
+    """
+    flat = []
+
+    for c in commands:
+        # Single key dicts
+        for k, v in c.items():
+            flat.append((k, v))
+
+    return flat
+
+def _parse_address(address):
+    """Parse an SSH address in the form ``[user@]host[:port]``.
+
+    Arguments:
+        address (str): Address as read from the YAML file.
+
+    Returns:
+        ``(user, host, port)`` tuple (``user`` may be ``None``) or ``None``.
+
+    Raises:
+        ValueError: if the port is not valid.
+    """
+    if not address:
+        return None
+
+    user, _, host = str(address).strip().rpartition('@')
+    host, _, port = host.partition(':')
+
+    return (user or None, host, int(port or 22))
+
+def _parse_ratio(ratio):
+    """Parse a ratio, either as a number or as a percentage string.
+
+    Arguments:
+        ratio (float or str): Ratio as read from the YAML file (e.g. ``0.1``
+            or ``'10%'``).
+
+    Returns:
+        Float ratio or ``None``.
+
+    Raises:
+        ValueError: if the ratio is not valid.
+    """
+    if ratio is None:
+        return None
+
+    ratio = str(ratio).strip()
+
+    if ratio.endswith('%'):
+        return float(ratio[:-1]) / 100
+
+    return float(ratio)
+
+def _parse_size(size):
+    """Parse a size in bytes, with an optional ``K``, ``M`` or ``G`` suffix.
+
+    Arguments:
+        size (int or str): Size as read from the YAML file.
+
+    Returns:
+        Integer size in bytes or ``None``.
+
+    Raises:
+        ValueError: if the size is not valid.
+    """
+    if size is None or isinstance(size, int):
+        return size
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = str(size).strip().upper()
+
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(size)
+
 def build_deployer(config):
     """Build a Deployer object.
 
@@ -118,7 +326,12 @@ def build_deployer(config):
     except KeyError as e:
         # Missing required parameter
         key = e.args[0]
-        cprint(m.DEP_MISSING_PARAM + '\n' % key, 'red')
+        cprint((m.DEP_MISSING_PARAM % key) + '\n', 'red')
+        return False, None
+
+    except ValueError as e:
+        # Invalid value for a parameter
+        cprint(m.DEP_INVALID_PARAM % e, 'red')
         return False, None
 
     # Determine deployment function to use
@@ -130,6 +343,16 @@ def build_deployer(config):
         cprint(m.DEP_GIT)
         deployer.deploy = types.MethodType(deployments.deploy_git, deployer)
 
+    elif deployer.source_type == 'git-archive':
+        cprint(m.DEP_ARCHIVE)
+        deployer.deploy = types.MethodType(
+            deployments.deploy_git_archive, deployer)
+
+    elif deployer.source_type == 'git-bundle':
+        cprint(m.DEP_BUNDLE)
+        deployer.deploy = types.MethodType(
+            deployments.deploy_git_bundle, deployer)
+
     else:
         # Unknown deployment type
         cprint(m.DEP_UNKNOWN % deployer.source_type, 'red')
@@ -138,4 +361,9 @@ def build_deployer(config):
     # Additional method for preparing/testing the deployment
     deployer.prepare = types.MethodType(deployments.prepare, deployer)
 
+    # Revision management
+    deployer.activate = types.MethodType(deployments.activate, deployer)
+    deployer.revisions = types.MethodType(deployments.revisions, deployer)
+    deployer.rollback = types.MethodType(deployments.rollback, deployer)
+
     return True, deployer
@@ -1,3 +1,6 @@
 from fumi.deployments.local import deploy as deploy_local
 from fumi.deployments.git import deploy as deploy_git
+from fumi.deployments.archive import deploy as deploy_git_archive
+from fumi.deployments.bundle import deploy as deploy_git_bundle
 from fumi.deployments.prepare import prepare
+from fumi.deployments.revision import activate, revisions, rollback
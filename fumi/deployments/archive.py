@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Implementation of the ``git-archive`` based deployment.
+
+This exports a commit of a local git repository with ``git archive`` and
+uploads it to the remote host, which does not need git or access to the git
+server.
+
+Archives are cached locally by commit. The remote host keeps a pristine copy
+of the last deployed commit (in deploy_path/pristine), which is never used by
+the application nor modified by post-deployment commands. Only the files that
+changed since that commit are archived and applied to the pristine copy, and
+each revision is then a copy of it, so revisions always match their commit.
+"""
+
+import datetime
+import os
+import subprocess
+import tempfile
+
+from six.moves import shlex_quote
+
+from fumi import messages as m
+from fumi import util
+from fumi.deployments.local import upload
+
+ARCHIVE_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME')
+    or os.path.join(os.path.expanduser('~'), '.cache'),
+    'fumi',
+    'archives')
+
+# Archives kept in the cache
+CACHE_MAX = 20
+
+# Above this number of changed paths, the whole tree is uploaded
+MAX_CHANGES = 500
+
+# Directory (in deploy_path) with the pristine copy of the last commit
+PRISTINE_DIR = 'pristine'
+
+
+def deploy(deployer, stage=False):
+    """Git archive based deployment.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        stage (bool): Only upload and extract the revision, without linking it
+            to the ``current`` directory.
+
+    Returns:
+        Boolean indicating result of the deployment.
+    """
+    # Resolve the commit to deploy
+    status, commit = resolve(deployer)
+    if not status:
+        return False
+
+
+    # SSH connection
+    deployer.timer.start('connect')
+
+    util.cprint(
+        '> ' + m.DEP_CONNECTING % (deployer.host, deployer.user),
+        'cyan'
+    )
+
+    status, ssh = util.connect(deployer)
+    if not status:
+        return False
+
+    util.cprint(m.DEP_CONNECTED + '\n', 'green')
+
+
+    # Predeployment commands
+    deployer.timer.start('predep')
+
+    status = util.run_commands(ssh, deployer.predep, timer=deployer.timer)
+    if not status:
+        ssh.close()
+        return False
+
+
+    # Directory structures
+    deployer.timer.start('check_dirs')
+
+    util.cprint('> ' + m.DEP_CHECK_REMOTE, 'cyan')
+
+    status = util.check_dirs(ssh, deployer)
+    if not status:
+        ssh.close()
+        return False
+
+    util.cprint(m.CORRECT + '\n', 'green')
+
+
+    # Archive the commit (or the paths changed since the pristine one)
+    deployer.timer.start('archive')
+
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+
+    rev_path = os.path.join(deployer.deploy_path, 'rev')
+    current_rev = os.path.join(rev_path, timestamp)
+
+    previous, changes = deployed_changes(ssh, deployer, commit)
+
+    if previous:
+        removed, added = changes
+        util.cprint(
+            m.DEP_ARCHIVE_DELTA % (len(set(removed + added)), previous[:12]),
+            'white')
+
+    else:
+        added = None
+
+    tmp_local = None
+
+    if added != []:
+        tmp_local = build_archive(deployer, commit, previous, added)
+
+        if not tmp_local:
+            ssh.close()
+            return False
+
+        deployer.artifact_size = os.path.getsize(tmp_local)
+
+
+    # Upload archive
+    deployer.timer.start('upload')
+
+    uload_path = os.path.join(
+        deployer.host_tmp or '/tmp', timestamp + '.tar.gz')
+
+    if tmp_local:
+        util.cprint(
+            '> ' + m.DEP_LOCAL_UPLOAD % os.path.basename(tmp_local), 'cyan')
+
+        if not upload(ssh, deployer, tmp_local, uload_path):
+            util.rollback(ssh, deployer, timestamp, 2)
+            ssh.close()
+            return False
+
+        util.cprint(m.DONE + '\n', 'green')
+
+
+    # Build the revision in deploy_path/rev
+    deployer.timer.start('extract')
+
+    util.cprint('> ' + m.DEP_LOCAL_UNCOMPRESS, 'cyan')
+
+    pristine_path = os.path.join(deployer.deploy_path, PRISTINE_DIR)
+    pristine_rev = os.path.join(pristine_path, commit)
+    building = pristine_rev + '.tmp'
+
+    script = []
+
+    if not previous:
+        # Start over from the whole tree
+        script.append('rm -rf %s && mkdir -p %s' % (pristine_path, building))
+
+    elif previous != commit:
+        # Turn the pristine copy of the previous commit into this one
+        script.append('mv %s %s' % (
+            os.path.join(pristine_path, previous), building))
+
+        if removed:
+            script.append(
+                'cd %s && rm -rf -- %s && '
+                'find . -mindepth 1 -depth -type d -empty -delete' % (
+                    building, ' '.join(shlex_quote(p) for p in removed)))
+
+    if tmp_local:
+        script.append('tar -C %s -zxf %s' % (building, uload_path))
+
+    if previous != commit:
+        script.append('mv %s %s' % (building, pristine_rev))
+
+    script.append('cp -a %s %s' % (pristine_rev, current_rev))
+    script.append('echo "%s %s" >> %s' % (
+        timestamp, commit,
+        os.path.join(deployer.deploy_path, util.COMMIT_LOG)))
+
+    status, stdout, stderr = ssh.run(' && '.join(script))
+
+    if status != 0:
+        util.cprint(m.DEP_ARCHIVE_EXTRACT_ERR + '\n', 'red')
+        util.cprint(stderr)
+
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
+
+    util.cprint(m.DONE + '\n', 'green')
+
+
+    # Link shared paths inside the new revision
+    deployer.timer.start('link_shared')
+
+    status = util.symlink_shared(ssh, deployer, current_rev)
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
+
+
+    # Staged revisions are activated later on
+    if stage:
+        deployer.timer.start('record')
+        util.record_revision(ssh, deployer, timestamp, 'staged')
+
+        if deployer.metrics_file:
+            deployer.usage = util.revision_usage(ssh, deployer)
+
+        if tmp_local:
+            deployer.timer.start('clean_tmp')
+            util.remove_remote(ssh, uload_path)
+
+        util.cprint(m.DEP_STAGE_COMPLETE % timestamp, 'green')
+        deployer.revision = timestamp
+
+        ssh.close()
+        return True
+
+
+    # Link directory
+    deployer.timer.start('symlink')
+
+    status = util.symlink(ssh, deployer, rev_path, timestamp)
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
+
+
+    # Run post-deployment commands
+    deployer.timer.start('postdep')
+
+    status = util.run_commands(
+        ssh,
+        deployer.postdep,
+        os.path.join(deployer.deploy_path, 'current'),
+        timer=deployer.timer)
+
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 4)
+        ssh.close()
+        return False
+
+
+    # Record revision (and its size) in the revision log
+    deployer.timer.start('record')
+
+    util.record_revision(ssh, deployer, timestamp, 'ok')
+
+
+    # Clean revisions
+    if deployer.keep_max or deployer.keep_size or deployer.keep_days:
+        deployer.timer.start('clean_revisions')
+        status = util.clean_revisions(ssh, deployer)
+
+
+    # Disk usage for the metrics file
+    if deployer.metrics_file:
+        deployer.timer.start('usage')
+        deployer.usage = util.revision_usage(ssh, deployer)
+
+
+    # Cleanup uploaded archive (the local one stays in the cache)
+    if tmp_local:
+        deployer.timer.start('clean_tmp')
+        util.remove_remote(ssh, uload_path)
+
+
+    util.cprint(m.DEP_COMPLETE, 'green')
+    deployer.revision = timestamp
+
+    # Close SSH connection
+    ssh.close()
+
+    return True
+
+def build_archive(deployer, commit, previous=None, paths=None):
+    """Obtain the archive of a commit, from the cache if possible.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        commit (str): Hash of the commit to archive.
+        previous (str): Commit of the pristine copy in the remote host, when
+            only some paths are archived.
+        paths (list[str]): Paths to archive, or ``None`` for the whole tree.
+
+    Returns:
+        Path to the archive or ``None`` on error.
+    """
+    if paths is None:
+        name = commit + '.tar.gz'
+
+    else:
+        name = '%s-%s.tar.gz' % (previous, commit)
+
+    path = os.path.join(ARCHIVE_CACHE, name)
+
+    if os.path.isfile(path):
+        util.cprint(m.DEP_ARCHIVE_CACHED % path, 'white')
+        os.utime(path, None)
+        return path
+
+    util.cprint('> ' + m.DEP_ARCHIVE_BUILD % (commit[:12], path), 'cyan')
+
+    if not os.path.isdir(ARCHIVE_CACHE):
+        os.makedirs(ARCHIVE_CACHE)
+
+    # Written to a temporary file first, as several hosts may build it
+    fd, tmp_path = tempfile.mkstemp(dir=ARCHIVE_CACHE, suffix='.tmp')
+
+    command = ['archive', '--format=tar.gz', commit]
+
+    if paths is not None:
+        command += ['--'] + paths
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            subprocess.check_call(
+                ['git', '--literal-pathspecs', '-C', deployer.source_path]
+                + command,
+                stdout=f)
+
+        os.rename(tmp_path, path)
+
+    except (OSError, subprocess.CalledProcessError) as e:
+        util.cprint(m.DEP_ARCHIVE_ERR % (commit[:12], e), 'red')
+        util.remove_local(tmp_path)
+        return None
+
+    _prune_cache()
+
+    util.cprint(m.DONE + '\n', 'green')
+
+    return path
+
+def deployed_changes(ssh, deployer, commit):
+    """Compare a commit with the pristine copy in the host.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        commit (str): Hash of the commit to deploy.
+
+    Returns:
+        Commit of the pristine copy and lists of paths removed and added by
+        the new commit (see ``diff_trees()``), or ``None`` and ``None`` if
+        the whole tree has to be uploaded.
+    """
+    status, stdout, stderr = ssh.run('ls -1 %s 2> /dev/null' % os.path.join(
+        deployer.deploy_path, PRISTINE_DIR))
+
+    entries = stdout.split()
+
+    # Leftovers of an interrupted deployment are discarded
+    if len(entries) != 1 or entries[0].endswith('.tmp'):
+        return None, None
+
+    previous = entries[0]
+
+    try:
+        removed, added = diff_trees(deployer.source_path, previous, commit)
+
+    except subprocess.CalledProcessError:
+        # Commit not available locally
+        return None, None
+
+    if len(removed) + len(added) > MAX_CHANGES:
+        return None, None
+
+    return previous, (removed, added)
+
+def diff_trees(repo, old, new):
+    """Find the files that differ between two trees.
+
+    Renames are reported as a removed and an added path.
+
+    Arguments:
+        repo (str): Path to the local repository.
+        old (str): Old tree (or commit).
+        new (str): New tree (or commit).
+
+    Returns:
+        Lists of paths removed (or replaced) and added (or replaced).
+
+    Raises:
+        subprocess.CalledProcessError: if a tree is not available.
+    """
+    with open(os.devnull, 'w') as null:
+        output = subprocess.check_output(
+            ['git', '-C', repo, 'diff-tree', '-r', '-z', '--no-renames',
+             old, new],
+            stderr=null)
+
+    removed = []
+    added = []
+
+    # Entries are ":<old mode> <new mode> <old> <new> <status>\0<path>\0"
+    fields = output.decode('utf-8').split('\0')
+
+    for info, path in zip(fields[0::2], fields[1::2]):
+        status = info.split()[-1]
+
+        if status != 'A':
+            removed.append(path)
+
+        if status != 'D':
+            added.append(path)
+
+    return removed, added
+
+def resolve(deployer):
+    """Obtain the hash of the commit to deploy.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        Boolean indicating result and commit hash.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', '-C', deployer.source_path, 'rev-parse', '--verify',
+             '%s^{commit}' % deployer.ref],
+            stderr=subprocess.STDOUT)
+
+    except (OSError, subprocess.CalledProcessError):
+        util.cprint(m.DEP_ARCHIVE_REF % deployer.ref, 'red')
+        return False, None
+
+    commit = commit.decode('ascii').strip()
+    util.cprint(m.DEP_ARCHIVE_COMMIT % (deployer.ref, commit[:12]), 'white')
+
+    return True, commit
+
+def _prune_cache():
+    """Remove the least recently used archives from the cache."""
+    archives = sorted(
+        (os.path.getmtime(os.path.join(ARCHIVE_CACHE, n)), n)
+        for n in os.listdir(ARCHIVE_CACHE) if n.endswith('.tar.gz'))
+
+    for mtime, name in archives[:-CACHE_MAX]:
+        util.remove_local(os.path.join(ARCHIVE_CACHE, name))
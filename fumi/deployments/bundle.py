@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Implementation of the ``git-bundle`` based deployment.
+
+The remote host keeps a bare mirror of the repository in
+``deploy_path/mirror.git``. On each deployment, only the commits the mirror
+does not have yet are sent, as an incremental ``git bundle`` computed
+against the commits it already knows. The revision is then exported from the
+mirror in the remote host, which does not need access to the git server.
+"""
+
+import datetime
+import os
+import subprocess
+import tempfile
+
+from fumi import messages as m
+from fumi import util
+from fumi.deployments.archive import resolve
+from fumi.deployments.local import upload
+
+# Bare repository in the remote host, relative to deploy_path
+MIRROR = 'mirror.git'
+
+# Deployed commits kept as references in the mirror
+MIRROR_REFS = 10
+
+# Reference included in bundles
+BUNDLE_REF = 'refs/fumi/bundle'
+
+
+def deploy(deployer, stage=False):
+    """Git bundle based deployment.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        stage (bool): Only export the revision, without linking it to the
+            ``current`` directory.
+
+    Returns:
+        Boolean indicating result of the deployment.
+    """
+    # Resolve the commit to deploy
+    status, commit = resolve(deployer)
+    if not status:
+        return False
+
+
+    # SSH connection
+    deployer.timer.start('connect')
+
+    util.cprint(
+        '> ' + m.DEP_CONNECTING % (deployer.host, deployer.user),
+        'cyan'
+    )
+
+    status, ssh = util.connect(deployer)
+    if not status:
+        return False
+
+    util.cprint(m.DEP_CONNECTED + '\n', 'green')
+
+
+    # Predeployment commands
+    deployer.timer.start('predep')
+
+    status = util.run_commands(ssh, deployer.predep, timer=deployer.timer)
+    if not status:
+        ssh.close()
+        return False
+
+
+    # Directory structures
+    deployer.timer.start('check_dirs')
+
+    util.cprint('> ' + m.DEP_CHECK_REMOTE, 'cyan')
+
+    status = util.check_dirs(ssh, deployer)
+    if not status:
+        ssh.close()
+        return False
+
+    status, known = mirror_commits(ssh, deployer)
+    if not status:
+        ssh.close()
+        return False
+
+    util.cprint(m.CORRECT + '\n', 'green')
+
+
+    # Bundle the commits missing in the mirror
+    deployer.timer.start('bundle')
+
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+
+    status, tmp_local = build_bundle(deployer, commit, known)
+    if not status:
+        ssh.close()
+        return False
+
+    uload_path = os.path.join(
+        deployer.host_tmp or '/tmp', timestamp + '.bundle')
+
+
+    # Upload bundle and fetch it in the mirror
+    if tmp_local:
+        deployer.timer.start('upload')
+
+        util.cprint(
+            '> ' + m.DEP_LOCAL_UPLOAD % os.path.basename(uload_path), 'cyan')
+
+        deployer.artifact_size = os.path.getsize(tmp_local)
+
+        status = upload(ssh, deployer, tmp_local, uload_path)
+        util.remove_local(os.path.dirname(tmp_local))
+
+        if status:
+            util.cprint(m.DONE + '\n', 'green')
+
+            deployer.timer.start('fetch')
+            status = fetch_bundle(ssh, deployer, commit, uload_path)
+
+        # The bundle is not needed once fetched
+        util.remove_remote(ssh, uload_path)
+
+        if not status:
+            ssh.close()
+            return False
+
+
+    # Export the commit to deploy_path/rev
+    deployer.timer.start('checkout')
+
+    util.cprint('> ' + m.DEP_BUNDLE_CHECKOUT % commit[:12], 'cyan')
+
+    rev_path = os.path.join(deployer.deploy_path, 'rev')
+    current_rev = os.path.join(rev_path, timestamp)
+    mirror = os.path.join(deployer.deploy_path, MIRROR)
+
+    status, stdout, stderr = ssh.run(
+        'mkdir -p %s && git -C %s archive %s | tar -C %s -xf -' % (
+            current_rev, mirror, commit, current_rev))
+
+    if status != 0:
+        util.cprint(m.DEP_ARCHIVE_EXTRACT_ERR + '\n', 'red')
+        util.cprint(stderr)
+
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
+
+    util.cprint(m.DONE + '\n', 'green')
+
+
+    # Link shared paths inside the new revision
+    deployer.timer.start('link_shared')
+
+    status = util.symlink_shared(ssh, deployer, current_rev)
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
+
+
+    # Staged revisions are activated later on
+    if stage:
+        deployer.timer.start('record')
+        util.record_revision(ssh, deployer, timestamp, 'staged')
+
+        if deployer.metrics_file:
+            deployer.usage = util.revision_usage(ssh, deployer)
+
+        util.cprint(m.DEP_STAGE_COMPLETE % timestamp, 'green')
+        deployer.revision = timestamp
+
+        ssh.close()
+        return True
+
+
+    # Link directory
+    deployer.timer.start('symlink')
+
+    status = util.symlink(ssh, deployer, rev_path, timestamp)
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
+
+
+    # Run post-deployment commands
+    deployer.timer.start('postdep')
+
+    status = util.run_commands(
+        ssh,
+        deployer.postdep,
+        os.path.join(deployer.deploy_path, 'current'),
+        timer=deployer.timer)
+
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 4)
+        ssh.close()
+        return False
+
+
+    # Record revision (and its size) in the revision log
+    deployer.timer.start('record')
+
+    util.record_revision(ssh, deployer, timestamp, 'ok')
+
+
+    # Clean revisions
+    if deployer.keep_max or deployer.keep_size or deployer.keep_days:
+        deployer.timer.start('clean_revisions')
+        status = util.clean_revisions(ssh, deployer)
+
+
+    # Disk usage for the metrics file
+    if deployer.metrics_file:
+        deployer.timer.start('usage')
+        deployer.usage = util.revision_usage(ssh, deployer)
+
+
+    util.cprint(m.DEP_COMPLETE, 'green')
+    deployer.revision = timestamp
+
+    # Close SSH connection
+    ssh.close()
+
+    return True
+
+def build_bundle(deployer, commit, known):
+    """Bundle the commits that the remote mirror does not have.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        commit (str): Hash of the commit to deploy.
+        known (list[str]): Commits referenced in the remote mirror.
+
+    Returns:
+        Boolean indicating result and path to the bundle (in a temporary
+        directory), or ``None`` if the mirror already has the commit.
+    """
+    repo = ['git', '-C', deployer.source_path]
+
+    # Only the commits that also exist locally can be excluded
+    with open(os.devnull, 'w') as null:
+        known = [
+            c for c in known
+            if subprocess.call(
+                repo + ['cat-file', '-e', c + '^{commit}'],
+                stdout=null, stderr=null) == 0]
+
+    exclude = ['--not'] + known if known else []
+
+    try:
+        count = int(subprocess.check_output(
+            repo + ['rev-list', '--count', commit] + exclude))
+
+    except (OSError, subprocess.CalledProcessError) as e:
+        util.cprint(m.DEP_BUNDLE_ERR % e, 'red')
+        return False, None
+
+    if not count:
+        util.cprint(m.DEP_BUNDLE_UPTODATE % commit[:12], 'white')
+        return True, None
+
+    util.cprint('> ' + m.DEP_BUNDLE_CREATE % count, 'cyan')
+
+    tmp_dir = tempfile.mkdtemp(prefix='fumi-')
+    path = os.path.join(tmp_dir, 'fumi.bundle')
+
+    # Bundles need a reference to the commit. It is created in a temporary
+    # repository that borrows the objects of the local one, which is not
+    # modified at all
+    tmp_repo = ['git', '-C', os.path.join(tmp_dir, 'repo.git')]
+
+    try:
+        objects = os.path.join(
+            deployer.source_path,
+            subprocess.check_output(
+                repo + ['rev-parse', '--git-common-dir']
+            ).decode('utf-8').strip(),
+            'objects')
+
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call(
+                ['git', 'init', '-q', '--bare', os.path.join(
+                    tmp_dir, 'repo.git')],
+                stdout=null)
+
+            with open(os.path.join(
+                    tmp_dir, 'repo.git', 'objects', 'info', 'alternates'),
+                    'w') as f:
+                f.write(os.path.abspath(objects) + '\n')
+
+            subprocess.check_call(
+                tmp_repo + ['update-ref', BUNDLE_REF, commit])
+            subprocess.check_call(
+                tmp_repo + ['bundle', 'create', '-q', path, BUNDLE_REF]
+                + exclude,
+                stdout=null, stderr=null)
+
+    except (IOError, OSError, subprocess.CalledProcessError) as e:
+        util.cprint(m.DEP_BUNDLE_ERR % e, 'red')
+        util.remove_local(tmp_dir)
+        return False, None
+
+    util.cprint(m.DONE + '\n', 'green')
+
+    return True, path
+
+def fetch_bundle(ssh, deployer, commit, bundle_path):
+    """Fetch an uploaded bundle in the remote mirror.
+
+    The commit is kept as a reference in the mirror, so that later bundles
+    only include newer commits. Only the most recent ``MIRROR_REFS``
+    references are kept.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        commit (str): Hash of the deployed commit.
+        bundle_path (str): Path of the bundle in the remote host.
+
+    Returns:
+        Boolean indicating result.
+    """
+    util.cprint('> ' + m.DEP_BUNDLE_FETCH, 'cyan')
+
+    mirror = os.path.join(deployer.deploy_path, MIRROR)
+
+    status, stdout, stderr = ssh.run(
+        'git -C %s fetch -q %s %s:refs/fumi/%s' % (
+            mirror, bundle_path, BUNDLE_REF, commit))
+
+    if status != 0:
+        util.cprint(m.DEP_BUNDLE_MIRROR_ERR + '\n', 'red')
+        util.cprint(stderr)
+        return False
+
+    # Forget old commits
+    ssh.run(
+        'git -C %s for-each-ref --sort=-committerdate --format="%%(refname)" '
+        'refs/fumi | tail -n +%d | while read r; do '
+        'git -C %s update-ref -d "$r"; done' % (
+            mirror, MIRROR_REFS + 1, mirror))
+
+    util.cprint(m.DONE + '\n', 'green')
+
+    return True
+
+def mirror_commits(ssh, deployer):
+    """Obtain the commits referenced in the remote mirror.
+
+    The mirror is created if it does not exist yet.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        Boolean indicating result and list of commit hashes.
+    """
+    mirror = os.path.join(deployer.deploy_path, MIRROR)
+
+    status, stdout, stderr = ssh.run(
+        '{ [ -d %s ] || git init -q --bare %s; } && '
+        'git -C %s for-each-ref --format="%%(objectname)" refs/fumi' % (
+            mirror, mirror, mirror))
+
+    if status == 127:
+        util.cprint(m.DEP_GIT_NOTFOUND, 'red')
+        return False, []
+
+    elif status != 0:
+        util.cprint(m.DEP_BUNDLE_MIRROR_ERR, 'red')
+        util.cprint(stderr)
+        return False, []
+
+    return True, [l.strip() for l in stdout.splitlines() if l.strip()]
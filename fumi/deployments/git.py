@@ -37,17 +37,25 @@ import os
 from fumi import messages as m
 from fumi import util
 
+# Directory of the remote host (inside deploy_path) with the submodule mirrors
+# and LFS objects
+CACHE = 'cache'
 
-def deploy(deployer):
+
+def deploy(deployer, stage=False):
     """Git based deployment.
 
     Arguments:
         deployer (``Deployer``): Deployer instance.
+        stage (bool): Only clone the revision, without linking it to the
+            ``current`` directory.
 
     Returns:
         Boolean indicating result of the deployment.
     """
     # SSH connection
+    deployer.timer.start('connect')
+
     util.cprint(
         '> ' + m.DEP_CONNECTING % (deployer.host, deployer.user),
         'cyan'
@@ -55,20 +63,23 @@ def deploy(deployer):
 
     status, ssh = util.connect(deployer)
     if not status:
-        ssh.close()
         return False
 
     util.cprint(m.DEP_CONNECTED + '\n', 'green')
 
 
     # Predeployment commands
-    status, util.run_commands(ssh, deployer.predep)
+    deployer.timer.start('predep')
+
+    status = util.run_commands(ssh, deployer.predep, timer=deployer.timer)
     if not status:
         ssh.close()
         return False
 
 
     # Directory structures
+    deployer.timer.start('check_dirs')
+
     util.cprint('> ' + m.DEP_CHECK_REMOTE, 'cyan')
 
     status = util.check_dirs(ssh, deployer)
@@ -80,6 +91,8 @@ def deploy(deployer):
 
 
     # Clone source
+    deployer.timer.start('clone')
+
     timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
     util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
 
@@ -90,50 +103,216 @@ def deploy(deployer):
 
     clone = 'git clone %s %s' % (deployer.source_path, current_rev)
 
-    stdin, stdout, stderr = ssh.exec_command(clone)
-    status = stdout.channel.recv_exit_status()
+    if deployer.lfs:
+        # LFS objects are fetched afterwards, concurrently
+        clone = 'GIT_LFS_SKIP_SMUDGE=1 ' + clone
+
+    status, stdout, stderr = ssh.run(clone)
 
     if status == 127:
         util.cprint(m.DEP_MISSING_PARAM)
         ssh.close()
         return False
-    # TODO: check git exit codes
+
+    elif status != 0:
+        util.cprint(m.DEP_GIT_CLONE_ERR + '\n', 'red')
+        util.cprint(stderr)
+
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
 
     util.cprint(m.DONE + '\n', 'green')
 
 
-    # Link directory
-    status = util.symlink(ssh, deployer, rev_path, timestamp)
+    # Submodules
+    if deployer.submodule_jobs:
+        deployer.timer.start('submodules')
+
+        util.cprint(
+            '> ' + m.DEP_GIT_SUBMODULES % deployer.submodule_jobs, 'cyan')
+
+        status, stdout, stderr = ssh.run(
+            submodules_cmd(deployer, current_rev))
+
+        if status != 0:
+            util.cprint(m.DEP_GIT_SUBMODULES_ERR + '\n', 'red')
+            util.cprint(stderr)
+
+            util.rollback(ssh, deployer, timestamp, 3)
+            ssh.close()
+            return False
+
+        util.cprint(m.DONE + '\n', 'green')
+
+
+    # Git LFS objects
+    if deployer.lfs:
+        deployer.timer.start('lfs')
+
+        util.cprint('> ' + m.DEP_GIT_LFS % deployer.lfs_jobs, 'cyan')
+
+        status, stdout, stderr = ssh.run(lfs_cmd(deployer, current_rev))
+
+        if status != 0:
+            util.cprint(m.DEP_GIT_LFS_ERR + '\n', 'red')
+            util.cprint(stderr)
+
+            util.rollback(ssh, deployer, timestamp, 3)
+            ssh.close()
+            return False
+
+        util.cprint(m.DONE + '\n', 'green')
+
+
+    # Link shared paths inside the new revision
+    deployer.timer.start('link_shared')
+
+    status = util.symlink_shared(ssh, deployer, current_rev)
     if not status:
         util.rollback(ssh, deployer, timestamp, 3)
         ssh.close()
         return False
 
 
-    # Link shared paths
-    util.symlink_shared(ssh, deployer)
+    # Staged revisions are activated later on
+    if stage:
+        deployer.timer.start('record')
+        util.record_revision(ssh, deployer, timestamp, 'staged')
+
+        if deployer.metrics_file:
+            deployer.usage = util.revision_usage(ssh, deployer)
+
+        util.cprint(m.DEP_STAGE_COMPLETE % timestamp, 'green')
+        deployer.revision = timestamp
+
+        ssh.close()
+        return True
+
+
+    # Link directory
+    deployer.timer.start('symlink')
+
+    status = util.symlink(ssh, deployer, rev_path, timestamp)
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
 
 
     # Run post-deployment commands
+    deployer.timer.start('postdep')
+
     status = util.run_commands(
         ssh,
         deployer.postdep,
-        os.path.join(deployer.deploy_path, 'current'))
+        os.path.join(deployer.deploy_path, 'current'),
+        timer=deployer.timer)
 
     if not status:
-        util.rollback(ssh, deployer, timestamp, 3)
+        util.rollback(ssh, deployer, timestamp, 4)
         ssh.close()
         return False
 
 
+    # Record revision (and its size) in the revision log
+    deployer.timer.start('record')
+
+    util.record_revision(ssh, deployer, timestamp, 'ok')
+
+
     # Clean revisions
-    if deployer.keep_max:
-        status = util.clean_revisions(ssh, deployer.keep_max, rev_path)
+    if deployer.keep_max or deployer.keep_size or deployer.keep_days:
+        deployer.timer.start('clean_revisions')
+        status = util.clean_revisions(ssh, deployer)
+
+
+    # Disk usage for the metrics file
+    if deployer.metrics_file:
+        deployer.timer.start('usage')
+        deployer.usage = util.revision_usage(ssh, deployer)
 
 
     util.cprint(m.DEP_COMPLETE, 'green')
+    deployer.revision = timestamp
 
     # Close SSH connection
     ssh.close()
 
     return True
+
+def lfs_cmd(deployer, rev_path):
+    """Build the shell command that fetches the Git LFS objects of a revision.
+
+    LFS objects are stored in ``deploy_path/cache/lfs``, shared by all the
+    revisions, so only new objects are downloaded.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        rev_path (str): Path of the cloned revision.
+
+    Returns:
+        Shell command.
+    """
+    storage = os.path.join(deployer.deploy_path, CACHE, 'lfs')
+
+    return (
+        'cd %s && git config lfs.storage %s && '
+        'git -c lfs.concurrenttransfers=%d lfs pull' % (
+            rev_path, storage, deployer.lfs_jobs))
+
+def submodules_cmd(deployer, rev_path):
+    """Build the shell command that fetches the submodules of a revision.
+
+    Each submodule is mirrored in ``deploy_path/cache/modules`` (mirrors are
+    updated in parallel) and then checked out from its mirror, so only new
+    objects are downloaded from the git server. Submodules with relative URLs
+    and nested submodules are fetched from their URL directly.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        rev_path (str): Path of the cloned revision.
+
+    Returns:
+        Shell command.
+    """
+    mirrors = os.path.join(deployer.deploy_path, CACHE, 'modules')
+    jobs = deployer.submodule_jobs
+
+    # "name url" of each submodule with an absolute URL
+    modules = (
+        "git config -f .gitmodules --get-regexp '^submodule\\..*\\.url$' | "
+        "sed 's/^submodule\\.\\(.*\\)\\.url /\\1 /' | "
+        "grep -v ' \\.\\.\\?/'")
+
+    # Path of the mirror of submodule $1
+    mirror = '%s/$(echo "$1" | tr / _).git' % mirrors
+
+    update = (
+        'm=%s; if [ -d "$m" ]; then git -C "$m" fetch -q --prune; '
+        'else git clone -q --mirror "$2" "$m"; fi' % mirror)
+
+    use = (
+        'set -- $name; m=%s; '
+        '[ ! -d "$m" ] || git config submodule."$1".url "$m"' % mirror)
+
+    script = [
+        'cd %s' % rev_path,
+        '{ [ -f .gitmodules ] || exit 0; }',
+        'mkdir -p %s' % mirrors,
+        # Submodules whose mirror fails are fetched from their URL
+        "{ %s | xargs -r -n 2 -P %d sh -c '%s' sh || true; }" % (
+            modules, jobs, update),
+        'git submodule -q init',
+        '{ %s | while read name; do %s; done; }' % (modules, use),
+        # Mirrors are local paths, which git rejects by default
+        'git -c protocol.file.allow=always submodule -q update --recursive '
+        '--jobs %d' % jobs,
+    ]
+
+    command = ' && '.join(script)
+
+    if deployer.lfs:
+        command = 'export GIT_LFS_SKIP_SMUDGE=1; ' + command
+
+    return command
@@ -32,23 +32,33 @@ This compresses the files to deploy and uploads them to the remote host.
 
 import datetime
 import os
-import scp
-import tarfile
+import shutil
+import stat
+import time
 
 from fumi import messages as m
+from fumi import profiling
 from fumi import util
+from fumi.transport import TransportError
 
+# ioctl that clones a file in copy-on-write filesystems (Linux)
+FICLONE = 0x40049409
 
-def deploy(deployer):
+
+def deploy(deployer, stage=False):
     """Local based deployment.
 
     Arguments:
         deployer (``Deployer``): Deployer instance.
+        stage (bool): Only upload and extract the revision, without linking it
+            to the ``current`` directory.
 
     Returns:
         Boolean indicating result of the deployment.
     """
     # SSH connection
+    deployer.timer.start('connect')
+
     util.cprint(
         '> ' + m.DEP_CONNECTING % (deployer.host, deployer.user),
         'cyan'
@@ -56,20 +66,23 @@ def deploy(deployer):
 
     status, ssh = util.connect(deployer)
     if not status:
-        ssh.close()
         return False
 
     util.cprint(m.DEP_CONNECTED + '\n', 'green')
 
 
     # Predeployment commands
-    status, util.run_commands(ssh, deployer.predep)
+    deployer.timer.start('predep')
+
+    status = util.run_commands(ssh, deployer.predep, timer=deployer.timer)
     if not status:
         ssh.close()
         return False
 
 
     # Directory structures
+    deployer.timer.start('check_dirs')
+
     util.cprint('> ' + m.DEP_CHECK_REMOTE, 'cyan')
 
     status = util.check_dirs(ssh, deployer)
@@ -80,143 +93,460 @@ def deploy(deployer):
     util.cprint(m.CORRECT + '\n', 'green')
 
 
-    # Compress source to temporary directory
-    timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
-    util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+    rev_path = os.path.join(deployer.deploy_path, 'rev')
 
-    compressed_file = timestamp + '.tar.gz'
-    tmp_local = os.path.join('/tmp', compressed_file)
+    if deployer.direct:
+        # Copy source straight to deploy_path/rev
+        deployer.timer.start('copy')
 
-    if deployer.local_ignore:
-        cnt_list = list(
-            set(os.listdir(deployer.source_path))^set(deployer.local_ignore))
+        if deployer.artifact:
+            # Same revision name as the rest of the hosts
+            timestamp = deployer.artifact[0]
+
+        else:
+            timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+        util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+
+        if not copy_source(ssh, deployer, rev_path, timestamp):
+            util.rollback(ssh, deployer, timestamp, 3)
+            ssh.close()
+            return False
 
     else:
-        cnt_list = os.listdir(deployer.source_path)
+        status, timestamp, tmp_local, uload_path = _transfer(
+            ssh, deployer, rev_path)
 
-    util.cprint('> ' + m.DEP_LOCAL_COMPRESS % tmp_local, 'cyan')
+        if not status:
+            ssh.close()
+            return False
 
-    with tarfile.open(tmp_local, "w:gz") as tar:
-        for item in cnt_list:
-            path = os.path.join(deployer.source_path, item)
 
-            if os.path.exists(path):
-                # Compress
-                tar.add(path, arcname=timestamp + '/' + item)
+    # Link shared paths inside the new revision
+    deployer.timer.start('link_shared')
 
-            else:
-                # Ignore
-                util.cprint(m.DEP_LOCAL_PATHNOEXIST % path, 'white')
+    status = util.symlink_shared(
+        ssh, deployer, os.path.join(rev_path, timestamp))
 
-    util.cprint(m.DONE + '\n', 'green')
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
+        ssh.close()
+        return False
 
 
-    # Upload compressed source
-    util.cprint('> ' + m.DEP_LOCAL_UPLOAD % compressed_file, 'cyan')
+    # Staged revisions are activated later on
+    if stage:
+        deployer.timer.start('record')
+        util.record_revision(ssh, deployer, timestamp, 'staged')
+
+        if deployer.metrics_file:
+            deployer.usage = util.revision_usage(ssh, deployer)
+
+        if not deployer.direct:
+            deployer.timer.start('clean_tmp')
+            _clean_temporary(ssh, deployer, tmp_local, uload_path)
+
+        util.cprint(m.DEP_STAGE_COMPLETE % timestamp, 'green')
+        deployer.revision = timestamp
 
-    try:
-        uload = scp.SCPClient(
-            ssh.get_transport(),
-            buff_size=deployer.buffer_size)
-
-    except:
-        # Failed to initiate SCP
-        util.cprint(m.DEP_LOCAL_SCPFAIL, 'red')
-        status = util.rollback(ssh, deployer, timestamp, 1)
+        ssh.close()
+        return True
+
+
+    # Link directory
+    deployer.timer.start('symlink')
+
+    status = util.symlink(ssh, deployer, rev_path, timestamp)
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 3)
         ssh.close()
         return False
 
-    uload_tmp = deployer.host_tmp or '/tmp'
-    uload_path = os.path.join(uload_tmp, compressed_file)
 
-    try:
-        uload.put(tmp_local, uload_path)
+    # Run post-deployment commands
+    deployer.timer.start('postdep')
 
-    except scp.SCPException as e:
-        util.cprint(m.DEP_LOCAL_UPLOADERR + '\n' % e, 'red')
-        status = util.rollback(ssh, deployer, timestamp, 3)
+    status = util.run_commands(
+        ssh,
+        deployer.postdep,
+        os.path.join(deployer.deploy_path, 'current'),
+        timer=deployer.timer)
+
+    if not status:
+        util.rollback(ssh, deployer, timestamp, 4)
         ssh.close()
         return False
 
+
+    # Record revision (and its size) in the revision log
+    deployer.timer.start('record')
+
+    util.record_revision(ssh, deployer, timestamp, 'ok')
+
+
+    # Clean revisions
+    if deployer.keep_max or deployer.keep_size or deployer.keep_days:
+        deployer.timer.start('clean_revisions')
+        status = util.clean_revisions(ssh, deployer)
+
+
+    # Disk usage for the metrics file
+    if deployer.metrics_file:
+        deployer.timer.start('usage')
+        deployer.usage = util.revision_usage(ssh, deployer)
+
+
+    # Cleanup temporary files
+    if not deployer.direct:
+        deployer.timer.start('clean_tmp')
+        _clean_temporary(ssh, deployer, tmp_local, uload_path)
+
+
+    util.cprint(m.DEP_COMPLETE, 'green')
+    deployer.revision = timestamp
+
+    # Close SSH connection
+    ssh.close()
+
+    return True
+
+def build_artifact(deployer, timestamp, tmp_dir='/tmp'):
+    """Compress the source to a temporary file.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        timestamp (str): Timestamp that identifies the revision.
+        tmp_dir (str): Local directory in which to create the file.
+
+    Returns:
+        Path to the compressed file.
+    """
+    import tarfile
+
+    tmp_local = os.path.join(tmp_dir, timestamp + '.tar.gz')
+    cnt_list = _source_items(deployer)
+
+    util.cprint('> ' + m.DEP_LOCAL_COMPRESS % tmp_local, 'cyan')
+
+    with profiling.trace_memory('compress'):
+        with tarfile.open(tmp_local, "w:gz") as tar:
+            for item in cnt_list:
+                path = os.path.join(deployer.source_path, item)
+
+                if os.path.exists(path):
+                    # Compress
+                    tar.add(path, arcname=timestamp + '/' + item)
+
+                else:
+                    # Ignore
+                    util.cprint(m.DEP_LOCAL_PATHNOEXIST % path, 'white')
+
     util.cprint(m.DONE + '\n', 'green')
 
+    return tmp_local
 
-    # Uncompress source to deploy_path/rev
-    util.cprint('> ' + m.DEP_LOCAL_UNCOMPRESS, 'cyan')
+def copy_source(ssh, deployer, rev_path, timestamp):
+    """Copy the source to a new revision in the local machine.
 
-    rev_path = os.path.join(deployer.deploy_path, 'rev')
-    untar = 'tar -C %s -zxvf %s' % (rev_path, uload_path)
+    Used when deploying to ``host: local``. Files are cloned (copy-on-write)
+    when the filesystem supports it or copied otherwise. With ``hard-links``,
+    files that did not change since the revision linked as ``current`` (same
+    mode, size and modification time) are hard linked to it instead.
 
-    stdin, stdout, stderr = ssh.exec_command(untar)
-    status = stdout.channel.recv_exit_status()
+    Hard linked files are shared with the previous revision, so commands that
+    modify files of the revision in place (instead of replacing them) also
+    modify the previous one.
 
-    if status == 127:
-        util.cprint(m.DEP_LOCAL_ERR127 + '\n', 'red')
+    Arguments:
+        ssh (``Transport``): Established connection to the local machine.
+        deployer (``Deployer``): Deployer instance.
+        rev_path (str): Path of the revisions directory.
+        timestamp (str): Timestamp that identifies the revision.
 
-        status = util.rollback(ssh, deployer, timestamp, 1)
-        ssh.close()
-        return False
+    Returns:
+        Boolean indicating result.
+    """
+    target = os.path.join(rev_path, timestamp)
+    current = os.path.join(deployer.deploy_path, 'current')
+    previous = None
 
-    elif status == 1:
-        util.cprint(m.DEP_LOCAL_ERR1 + '\n', 'red')
-        util.cprint(*stderr.readlines())
+    if deployer.hard_links and os.path.islink(current):
+        previous = os.path.realpath(current)
+    counts = [0, 0]
 
-        status = util.rollback(ssh, deployer, timestamp, 2)
-        ssh.close()
-        return False
+    util.cprint('> ' + m.DEP_LOCAL_COPY % target, 'cyan')
 
-    elif status == 2:
-        util.cprint(m.DEP_LOCAL_ERR2 + '\n', 'red')
-        util.cprint(*stderr.readlines())
+    try:
+        os.makedirs(target)
 
-        status = util.rollback(ssh, deployer, timestamp, 2)
-        ssh.close()
+        for item in _source_items(deployer):
+            path = os.path.join(deployer.source_path, item)
+
+            if os.path.lexists(path):
+                _copy(
+                    path,
+                    os.path.join(target, item),
+                    previous and os.path.join(previous, item),
+                    deployer.buffer_size,
+                    counts)
+
+            else:
+                # Ignore
+                util.cprint(m.DEP_LOCAL_PATHNOEXIST % path, 'white')
+
+    except (IOError, OSError) as e:
+        util.cprint((m.DEP_LOCAL_COPYERR % e) + '\n', 'red')
         return False
 
+    util.cprint(m.DEP_LOCAL_COPIED % tuple(counts), 'white')
     util.cprint(m.DONE + '\n', 'green')
 
+    return True
 
-    # Link directory
-    status = util.symlink(ssh, deployer, rev_path, timestamp)
-    if not status:
-        util.rollback(ssh, deployer, timestamp, 3)
-        ssh.close()
+def upload(ssh, deployer, local_path, remote_path):
+    """Upload a file to the remote host.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        local_path (str): Path of the local file.
+        remote_path (str): Destination path in the remote host.
+
+    Returns:
+        Boolean indicating result.
+    """
+    started = time.time()
+
+    try:
+        ssh.upload(local_path, remote_path, deployer.buffer_size)
+
+    except TransportError as e:
+        util.cprint((m.DEP_LOCAL_UPLOADERR % e) + '\n', 'red')
         return False
 
+    deployer.timer.transfer(
+        os.path.getsize(local_path), time.time() - started)
 
-    # Link shared paths
-    util.symlink_shared(ssh, deployer)
+    return True
 
+def _clone(src, dst, buffer_size):
+    """Copy the content of a file, as a copy-on-write clone if possible.
 
-    # Run post-deployment commands
-    status = util.run_commands(
-        ssh,
-        deployer.postdep,
-        os.path.join(deployer.deploy_path, 'current'))
+    Arguments:
+        src (str): Path of the file to copy.
+        dst (str): Path of the new file.
+        buffer_size (int): Buffer size (in bytes) when copying.
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                import fcntl
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
 
-    if not status:
-        util.rollback(ssh, deployer, timestamp, 3)
-        ssh.close()
+            except (ImportError, IOError, OSError):
+                # Not supported by the platform or the filesystem
+                pass
+
+            shutil.copyfileobj(fsrc, fdst, buffer_size)
+
+def _copy(src, dst, previous, buffer_size, counts):
+    """Recursively copy a path for ``copy_source()``.
+
+    Arguments:
+        src (str): Path in the source.
+        dst (str): Path in the new revision.
+        previous (str): Same path in the previous revision to hard link
+            unchanged files to, or ``None``.
+        buffer_size (int): Buffer size (in bytes) when copying.
+        counts (list[int]): Number of files copied and linked so far.
+    """
+    st = os.lstat(src)
+
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+
+    elif stat.S_ISDIR(st.st_mode):
+        os.mkdir(dst)
+
+        for name in os.listdir(src):
+            _copy(
+                os.path.join(src, name),
+                os.path.join(dst, name),
+                previous and os.path.join(previous, name),
+                buffer_size,
+                counts)
+
+        shutil.copystat(src, dst)
+
+    else:
+        if _unchanged(st, previous):
+            try:
+                # Shared with the previous revision (see ``hard-links``)
+                os.link(previous, dst)
+                counts[1] += 1
+                return
+
+            except OSError:
+                # Different filesystem
+                pass
+
+        _clone(src, dst, buffer_size)
+        shutil.copystat(src, dst)
+        counts[0] += 1
+
+def _source_items(deployer):
+    """Obtain the top level items of the source to deploy.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        List of names, without those in ``local_ignore``.
+    """
+    if deployer.local_ignore:
+        return list(
+            set(os.listdir(deployer.source_path))^set(deployer.local_ignore))
+
+    return os.listdir(deployer.source_path)
+
+def _mtime(st):
+    """Obtain the exact modification time of a file.
+
+    Arguments:
+        st: ``os.lstat()`` result of the file.
+
+    Returns:
+        Modification time in nanoseconds (or seconds in Python 2).
+    """
+    return getattr(st, 'st_mtime_ns', st.st_mtime)
+
+def _unchanged(st, previous):
+    """Check whether a file is the same as in the previous revision.
+
+    Arguments:
+        st: ``os.lstat()`` result of the source file.
+        previous (str): Path of the file in the previous revision, or
+            ``None``.
+
+    Returns:
+        Boolean indicating whether the file can be hard linked.
+    """
+    if not previous:
         return False
 
+    try:
+        prev = os.lstat(previous)
 
-    # Clean revisions
-    if deployer.keep_max:
-        status = util.clean_revisions(ssh, deployer.keep_max, rev_path)
+    except OSError:
+        return False
 
+    return (
+        stat.S_ISREG(prev.st_mode)
+        and stat.S_IMODE(prev.st_mode) == stat.S_IMODE(st.st_mode)
+        and prev.st_size == st.st_size
+        and _mtime(prev) == _mtime(st))
 
-    # Cleanup temporary files
+def _clean_temporary(ssh, deployer, tmp_local, uload_path):
+    """Remove the local and uploaded compressed files.
+
+    Compressed files shared by several hosts are removed once all of them
+    have been deployed to, so only the uploaded file is removed then.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        tmp_local (str): Path to the local compressed file.
+        uload_path (str): Path to the uploaded file in the remote host.
+    """
     util.cprint('> ' + m.DEP_LOCAL_CLEAN, 'cyan')
 
-    util.remove_local(tmp_local)
+    if not deployer.artifact:
+        util.remove_local(tmp_local)
+
     util.remove_remote(ssh, uload_path)
 
     util.cprint(m.DONE + '\n', 'green')
 
+def _transfer(ssh, deployer, rev_path):
+    """Compress the source, upload it and extract it in the remote host.
 
-    util.cprint(m.DEP_COMPLETE, 'green')
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        rev_path (str): Path of the revisions directory in the remote host.
 
-    # Close SSH connection
-    ssh.close()
+    Returns:
+        Boolean indicating result, timestamp of the revision, path to the
+        local compressed file and path to the uploaded file.
+    """
+    # Compress source to temporary directory
+    deployer.timer.start('compress')
 
-    return True
+    if deployer.artifact:
+        # Shared by several hosts
+        timestamp, tmp_local = deployer.artifact
+        util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+
+    else:
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+
+        tmp_local = build_artifact(deployer, timestamp)
+
+    deployer.artifact_size = os.path.getsize(tmp_local)
+
+    compressed_file = timestamp + '.tar.gz'
+    uload_tmp = deployer.host_tmp or '/tmp'
+    uload_path = os.path.join(uload_tmp, compressed_file)
+
+
+    # Upload compressed source
+    deployer.timer.start('upload')
+
+    if deployer.artifact_uploaded:
+        # Already distributed to the host
+        util.cprint(m.DEP_LOCAL_UPLOADED % uload_path, 'white')
+
+    else:
+        util.cprint('> ' + m.DEP_LOCAL_UPLOAD % compressed_file, 'cyan')
+
+        if not upload(ssh, deployer, tmp_local, uload_path):
+            util.rollback(ssh, deployer, timestamp, 2)
+            return False, timestamp, tmp_local, uload_path
+
+        util.cprint(m.DONE + '\n', 'green')
+
+
+    # Uncompress source to deploy_path/rev
+    deployer.timer.start('extract')
+
+    util.cprint('> ' + m.DEP_LOCAL_UNCOMPRESS, 'cyan')
+
+    untar = 'tar -C %s -zxf %s' % (rev_path, uload_path)
+
+    status, stdout, stderr = ssh.run(untar)
+
+    if status == 127:
+        util.cprint(m.DEP_LOCAL_ERR127 + '\n', 'red')
+
+        util.rollback(ssh, deployer, timestamp, 1)
+        return False, timestamp, tmp_local, uload_path
+
+    elif status == 1:
+        util.cprint(m.DEP_LOCAL_ERR1 + '\n', 'red')
+        util.cprint(stderr)
+
+        util.rollback(ssh, deployer, timestamp, 2)
+        return False, timestamp, tmp_local, uload_path
+
+    elif status == 2:
+        util.cprint(m.DEP_LOCAL_ERR2 + '\n', 'red')
+        util.cprint(stderr)
+
+        util.rollback(ssh, deployer, timestamp, 2)
+        return False, timestamp, tmp_local, uload_path
+
+    util.cprint(m.DONE + '\n', 'green')
+
+    return True, timestamp, tmp_local, uload_path
@@ -52,7 +52,6 @@ def prepare(deployer):
 
     status, ssh = util.connect(deployer)
     if not status:
-        ssh.close()
         return False
 
     util.cprint(m.DEP_CONNECTED + '\n', 'green')
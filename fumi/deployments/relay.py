@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Host to host distribution of compressed sources.
+
+In multi-host ``local`` deployments with ``relay`` enabled, the compressed
+source is uploaded once per group of hosts. Hosts that already have it then
+forward it to their peers over the internal network, verifying the checksum
+on each hop.
+"""
+
+import datetime
+import hashlib
+import os
+import tempfile
+
+from fumi import fleet
+from fumi import messages as m
+from fumi import util
+from fumi.deployments.local import build_artifact, upload
+
+
+def checksum(path):
+    """Compute the SHA-256 checksum of a local file.
+
+    Arguments:
+        path (str): Path to the file.
+
+    Returns:
+        Hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def distribute(deployers, timestamp, local_path):
+    """Distribute a compressed source to the hosts of a deployment.
+
+    Hosts are grouped by their ``relay-group`` tag. The file is uploaded from
+    the local machine to the first host of each group and, in each following
+    round, every host that has the file forwards it to another host of its
+    group, so the number of copies doubles each round. Hosts to which the
+    file could not be forwarded get it directly from the local machine.
+
+    Hosts that end up with the file are marked with ``artifact_uploaded``.
+
+    Arguments:
+        deployers (list[``Deployer``]): Deployers (one per host).
+        timestamp (str): Timestamp that identifies the revision.
+        local_path (str): Path to the local compressed file.
+    """
+    digest = checksum(local_path)
+    groups = {}
+    order = []
+
+    for deployer in deployers:
+        group = deployer.tags.get(deployer.relay_group)
+
+        if group not in groups:
+            groups[group] = []
+            order.append(group)
+
+        groups[group].append(deployer)
+
+    util.cprint(
+        '> ' + m.RELAY_DISTRIBUTE % (len(deployers), len(groups)), 'cyan')
+
+    direct = lambda d: seed(d, timestamp, local_path, digest)
+
+    # First host of each group, from the local machine
+    seeded = {}
+    pending = {}
+    first = [groups[g][0] for g in order]
+
+    for group, deployer, result in zip(
+            order, first, fleet.run_batch(
+                first, direct, deployers[0].max_parallel)):
+        seeded[group] = [deployer] if result else []
+        pending[group] = groups[group][1:]
+
+        if not result:
+            # Remaining hosts upload the file themselves
+            pending[group] = []
+
+    # Each host with the file forwards it to a peer
+    while any(pending.values()):
+        sources = {}
+        targets = []
+
+        for group in order:
+            for source in list(seeded[group]):
+                if not pending[group]:
+                    break
+
+                target = pending[group].pop(0)
+                sources[id(target)] = (group, source)
+                targets.append(target)
+
+        hop = lambda d: (
+            forward(sources[id(d)][1], d, timestamp, digest)
+            or direct(d))
+
+        for target, result in zip(
+                targets,
+                fleet.run_batch(targets, hop, deployers[0].max_parallel)):
+            if result:
+                seeded[sources[id(target)][0]].append(target)
+
+    for group in order:
+        for deployer in seeded[group]:
+            deployer.artifact_uploaded = True
+
+    util.cprint(m.DONE + '\n', 'green')
+
+def forward(source, target, timestamp, digest):
+    """Make a host forward the compressed source to one of its peers.
+
+    The source host copies the file with ``scp`` (so it needs SSH access to
+    the target host) and checks the checksum of the copy.
+
+    Arguments:
+        source (``Deployer``): Deployer of the host that has the file.
+        target (``Deployer``): Deployer of the host to send the file to.
+        timestamp (str): Timestamp that identifies the revision.
+        digest (str): Expected SHA-256 checksum.
+
+    Returns:
+        Boolean indicating result.
+    """
+    src_path = remote_path(source, timestamp)
+    dst_path = remote_path(target, timestamp)
+    dest = '%s@%s' % (target.user, target.host)
+
+    util.cprint(m.RELAY_FORWARD % (source.host, target.host), 'magenta')
+    target.timer.start('relay')
+
+    status, ssh = util.connect(source)
+    if not status:
+        return False
+
+    options = '-o BatchMode=yes -o ConnectTimeout=%d' % max(
+        1, int(target.connect_timeout))
+
+    copy = 'scp -q %s %s %s:%s && ssh %s %s sha256sum %s' % (
+        options, src_path, dest, dst_path, options, dest, dst_path)
+
+    status, output, stderr = ssh.run(copy)
+
+    ssh.close()
+
+    if status != 0 or not output.startswith(digest):
+        util.cprint(m.RELAY_FORWARD_ERR % target.host, 'red')
+        return False
+
+    return True
+
+def remote_path(deployer, timestamp):
+    """Obtain the path of the compressed source in a remote host.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        timestamp (str): Timestamp that identifies the revision.
+
+    Returns:
+        Path in the remote host.
+    """
+    return os.path.join(deployer.host_tmp or '/tmp', timestamp + '.tar.gz')
+
+def share(deployers):
+    """Compress the source once for all the hosts of a deployment.
+
+    Only applies to ``local`` deployments with more than one host. The
+    compressed file is distributed beforehand when ``relay`` is enabled (and
+    the hosts are reached through SSH).
+
+    Arguments:
+        deployers (list[``Deployer``]): Deployers (one per host).
+
+    Returns:
+        Local temporary directory containing the compressed file (to be
+        removed after deploying) or ``None``.
+    """
+    settings = deployers[0]
+
+    if len(deployers) == 1 or settings.source_type != 'local':
+        return None
+
+    if all(d.direct for d in deployers):
+        # Copied straight from the source
+        return None
+
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    tmp_dir = tempfile.mkdtemp(prefix='fumi-')
+
+    util.cprint(m.DEP_PREPARE_REV % timestamp, 'white')
+
+    settings.timer.start('compress')
+    local_path = build_artifact(settings, timestamp, tmp_dir)
+    settings.timer.stop()
+
+    for deployer in deployers:
+        deployer.artifact = (timestamp, local_path)
+
+    if settings.relay and settings.transport == 'ssh':
+        distribute(deployers, timestamp, local_path)
+
+    return tmp_dir
+
+def seed(deployer, timestamp, local_path, digest):
+    """Upload the compressed source directly from the local machine.
+
+    Arguments:
+        deployer (``Deployer``): Deployer of the host to upload to.
+        timestamp (str): Timestamp that identifies the revision.
+        local_path (str): Path to the local compressed file.
+        digest (str): Expected SHA-256 checksum.
+
+    Returns:
+        Boolean indicating result.
+    """
+    util.cprint(m.RELAY_SEED % deployer.host, 'magenta')
+    deployer.timer.start('relay')
+
+    status, ssh = util.connect(deployer)
+    if not status:
+        return False
+
+    path = remote_path(deployer, timestamp)
+
+    if not upload(ssh, deployer, local_path, path):
+        ssh.close()
+        return False
+
+    status, output, stderr = ssh.run('sha256sum %s' % path)
+
+    ssh.close()
+
+    if not output.startswith(digest):
+        util.cprint(m.RELAY_FORWARD_ERR % deployer.host, 'red')
+        return False
+
+    return True
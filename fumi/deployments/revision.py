@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Implementation of the revision management operations.
+
+These act on revisions that already exist in the remote host: listing them and
+switching the ``current`` link between them without deploying anything.
+"""
+
+import os
+
+from fumi import messages as m
+from fumi import util
+
+
+def activate(deployer, revision=None, postdep=True):
+    """Link an existing revision to the ``current`` directory.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        revision (str): Revision to activate. Defaults to the most recent one.
+        postdep (bool): Whether or not to run the post-deployment commands
+            after switching.
+
+    Returns:
+        Boolean indicating result of the activation.
+    """
+    return _switch(deployer, revision, False, postdep and deployer.postdep)
+
+def revisions(deployer):
+    """List the revisions available in the remote host.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        Boolean indicating result of the listing.
+    """
+    # SSH connection
+    util.cprint(
+        '> ' + m.DEP_CONNECTING % (deployer.host, deployer.user),
+        'cyan'
+    )
+
+    status, ssh = util.connect(deployer)
+    if not status:
+        return False
+
+    util.cprint(m.DEP_CONNECTED + '\n', 'green')
+
+
+    status, revs, current = util.list_revisions(ssh, deployer)
+    ssh.close()
+
+    if not status:
+        return False
+
+    if not revs:
+        util.cprint(m.REV_NONE, 'white')
+
+    for r in revs:
+        if r == current:
+            util.cprint(m.REV_CURRENT % r, 'green')
+
+        else:
+            util.cprint('- %s' % r)
+
+    return True
+
+def rollback(deployer, revision=None, postdep=True):
+    """Link a previous revision to the ``current`` directory.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        revision (str): Revision to roll back to. Defaults to the one
+            previous to the current revision.
+        postdep (bool): Whether or not to run the ``rollback-postdep``
+            commands after switching.
+
+    Returns:
+        Boolean indicating result of the rollback.
+    """
+    return _switch(
+        deployer, revision, not revision,
+        postdep and deployer.rollback_postdep)
+
+def _switch(deployer, revision, previous, commands):
+    """Connect to the remote host and switch the active revision.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        revision (str): Revision to activate.
+        previous (bool): Activate the revision previous to the current one.
+        commands (list): Post-deployment commands to run after switching.
+
+    Returns:
+        Boolean indicating result.
+    """
+    # SSH connection
+    util.cprint(
+        '> ' + m.DEP_CONNECTING % (deployer.host, deployer.user),
+        'cyan'
+    )
+
+    status, ssh = util.connect(deployer)
+    if not status:
+        return False
+
+    util.cprint(m.DEP_CONNECTED + '\n', 'green')
+
+
+    # Link directory (single remote command)
+    status = util.activate_revision(ssh, deployer, revision, previous)[0]
+
+    if not status:
+        ssh.close()
+        return False
+
+
+    # Run post-deployment commands
+    status = util.run_commands(
+        ssh,
+        commands,
+        os.path.join(deployer.deploy_path, 'current'))
+
+    ssh.close()
+
+    return status
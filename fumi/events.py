@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Machine readable event stream.
+
+When running with ``--output jsonl``, every phase, command, transfer and error
+is written to the standard output as a JSON object per line, while the human
+readable messages are written to the standard error. Events are written by a
+separate thread so that the deployment never waits for the output.
+
+Every event has the following fields:
+
+- ``time``: UNIX timestamp (float)
+- ``event``: type of event
+- ``host``: host the event refers to, or ``null``
+"""
+
+import json
+import sys
+import threading
+import time
+
+from six.moves import queue
+
+# Queue of pending events, ``None`` while the stream is disabled
+_QUEUE = None
+_WRITER = None
+
+# Host the current thread is working on
+_LABEL = threading.local()
+
+
+def enabled():
+    """Check whether the event stream is enabled.
+
+    Returns:
+        Boolean.
+    """
+    return _QUEUE is not None
+
+def emit(event, host=None, **fields):
+    """Queue an event for writing.
+
+    Does nothing if the event stream is not enabled.
+
+    Arguments:
+        event (str): Type of event.
+        host (str): Host the event refers to (by default, the one set for the
+            current thread with ``set_label()``).
+        **fields: Additional fields of the event.
+    """
+    if _QUEUE is None:
+        return
+
+    fields.update(
+        time=time.time(),
+        event=event,
+        host=host or getattr(_LABEL, 'host', None))
+    _QUEUE.put(fields)
+
+def set_label(host):
+    """Set the host that the events of the current thread refer to.
+
+    Arguments:
+        host (str): Host or ``None`` to remove it.
+    """
+    _LABEL.host = host
+
+def start(stream=None):
+    """Enable the event stream.
+
+    Arguments:
+        stream: File object to write the events to (standard output by
+            default).
+    """
+    global _QUEUE, _WRITER
+
+    if _QUEUE is not None:
+        return
+
+    _QUEUE = queue.Queue()
+    _WRITER = threading.Thread(
+        target=_write, args=(_QUEUE, stream or sys.stdout))
+    _WRITER.daemon = True
+    _WRITER.start()
+
+def stop():
+    """Write the pending events and disable the event stream."""
+    global _QUEUE, _WRITER
+
+    if _QUEUE is None:
+        return
+
+    _QUEUE.put(None)
+    _WRITER.join()
+
+    _QUEUE = None
+    _WRITER = None
+
+def _write(events, stream):
+    """Write events until ``None`` is received.
+
+    The stream is flushed whenever there are no more pending events.
+
+    Arguments:
+        events (``queue.Queue``): Queue of events.
+        stream: File object to write the events to.
+    """
+    while True:
+        event = events.get()
+
+        if event is None:
+            stream.flush()
+            return
+
+        stream.write(json.dumps(event, sort_keys=True) + '\n')
+
+        if events.empty():
+            stream.flush()
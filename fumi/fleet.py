@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Execution of operations over several hosts.
+
+Configurations that select hosts from the inventory produce one ``Deployer``
+per host. The functions in this module run the same operation for each of
+them, in batches of hosts that are processed concurrently (rolling
+deployments), and report the result.
+"""
+
+import threading
+import time
+
+from six.moves import queue
+
+from fumi import events
+from fumi import messages as m
+from fumi import profiling
+from fumi import util
+
+
+def revert(deployer):
+    """Roll back the revision deployed by a deployer.
+
+    This links again the revision that was current before the deployment
+    and removes the deployed one (rollback level 4).
+
+    Arguments:
+        deployer (``Deployer``): Deployer that completed a deployment.
+
+    Returns:
+        Boolean indicating result.
+    """
+    if not deployer.revision:
+        return True
+
+    status, ssh = util.connect(deployer)
+    if not status:
+        return False
+
+    status = util.rollback(
+        ssh, deployer, deployer.revision, 4, deployer.previous_revision)
+    ssh.close()
+
+    return status
+
+def run(deployers, action, undo=None):
+    """Run an operation for every deployer.
+
+    Hosts are processed in batches of ``batch-size`` hosts (taken from the
+    first deployer), waiting ``batch-pause`` seconds between batches. If the
+    ratio of failed hosts exceeds ``max-fail``, the remaining batches are
+    skipped and ``undo`` is called for the hosts that completed the
+    operation.
+
+    Arguments:
+        deployers (list[``Deployer``]): Deployers (one per host).
+        action: Callable that receives a ``Deployer`` and returns a boolean
+            indicating the result of the operation.
+        undo: Callable used to revert the operation in a host on abort.
+
+    Returns:
+        Boolean indicating whether the operation succeeded in all the hosts.
+    """
+    if len(deployers) == 1:
+        events.set_label(deployers[0].host)
+
+        try:
+            status = action(deployers[0])
+
+        finally:
+            deployers[0].timer.stop()
+            events.set_label(None)
+
+        _emit_result(deployers[0], status)
+
+        return status
+
+    settings = deployers[0]
+    size = batch_size(settings.batch_size, len(deployers))
+    batches = [
+        deployers[i:i + size] for i in range(0, len(deployers), size)]
+
+    succeeded = []
+    failed = []
+    reverted = []
+
+    for num, batch in enumerate(batches):
+        if num > 0 and settings.batch_pause:
+            util.cprint('\n' + m.FLEET_PAUSE % settings.batch_pause, 'white')
+            time.sleep(settings.batch_pause)
+
+        if len(batches) > 1:
+            util.cprint(
+                '\n' + m.FLEET_BATCH % (num + 1, len(batches)), 'white')
+
+        for deployer, result in zip(
+                batch, run_batch(batch, action, settings.max_parallel)):
+            _emit_result(deployer, result)
+
+            if result:
+                succeeded.append(deployer)
+
+            else:
+                failed.append(deployer.host)
+
+        processed = len(succeeded) + len(failed)
+
+        if (settings.max_fail is not None
+                and float(len(failed)) / processed > settings.max_fail):
+            # Too many failures
+            util.cprint('\n' + m.FLEET_ABORT % len(failed), 'red')
+
+            if undo and succeeded:
+                util.cprint(m.FLEET_REVERT, 'cyan')
+                for deployer, result in zip(
+                        succeeded,
+                        run_batch(succeeded, undo, settings.max_parallel)):
+                    events.emit('host_reverted', deployer.host, ok=result)
+
+                reverted = [d.host for d in succeeded]
+                succeeded = []
+
+            break
+
+    summary(deployers, len(succeeded), failed, reverted)
+
+    return not failed and len(succeeded) == len(deployers)
+
+def run_batch(batch, action, max_parallel=None):
+    """Run an operation for a batch of deployers concurrently.
+
+    This is the building block of ``run()``, also used by other modules that
+    need to do something in several hosts at once (see ``relay``). The output
+    of each host is prefixed with its name and unexpected errors are
+    considered failures.
+
+    Arguments:
+        batch (list[``Deployer``]): Deployers in the batch.
+        action: Callable that receives a ``Deployer`` and returns a boolean.
+        max_parallel (int): Maximum number of hosts processed at the same
+            time (all of them by default).
+
+    Returns:
+        List of results, in the same order as the batch.
+    """
+    results = [False] * len(batch)
+
+    if len(batch) == 1:
+        util.cprint('\n' + m.FLEET_HOST % batch[0].host, 'white')
+
+        events.set_label(batch[0].host)
+        results[0] = _call(action, batch[0])
+        events.set_label(None)
+
+        return results
+
+    pending = queue.Queue()
+    for index, deployer in enumerate(batch):
+        pending.put((index, deployer))
+
+    def worker():
+        while True:
+            try:
+                index, deployer = pending.get_nowait()
+
+            except queue.Empty:
+                return
+
+            util.set_label(deployer.host)
+            events.set_label(deployer.host)
+            results[index] = _call(action, deployer)
+            util.set_label(None)
+            events.set_label(None)
+
+    workers = min(len(batch), max(1, max_parallel or len(batch)))
+    threads = [
+        threading.Thread(target=profiling.profile_thread(worker))
+        for i in range(workers)]
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    return results
+
+def batch_size(size, total):
+    """Obtain the number of hosts per batch.
+
+    Arguments:
+        size (int or str): Number of hosts or percentage string (``'25%'``).
+        total (int): Total number of hosts.
+
+    Returns:
+        Integer number of hosts, at least 1.
+    """
+    size = str(size or 1).strip()
+
+    if size.endswith('%'):
+        return max(1, int(total * float(size[:-1]) / 100))
+
+    return max(1, int(size))
+
+def summary(deployers, done, failed, reverted=None):
+    """Print the result of a multi-host operation.
+
+    Arguments:
+        deployers (list[``Deployer``]): Deployers (one per host).
+        done (int): Number of hosts in which the operation succeeded.
+        failed (list[str]): Hosts in which the operation failed.
+        reverted (list[str]): Hosts that were rolled back after aborting.
+    """
+    util.cprint(
+        '\n' + m.FLEET_DONE % (done, len(deployers)),
+        'green' if done == len(deployers) else 'red')
+
+    if failed:
+        util.cprint(m.FLEET_FAILED % ', '.join(failed), 'red')
+
+    if reverted:
+        util.cprint(m.FLEET_REVERTED % ', '.join(reverted), 'magenta')
+
+def _call(action, deployer):
+    """Call an operation, considering unexpected errors as failures.
+
+    Arguments:
+        action: Callable that receives a ``Deployer`` and returns a boolean.
+        deployer (``Deployer``): Deployer to use.
+
+    Returns:
+        Boolean result of the operation.
+    """
+    try:
+        return action(deployer)
+
+    except Exception as e:
+        util.cprint(m.UNEXPECTED_ERR % e, 'red')
+        return False
+
+    finally:
+        # Phases are not timed between operations
+        deployer.timer.stop()
+
+def _emit_result(deployer, result):
+    """Emit the result of an operation in a host to the event stream.
+
+    Arguments:
+        deployer (``Deployer``): Deployer of the host.
+        result (bool): Result of the operation.
+    """
+    events.emit(
+        'host_result',
+        deployer.host,
+        ok=bool(result),
+        revision=deployer.revision,
+        seconds=deployer.timer.duration())
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Local history of deployments.
+
+Every ``deploy`` and ``stage`` run is recorded in a SQLite database (in
+``~/.local/share/fumi``) along with the duration of each phase in each host,
+so that the ``history`` command can show trends and detect phases that
+became slower. The number of revisions kept in each host and their disk usage
+are recorded too when a metrics file is configured (see ``fumi.metrics``).
+"""
+
+import contextlib
+import os
+import time
+
+from fumi import messages as m
+from fumi import util
+
+HISTORY_DB = os.path.join(
+    os.environ.get('XDG_DATA_HOME')
+    or os.path.join(os.path.expanduser('~'), '.local', 'share'),
+    'fumi',
+    'history.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    config TEXT NOT NULL,
+    action TEXT NOT NULL,
+    hosts INTEGER NOT NULL,
+    revision TEXT,
+    artifact_size INTEGER,
+    seconds REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    host TEXT NOT NULL,
+    revision TEXT,
+    transferred INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    host TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    host TEXT NOT NULL,
+    revisions INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (config, started);
+CREATE INDEX IF NOT EXISTS phases_run ON phases (run_id);
+"""
+
+# Phases shorter than this (in seconds) are never reported as regressions
+MIN_REGRESSION = 0.5
+
+
+def connect(path=None):
+    """Open the history database, creating it if needed.
+
+    Arguments:
+        path (str): Path to the database (``HISTORY_DB`` by default).
+
+    Returns:
+        ``sqlite3.Connection`` instance.
+    """
+    import sqlite3
+
+    path = path or HISTORY_DB
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+
+    return db
+
+def median(values):
+    """Obtain the median of a list of numbers.
+
+    Arguments:
+        values (list[float]): Numbers (at least one).
+
+    Returns:
+        Median value.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def record(name, action, deployers, ok, started, path=None):
+    """Record a run in the history database.
+
+    Errors are reported but never interrupt the program.
+
+    Arguments:
+        name (str): Name of the configuration.
+        action (str): Action that was run (``deploy`` or ``stage``).
+        deployers (list[``Deployer``]): Deployers (one per host).
+        ok (bool): Whether the run succeeded in every host.
+        started (float): UNIX timestamp of the start of the run.
+        path (str): Path to the database (``HISTORY_DB`` by default).
+
+    Returns:
+        Boolean indicating result.
+    """
+    import sqlite3
+
+    revisions = [d.revision for d in deployers if d.revision]
+    artifact_size = max(d.artifact_size or 0 for d in deployers) or None
+
+    try:
+        with contextlib.closing(connect(path)) as db:
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO runs (started, config, action, hosts,'
+                    ' revision, artifact_size, seconds, ok)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (started, name, action, len(deployers),
+                     revisions[0] if revisions else None, artifact_size,
+                     time.time() - started, int(bool(ok))))
+
+                run_id = cursor.lastrowid
+
+                for d in deployers:
+                    db.execute(
+                        'INSERT INTO hosts (run_id, host, revision,'
+                        ' transferred, seconds, ok)'
+                        ' VALUES (?, ?, ?, ?, ?, ?)',
+                        (run_id, d.host, d.revision, d.timer.transferred,
+                         d.timer.duration(), int(d.revision is not None)))
+
+                    db.executemany(
+                        'INSERT INTO phases (run_id, host, phase, seconds)'
+                        ' VALUES (?, ?, ?, ?)',
+                        [(run_id, d.host, p, s) for p, s in d.timer.phases])
+
+                    if d.usage:
+                        db.execute(
+                            'INSERT INTO usage (run_id, host, revisions, size)'
+                            ' VALUES (?, ?, ?, ?)', (run_id, d.host) + d.usage)
+
+    except (sqlite3.Error, OSError) as e:
+        util.cprint(m.HIST_WRITE_ERR % e, 'red')
+        return False
+
+    return True
+
+def regressions(db, name, threshold, window=10):
+    """Detect phases of the latest run that became slower.
+
+    The duration of a phase in a run is that of the slowest host. Each phase
+    of the latest successful run is compared with the median of the previous
+    ``window`` successful runs of the same configuration and action. The size
+    of the compressed source is compared the same way.
+
+    Arguments:
+        db (``sqlite3.Connection``): History database.
+        name (str): Name of the configuration.
+        threshold (float): Allowed increase over the median (e.g. ``0.25``
+            for 25%).
+        window (int): Number of previous runs to compare with.
+
+    Returns:
+        List of ``(metric, latest, median)`` tuples, where ``metric`` is the
+        name of the phase or ``None`` for the size of the compressed source.
+    """
+    runs = db.execute(
+        'SELECT id, action, artifact_size FROM runs'
+        ' WHERE config = ? AND ok = 1 ORDER BY started DESC, id DESC',
+        (name,)).fetchall()
+
+    if not runs:
+        return []
+
+    latest, action, latest_size = runs[0]
+    previous = [r for r in runs[1:] if r[1] == action][:window]
+
+    if not previous:
+        return []
+
+    found = []
+
+    # Phases
+    durations = {}
+
+    for run_id, _, _ in [runs[0]] + previous:
+        rows = db.execute(
+            'SELECT phase, MAX(seconds) FROM phases WHERE run_id = ?'
+            ' GROUP BY phase', (run_id,))
+
+        for phase, seconds in rows:
+            durations.setdefault(phase, {})[run_id] = seconds
+
+    for phase, by_run in sorted(durations.items()):
+        if latest not in by_run:
+            continue
+
+        history = [by_run[r[0]] for r in previous if r[0] in by_run]
+        if not history:
+            continue
+
+        usual = median(history)
+        current = by_run[latest]
+
+        if (current > usual * (1 + threshold)
+                and current - usual >= MIN_REGRESSION):
+            found.append((phase, current, usual))
+
+    # Size of the compressed source
+    sizes = [r[2] for r in previous if r[2]]
+
+    if latest_size and sizes:
+        usual = median(sizes)
+
+        if latest_size > usual * (1 + threshold):
+            found.append((None, latest_size, usual))
+
+    return found
+
+def show(name=None, limit=20, threshold=0.25, path=None):
+    """Print the latest runs and the detected regressions.
+
+    Arguments:
+        name (str): Name of the configuration, or ``None`` for all of them.
+        limit (int): Maximum number of runs to show.
+        threshold (float): Allowed increase over the median before a phase
+            is reported as a regression.
+        path (str): Path to the database (``HISTORY_DB`` by default).
+
+    Returns:
+        Boolean indicating whether no regressions were detected.
+    """
+    import datetime
+    import sqlite3
+
+    from fumi.timing import format_size
+
+    try:
+        with contextlib.closing(connect(path)) as db:
+            query = (
+                'SELECT id, started, config, action, hosts, revision,'
+                ' artifact_size, seconds, ok FROM runs')
+            params = ()
+
+            if name:
+                query += ' WHERE config = ?'
+                params = (name,)
+
+            rows = db.execute(
+                query + ' ORDER BY started DESC, id DESC LIMIT ?',
+                params + (limit,)).fetchall()
+
+            names = [name] if name else sorted(set(r[2] for r in rows))
+            found = dict((n, regressions(db, n, threshold)) for n in names)
+
+    except (sqlite3.Error, OSError) as e:
+        util.cprint(m.HIST_READ_ERR % e, 'red')
+        return False
+
+    if not rows:
+        util.cprint(m.HIST_EMPTY)
+        return True
+
+    for _, started, config, action, hosts, revision, size, seconds, ok in (
+            reversed(rows)):
+        util.cprint('%s  %-12s %-7s %3d  %-14s %10s %9.2fs  %s' % (
+            datetime.datetime.fromtimestamp(started).strftime(
+                '%Y-%m-%d %H:%M'),
+            config,
+            action,
+            hosts,
+            revision or '-',
+            format_size(size) if size else '-',
+            seconds,
+            m.HIST_OK if ok else m.HIST_FAILED),
+            'normal' if ok else 'red')
+
+    for config in names:
+        for metric, current, usual in found[config]:
+            if metric is None:
+                util.cprint(m.HIST_SIZE_REGRESSION % (
+                    config, format_size(current), format_size(usual)), 'red')
+
+            else:
+                util.cprint(m.HIST_REGRESSION % (
+                    config, metric, current, usual), 'red')
+
+    return not any(found.values())
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Host inventory and selector queries.
+
+The ``inventory`` section of the deployment file lists hosts along with their
+tags::
+
+    inventory:
+        web1.example.com:
+            role: api
+            region: eu
+        web2.example.com:
+            role: api
+            region: us
+            canary: true
+
+Hosts are chosen with selectors, which are comma separated conditions that
+must all be met. Each condition has the form ``tag=value`` (several values
+may be given separated by ``|``) or ``tag!=value``.
+"""
+
+from fumi import messages as m
+
+
+class Inventory(object):
+    """Hosts and tags, indexed for fast selection.
+
+    Attributes:
+        hosts (list[str]): Host names, in file order.
+        tags (dict): Tags of each host.
+        index (dict): Sets of hosts indexed by ``(tag, value)`` pairs. Values
+            are stored as lowercase strings.
+    """
+
+    def __init__(self, section=None):
+        self.hosts = []
+        self.tags = {}
+        self.index = {}
+
+        for host, tags in (section or {}).items():
+            tags = tags or {}
+
+            if not isinstance(tags, dict):
+                raise ValueError(m.INV_BAD_HOST % host)
+
+            self.hosts.append(host)
+            self.tags[host] = tags
+
+            for k, v in tags.items():
+                self.index.setdefault((k, _value(v)), set()).add(host)
+
+    def select(self, selector):
+        """Obtain the hosts that match a selector.
+
+        Arguments:
+            selector (str): Selector query (e.g. ``region=eu,role=api|web``).
+
+        Returns:
+            List of host names, in file order.
+
+        Raises:
+            ValueError: if the selector is not valid.
+        """
+        selected = None
+        excluded = set()
+
+        for condition in selector.split(','):
+            condition = condition.strip()
+
+            if '!=' in condition:
+                tag, values = condition.split('!=', 1)
+                negate = True
+
+            elif '=' in condition:
+                tag, values = condition.split('=', 1)
+                negate = False
+
+            else:
+                raise ValueError(m.INV_BAD_SELECTOR % condition)
+
+            matches = set()
+            for v in values.split('|'):
+                matches |= self.index.get((tag.strip(), _value(v)), set())
+
+            if negate:
+                excluded |= matches
+
+            elif selected is None:
+                selected = matches
+
+            else:
+                selected &= matches
+
+        if selected is None:
+            # Only negative conditions
+            selected = set(self.hosts)
+
+        selected -= excluded
+
+        return [h for h in self.hosts if h in selected]
+
+def _value(value):
+    """Normalize a tag value for the index.
+
+    Arguments:
+        value: Value as read from the YAML file or the selector.
+
+    Returns:
+        Lowercase string.
+    """
+    return str(value).strip().lower()
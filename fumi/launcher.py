@@ -33,11 +33,12 @@ This parses the command line arguments and performs the different operations.
 __version__ = '0.4.0'
 
 # Set locale
-from pkg_resources import resource_filename
-import six
 import gettext
+import os
+import six
 
-_locale_dir = resource_filename(__name__, 'locale')
+_locale_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'locale')
 if six.PY3:
     gettext.install('fumi', _locale_dir)
 else:
@@ -45,18 +46,41 @@ else:
 
 
 import argparse
-import os
 import sys
+import time
 
+from fumi import config
+from fumi import events
+from fumi import fleet
+from fumi import history
 from fumi import messages as m
+from fumi import metrics
+from fumi import profiling
+from fumi import timing
 from fumi import util
 from fumi.deployer import build_deployer
+from fumi.deployments import relay
 
 
 FUMI_YML = os.path.join(os.getcwd(), 'fumi.yml')
 
 
-def deploy(conf_name, prepare=False):
+def activate(conf_name, revision=None, postdep=True, select=None):
+    """Activate an existing remote revision.
+
+    Arguments:
+        conf_name (str): Name of the configuration to use.
+        revision (str): Revision to activate (latest by default).
+        postdep (bool): Whether or not to run post-deployment commands.
+        select (str): Inventory selector for the hosts to use.
+    """
+    deployers = get_deployers(conf_name, select)
+
+    if not fleet.run(deployers, lambda d: d.activate(revision, postdep)):
+        sys.exit(-1)
+
+
+def deploy(conf_name, prepare=False, stage=False, select=None):
     """Deploy using given configuration.
 
     Arguments:
@@ -64,44 +88,97 @@ def deploy(conf_name, prepare=False):
         prepare (bool): Whether or not this is a preparation deployment.
             A preparation simply checks connection and creates the remote
             directory tree.
+        stage (bool): Whether or not to only stage the new revision, leaving
+            its activation for later.
+        select (str): Inventory selector for the hosts to deploy to.
     """
-    status, content = util.read_yaml(FUMI_YML)
+    deployers = get_deployers(conf_name, select)
+    started = time.time()
+    undo = None
+    shared = None
+
+    if not prepare:
+        # Compress (and distribute) the source once for all the hosts
+        shared = relay.share(deployers)
+
+    if prepare:
+        # Preparation
+        action = lambda d: d.prepare()
+
+    elif stage:
+        # Upload without activating
+        action = lambda d: d.deploy(stage=True)
+
+    else:
+        # Deploy!
+        action = lambda d: d.deploy()
+        undo = fleet.revert
+
+    status = fleet.run(deployers, action, undo)
+
+    if shared:
+        util.remove_local(shared)
+
+    if not prepare:
+        timing.report(deployers)
+
+        history.record(
+            deployers[0].name,
+            'stage' if stage else 'deploy',
+            deployers,
+            status,
+            started)
+
+        if deployers[0].metrics_file:
+            metrics.write(deployers[0].metrics_file)
 
     if not status:
         sys.exit(-1)
 
-    if not content:
-        util.cprint(m.NO_YML, 'red')
-        sys.exit(-1)
+
+def get_deployers(conf_name, select=None):
+    """Build the deployers for the given configuration.
+
+    If no configuration name is provided, the default one is used (asking the
+    user to choose one when none is set).
+
+    When a selector is given (or the configuration has a ``select`` field),
+    one deployer is built for each matching host of the inventory.
+
+    Arguments:
+        conf_name (str): Name of the configuration to use.
+        select (str): Inventory selector that overrides the one in the
+            configuration.
+
+    Returns:
+        List of ``Deployer`` instances. Exits the program on error.
+    """
+    conf = load_configs()
 
     if not conf_name:
         # Find default configuration
-        default = None
+        default = conf.default
 
-        for k in content.keys():
-            if content[k].get('default'):
-                # Found default configuration
-                default = k
-                util.cprint(m.USE_DEFAULT_CONF % default)
-                break
+        if default:
+            util.cprint(m.USE_DEFAULT_CONF % default)
 
-        if not default:
+        else:
             # Default not found
-            if len(content.keys()) == 0:
+            if not conf.names:
                 util.cprint(m.NO_CONFS, 'red')
                 sys.exit(-1)
 
             # Ask for default
             util.cprint(m.CONFS_FOUND)
 
-            for k in content.keys():
+            for k in conf.names:
                 util.cprint('- %s' % k)
 
             default = six.moves.input(m.CONF_SET_DEF)
 
-            if default in content.keys():
-                content[default]['default'] = True
-                util.write_yaml(FUMI_YML, content)
+            if default in conf:
+                conf.content[default]['default'] = True
+                util.write_yaml(FUMI_YML, conf.content)
 
             else:
                 # Welp...
@@ -110,47 +187,94 @@ def deploy(conf_name, prepare=False):
 
         conf_name = default
 
-    elif conf_name not in content.keys():
+    elif conf_name not in conf:
         util.cprint(m.CONF_NAME_NOT_FOUND % conf_name, 'red')
         sys.exit(-1)
 
-    # Build deployer
-    status, deployer = build_deployer(content[conf_name])
+    section = conf.get(conf_name)
+    select = select or section.get('select')
 
-    if not status:
-        sys.exit(-1)
+    if select:
+        # One configuration per selected host
+        try:
+            hosts = conf.inventory.select(select)
 
-    if prepare:
-        # Preparation
-        result = deployer.prepare()
+        except ValueError as e:
+            util.cprint(str(e), 'red')
+            sys.exit(-1)
+
+        if not hosts:
+            util.cprint(m.INV_NO_HOSTS % select, 'red')
+            sys.exit(-1)
 
     else:
-        # Deploy!
-        result = deployer.deploy()
+        hosts = [None]
+
+    # Build deployers
+    deployers = []
+
+    for host in hosts:
+        status, deployer = build_deployer(
+            dict(section, host=host) if host else section)
+
+        if not status:
+            sys.exit(-1)
 
-    if not result:
+        deployer.name = conf_name
+
+        if host:
+            deployer.tags = conf.inventory.tags[host]
+
+        deployers.append(deployer)
+
+    return deployers
+
+
+def show_history(conf_name=None, limit=20, threshold=0.25):
+    """Show the latest deployments and detect regressions.
+
+    Exits with an error status if a phase of the latest deployment (or the
+    size of its compressed source) regressed.
+
+    Arguments:
+        conf_name (str): Name of the configuration (all by default).
+        limit (int): Maximum number of deployments to show.
+        threshold (float): Allowed increase over the median of previous
+            deployments.
+    """
+    if not history.show(conf_name, limit, threshold):
         sys.exit(-1)
 
 
 def list_configs():
     """List the configurations present in the fumi.yml file."""
-    status, content = util.read_yaml(FUMI_YML)
+    conf = load_configs()
+
+    for name in conf.names:
+        if name == conf.default:
+            util.cprint(m.LIST_DEFAULT % name)
+
+        else:
+            util.cprint('- %s' % name)
+
+
+def load_configs():
+    """Load the fumi.yml file.
+
+    Returns:
+        ``ConfigFile`` instance. Exits the program on error or if the file
+        does not exist or is empty.
+    """
+    status, conf = config.load(FUMI_YML)
 
     if not status:
         sys.exit(-1)
 
-    if not content:
+    if not conf or not conf.content:
         util.cprint(m.NO_YML, 'red')
         sys.exit(-1)
 
-    for conf in content.keys():
-        is_default = content[conf].get('default', False)
-
-        if is_default:
-            util.cprint(m.LIST_DEFAULT % conf)
-
-        else:
-            util.cprint('- %s' % conf)
+    return conf
 
 
 def new_config(name):
@@ -194,6 +318,19 @@ def new_config(name):
     util.cprint(m.CREATED_BLANK % name)
 
 
+def list_revisions(conf_name, select=None):
+    """List the remote revisions of the given configuration.
+
+    Arguments:
+        conf_name (str): Name of the configuration to use.
+        select (str): Inventory selector for the hosts to use.
+    """
+    deployers = get_deployers(conf_name, select)
+
+    if not fleet.run(deployers, lambda d: d.revisions()):
+        sys.exit(-1)
+
+
 def remove_config(name):
     """Remove a configuration from the fumi.yml file.
 
@@ -223,6 +360,21 @@ def remove_config(name):
     util.cprint(m.CONF_REMOVED % name, 'green')
 
 
+def rollback(conf_name, revision=None, postdep=True, select=None):
+    """Roll back to a previous remote revision.
+
+    Arguments:
+        conf_name (str): Name of the configuration to use.
+        revision (str): Revision to roll back to (previous by default).
+        postdep (bool): Whether or not to run post-rollback commands.
+        select (str): Inventory selector for the hosts to use.
+    """
+    deployers = get_deployers(conf_name, select)
+
+    if not fleet.run(deployers, lambda d: d.rollback(revision, postdep)):
+        sys.exit(-1)
+
+
 def init_parser():
     """ Initialize the arguments parser. """
     parser = argparse.ArgumentParser(description=m.FUMI_DESC)
@@ -230,7 +382,34 @@ def init_parser():
     parser.add_argument('--version', action='version',
         version='%(prog)s ' + __version__)
 
-    subparsers = parser.add_subparsers(title=m.FUMI_CMDS)
+    parser.add_argument(
+        '--output',
+        choices=['text', 'jsonl'],
+        default='text',
+        help=m.FUMI_OUTPUT_DESC
+    )
+
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='fumi.prof',
+        metavar=m.FUMI_FILE,
+        help=m.FUMI_PROFILE_DESC
+    )
+
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help=m.FUMI_TRACE_MEMORY_DESC
+    )
+
+    subparsers = parser.add_subparsers(title=m.FUMI_CMDS, dest='action')
+
+
+    # activate
+    parser_activate = subparsers.add_parser(
+        'activate', help=m.FUMI_ACTIVATE_DESC)
+    _add_revision_args(parser_activate)
 
 
     # deploy
@@ -241,6 +420,30 @@ def init_parser():
         metavar=m.FUMI_CONF,
         help=m.FUMI_CONF_DESC
     )
+    _add_select_arg(parser_deploy)
+
+
+    # history
+    parser_history = subparsers.add_parser(
+        'history', help=m.FUMI_HISTORY_DESC)
+    parser_history.add_argument(
+        'configuration',
+        nargs='?',
+        metavar=m.FUMI_CONF,
+        help=m.FUMI_CONF_DESC
+    )
+    parser_history.add_argument(
+        '--limit',
+        type=int,
+        default=20,
+        help=m.FUMI_LIMIT_DESC
+    )
+    parser_history.add_argument(
+        '--threshold',
+        type=_ratio,
+        default=0.25,
+        help=m.FUMI_THRESHOLD_DESC
+    )
 
 
     # list
@@ -264,6 +467,7 @@ def init_parser():
         metavar=m.FUMI_CONF,
         help=m.FUMI_CONF_DESC
     )
+    _add_select_arg(parser_prepare)
 
 
     # remove
@@ -274,12 +478,86 @@ def init_parser():
         help=m.FUMI_NAME_DESC
     )
 
+
+    # revisions
+    parser_revisions = subparsers.add_parser(
+        'revisions', help=m.FUMI_REVS_DESC)
+    parser_revisions.add_argument(
+        'configuration',
+        nargs='?',
+        metavar=m.FUMI_CONF,
+        help=m.FUMI_CONF_DESC
+    )
+    _add_select_arg(parser_revisions)
+
+
+    # rollback
+    parser_rollback = subparsers.add_parser(
+        'rollback', help=m.FUMI_ROLLBACK_DESC)
+    _add_revision_args(parser_rollback)
+
+
+    # stage
+    parser_stage = subparsers.add_parser('stage', help=m.FUMI_STAGE_DESC)
+    parser_stage.add_argument(
+        'configuration',
+        nargs='?',
+        metavar=m.FUMI_CONF,
+        help=m.FUMI_CONF_DESC
+    )
+    _add_select_arg(parser_stage)
+
     return parser
 
+def _add_revision_args(parser):
+    """ Add the arguments shared by revision switching commands. """
+    parser.add_argument(
+        'configuration',
+        nargs='?',
+        metavar=m.FUMI_CONF,
+        help=m.FUMI_CONF_DESC
+    )
+    parser.add_argument(
+        'revision',
+        nargs='?',
+        metavar=m.FUMI_REV,
+        help=m.FUMI_REV_DESC
+    )
+    parser.add_argument(
+        '--no-postdep',
+        dest='postdep',
+        action='store_false',
+        help=m.FUMI_NOPOSTDEP_DESC
+    )
+    _add_select_arg(parser)
+
+def _ratio(value):
+    """ Parse a ratio given as a number or as a percentage. """
+    if value.endswith('%'):
+        return float(value[:-1]) / 100
+
+    return float(value)
+
+def _add_select_arg(parser):
+    """ Add the inventory selector argument. """
+    parser.add_argument(
+        '--select',
+        metavar=m.FUMI_SELECT,
+        help=m.FUMI_SELECT_DESC
+    )
+
 def parse_action(action, parsed):
     """ Parse the action to execute. """
-    if action == 'deploy':
-        deploy(parsed.configuration)
+    if action == 'activate':
+        activate(
+            parsed.configuration, parsed.revision, parsed.postdep,
+            parsed.select)
+
+    elif action == 'deploy':
+        deploy(parsed.configuration, select=parsed.select)
+
+    elif action == 'history':
+        show_history(parsed.configuration, parsed.limit, parsed.threshold)
 
     elif action == 'list':
         list_configs()
@@ -288,11 +566,22 @@ def parse_action(action, parsed):
         new_config(parsed.name)
 
     elif action == 'prepare':
-        deploy(parsed.configuration, prepare=True)
+        deploy(parsed.configuration, prepare=True, select=parsed.select)
 
     elif action == 'remove':
         remove_config(parsed.name)
 
+    elif action == 'revisions':
+        list_revisions(parsed.configuration, parsed.select)
+
+    elif action == 'rollback':
+        rollback(
+            parsed.configuration, parsed.revision, parsed.postdep,
+            parsed.select)
+
+    elif action == 'stage':
+        deploy(parsed.configuration, stage=True, select=parsed.select)
+
     else:
         util.cprint(m.FUMI_UNKNOWN)
 
@@ -301,9 +590,48 @@ def main():
     parser = init_parser()
     args = parser.parse_args()
 
-    if len(sys.argv) == 1:
-        # No argument provided
+    if not args.action:
+        # No action provided
         parser.print_help()
         return
 
-    parse_action(sys.argv[1], args)
+    if args.trace_memory:
+        profiling.enable_memory_tracing()
+
+    if args.profile:
+        # Profile the whole command
+        run = lambda: profiling.profile(
+            lambda: parse_action(args.action, args), args.profile)
+
+    else:
+        run = lambda: parse_action(args.action, args)
+
+    if args.output != 'jsonl':
+        run()
+        return
+
+    # Machine readable output
+    events.start()
+    events.emit('run_start', action=args.action, argv=sys.argv[1:])
+
+    started = time.time()
+    status = 0
+
+    try:
+        run()
+
+    except SystemExit as e:
+        status = e.code
+        raise
+
+    except BaseException:
+        status = 1
+        raise
+
+    finally:
+        events.emit(
+            'run_end',
+            ok=not status,
+            status=status,
+            seconds=time.time() - started)
+        events.stop()
@@ -47,12 +47,24 @@ CONF_SET_DEF = _('Which one do you want to set as default?: ')
 CONFS_FOUND = _('I found the following configurations:')
 
 CONN_AUTH_FAIL = _('Authentication failed')
+# NOTE: Includes the name of the host
+CONN_BAD_HOST_KEY = _('Host key for %s does not match the known hosts file')
+# NOTE: Includes the name of the bastion host
+CONN_BASTION = _('Connecting to bastion host %s')
+# NOTE: Includes the name of the bastion host
+CONN_BASTION_ERR = _('Could not connect to bastion host %s')
 CONN_FAIL = _('Could not connect, please check your credentials')
+# NOTE: Tokens are the name of the host and the last error
+CONN_GIVE_UP = _('Could not connect to %s: %s')
 CONN_NEEDPASS = _('Connection needs a password')
 CONN_KEYPASS = _('Password needed to unlock private key file')
+# NOTE: Commands are run in the local machine instead of through SSH
+CONN_LOCAL = _('Using the local transport')
 # NOTE: When introducing password manually
 CONN_PASS = _('Password: ')
 CONN_PUBKEY = _('Trying to connect using public key')
+# NOTE: Tokens are the name of the host, the error and the seconds to wait
+CONN_RETRY = _('Connection to %s failed (%s), retrying in %.1f seconds...')
 CONN_TRYPASS = _('Trying to connect using provided password')
 
 CORRECT = _('Correct!')
@@ -60,6 +72,31 @@ CORRECT = _('Correct!')
 # NOTE: Created empty configuration template, shows name
 CREATED_BLANK = _('Created blank configuration: %s')
 
+DEP_ARCHIVE = _('Performing a "git-archive" deployment')
+# NOTE: Tokens are the short commit hash and the path of the archive
+DEP_ARCHIVE_BUILD = _('Archiving commit %s to %s')
+# NOTE: Includes the path of the archive
+DEP_ARCHIVE_CACHED = _('Using cached archive %s')
+# NOTE: Tokens are the git reference and the short commit hash
+DEP_ARCHIVE_COMMIT = _('Deploying %s (commit %s)')
+# NOTE: Tokens are the number of changed paths and the deployed commit
+DEP_ARCHIVE_DELTA = _('%d paths changed since commit %s')
+# NOTE: Tokens are the short commit hash and the error
+DEP_ARCHIVE_ERR = _('Could not archive commit %s: %s')
+DEP_ARCHIVE_EXTRACT_ERR = _('Error building the revision in remote host')
+# NOTE: Includes the git reference
+DEP_ARCHIVE_REF = _('Could not find git reference %s in source repository')
+DEP_BUNDLE = _('Performing a "git-bundle" deployment')
+# NOTE: Includes the short commit hash
+DEP_BUNDLE_CHECKOUT = _('Exporting commit %s from remote mirror...')
+# NOTE: Includes the number of commits
+DEP_BUNDLE_CREATE = _('Bundling %d commits missing in remote mirror...')
+# NOTE: Includes the error
+DEP_BUNDLE_ERR = _('Could not create bundle: %s')
+DEP_BUNDLE_FETCH = _('Updating remote mirror...')
+DEP_BUNDLE_MIRROR_ERR = _('Error updating remote mirror')
+# NOTE: Includes the short commit hash
+DEP_BUNDLE_UPTODATE = _('Remote mirror already has commit %s')
 DEP_COMPLETE = _('Deployment complete!')
 DEP_CHECK_REMOTE = _('Checking remote directories...')
 DEP_CONNECTED = _('Connected!')
@@ -67,10 +104,23 @@ DEP_CONNECTING = _('Connecting to %s as %s...')
 DEP_CREATEDIR = _('Creating remote directory tree...')
 DEP_GIT = _('Performing a "git" deployment')
 DEP_GIT_CLONE = _('Cloning repository...')
+DEP_GIT_CLONE_ERR = _('Error cloning repository')
+# NOTE: Includes the number of concurrent transfers
+DEP_GIT_LFS = _('Fetching LFS objects (%d concurrent transfers)...')
+DEP_GIT_LFS_ERR = _('Error fetching LFS objects')
 DEP_GIT_NOTFOUND = _('git command not found in remote server')
+# NOTE: Includes the number of parallel jobs
+DEP_GIT_SUBMODULES = _('Fetching submodules (%d jobs)...')
+DEP_GIT_SUBMODULES_ERR = _('Error fetching submodules')
+# NOTE: Includes the error message
+DEP_INVALID_PARAM = _('Invalid parameter value: %s')
 DEP_LOCAL = _('Performing a "local"deployment')
 DEP_LOCAL_CLEAN = _('Cleaning temporary files...')
 DEP_LOCAL_COMPRESS = _('Compressing source to %s')
+# NOTE: Tokens are the number of files copied and hard linked
+DEP_LOCAL_COPIED = _('%d files copied, %d linked from the previous revision')
+DEP_LOCAL_COPY = _('Copying source to %s...')
+DEP_LOCAL_COPYERR = _('Error copying source: %s')
 DEP_LOCAL_ERR1 = _('Error: some files differ')
 DEP_LOCAL_ERR127 = _('Error: tar command not found in remote host')
 DEP_LOCAL_ERR2 = _('Fatal error when extracting remote file')
@@ -78,34 +128,98 @@ DEP_LOCAL_PATHNOEXIST = _('Path "%s" does not exist, ignoring')
 DEP_LOCAL_SCPFAIL = _('Failed to initiate SCP, check configuration')
 DEP_LOCAL_UNCOMPRESS = _('Uncompressing remote file...')
 DEP_LOCAL_UPLOAD = _('Uploading %s...')
+# NOTE: Includes the path of the file in the remote host
+DEP_LOCAL_UPLOADED = _('Compressed source already in remote host: %s')
 DEP_LOCAL_UPLOADERR = _('Error uploading to server: %s')
 DEP_MISSING_PARAM = _('Missing required parameter: %s')
 DEP_PREPARE_COMPLETE = _('Preparation complete!')
 DEP_PREPARE_REV = _('Preparing revision %s')
 DEP_PREPARE_NOTICE = _('Make sure to upload shared files before deploying')
+# NOTE: Token is the name of the staged revision
+DEP_STAGE_COMPLETE = _('Revision %s staged, use "fumi activate" to link it')
 DEP_UNKNOWN = _('Unknown deployment type: %s')
+# NOTE: Token is the name of the transport
+DEP_UNKNOWN_TRANSPORT = _('Unknown transport: %s')
 
 DONE = _('Done!')
 
+# NOTE: Includes the number of failed hosts
+FLEET_ABORT = _('Aborting deployment: %d hosts failed')
+# NOTE: Tokens are the number of the batch and the total number of batches
+FLEET_BATCH = _('Batch %d of %d')
+# NOTE: Tokens are the number of successful hosts and the total
+FLEET_DONE = _('%d of %d hosts completed successfully')
+# NOTE: Includes the list of failed hosts
+FLEET_FAILED = _('Failed hosts: %s')
+# NOTE: Includes the name of the host
+FLEET_HOST = _('Host: %s')
+# NOTE: Includes the number of seconds
+FLEET_PAUSE = _('Waiting %s seconds before the next batch...')
+FLEET_REVERT = _('Rolling back hosts that were already deployed...')
+# NOTE: Includes the list of hosts
+FLEET_REVERTED = _('Rolled back hosts: %s')
+
+FUMI_ACTIVATE_DESC = _('activate a remote revision (latest by default)')
 # NOTE: Command line title for the commands section
 FUMI_CMDS = _('commands')
 FUMI_CONF = _('configuration')
 FUMI_CONF_DESC = _('configuration to use')
 FUMI_DEPLOY_DESC = _('deploy using given configuration')
 FUMI_DESC = _('Simple deployment tool')
+FUMI_HISTORY_DESC = _('show the latest deployments and detect regressions')
+FUMI_FILE = _('file')
+FUMI_LIMIT_DESC = _('maximum number of deployments to show')
 FUMI_LIST_DESC = _('list all the available deployment configurations')
 FUMI_NAME = _('name')
 FUMI_NAME_DESC = _('name for the new configuration')
 FUMI_NEW_DESC = _('create new deployment configuration')
+FUMI_NOPOSTDEP_DESC = _('do not run post-deployment commands')
+FUMI_OUTPUT_DESC = _('output format (jsonl writes events to standard output)')
 FUMI_PREP_DESC = _('test connection and prepare remote directories')
+FUMI_PROFILE_DESC = _('profile the command and write the statistics to a file '
+                      '(fumi.prof by default)')
+FUMI_REV = _('revision')
+FUMI_REV_DESC = _('name of the revision')
+FUMI_REVS_DESC = _('list the revisions available in the remote host')
 FUMI_RM_DESC = _('remove a configuration from the deployment file')
+FUMI_ROLLBACK_DESC = _('activate the previous (or given) remote revision')
+FUMI_SELECT = _('selector')
+FUMI_SELECT_DESC = _('deploy to the inventory hosts matching the selector')
+FUMI_STAGE_DESC = _('upload a new revision without activating it')
+FUMI_THRESHOLD_DESC = _(
+    'allowed increase over the median of previous deployments (e.g. 25%%)')
+FUMI_TRACE_MEMORY_DESC = _('trace the memory used to compress the source')
 # TODO: Shown when trying to execute an unknown action
 FUMI_UNKNOWN = _('Unknown action')
 
+HIST_EMPTY = _('There are no deployments in the history')
+HIST_FAILED = _('failed')
+HIST_OK = _('ok')
+# NOTE: Includes the error
+HIST_READ_ERR = _('Could not read the deployment history: %s')
+# NOTE: Tokens are the configuration, the phase and its latest and usual
+# durations
+HIST_REGRESSION = _('%s: phase "%s" took %.2fs (usually %.2fs)')
+# NOTE: Tokens are the configuration and the latest and usual sizes
+HIST_SIZE_REGRESSION = _('%s: compressed source is %s (usually %s)')
+# NOTE: Includes the error
+HIST_WRITE_ERR = _('Could not record the deployment in the history: %s')
+
+# NOTE: Includes the name of the host
+INV_BAD_HOST = _('inventory host "%s" must be a mapping of tags')
+# NOTE: Includes the invalid condition
+INV_BAD_SELECTOR = _('Invalid selector condition: "%s"')
+# NOTE: Includes the selector
+INV_NO_HOSTS = _('No hosts match the selector "%s"')
+
 LINK_DIR = _('Linking directory...')
+LINK_ERR = _('Could not link revision:')
 LINK_SHARED = _('Linking shared files...')
 LINKING = _('Linking: %s')
 
+# NOTE: Includes the error
+METRICS_ERR = _('Could not write the metrics file: %s')
+
 # NOTE: When listing configurations, the default one is marked as such
 LIST_DEFAULT = _('- %s (default)')
 NO_CONFS = _('There are no configurations available')
@@ -113,6 +227,23 @@ NO_YML = _('There is no fumi.yml file')
 
 PATH_NOEXIST = _('Path "%s" does not exist')
 
+# NOTE: Tokens are the name of the stage and the amount of memory
+# NOTE: Token is the name of the stage
+PROF_MEMORY_END = _('Memory still allocated at the end of "%s", by line:')
+PROF_MEMORY_PEAK = _('Memory peak while running "%s": %s')
+PROF_NO_TRACEMALLOC = _('Memory tracing requires Python 3')
+# NOTE: Includes the path of the file
+PROF_WRITTEN = _('Profiling statistics written to %s')
+
+# NOTE: Tokens are the number of hosts and the number of groups
+RELAY_DISTRIBUTE = _('Distributing compressed source to %d hosts (%d groups)')
+# NOTE: Tokens are the host that sends the file and the one that receives it
+RELAY_FORWARD = _('Forwarding compressed source: %s -> %s')
+# NOTE: Includes the name of the host
+RELAY_FORWARD_ERR = _('Could not forward compressed source to %s')
+# NOTE: Includes the name of the host
+RELAY_SEED = _('Uploading compressed source to %s')
+
 REMOTE_DEP_CREATE_ERR = _('Cannot create remote deployment directory')
 REMOTE_DEP_NOEXIST = _('Remote deployment directory does not exist')
 REMOTE_FILE_NOEXIST = _('Remote file "%s" does not exist')
@@ -123,9 +254,15 @@ REMOTE_SHR_NOEXIST = _('Remote shared directory does not exist')
 REMOTE_TMP_CREATE_ERR = _('Cannot create remote temporary directory')
 REMOTE_TMP_NOEXIST = _('Remote temporary directory does not exist')
 
+# NOTE: Name of the revision linked to the current directory
+REV_ACTIVATED = _('Active revision: %s')
 REV_CHECK = _('Checking old revisions...')
+# NOTE: Revision marked as the one currently linked
+REV_CURRENT = _('- %s (current)')
 REV_LINK_PREV = _('Linking previous revision (%s) ...')
 REV_LIST_ERR = _('Error obtaining list of revisions')
+REV_NONE = _('There are no revisions in the remote host')
+REV_NOT_FOUND = _('Revision "%s" not found')
 REV_PREV_MISSING = _('No previous revision to link')
 # NOTE: ID of the revision being removed
 REV_RM = _('Removing revision %s')
@@ -145,13 +282,29 @@ RM_MSG_REMOTE = _('Removing remote file %s ...')
 
 ROLLBACK_BEGIN = _('Beginning rollback...')
 
+# NOTE: Column titles of the timing summary
+TIMING_HOST = _('host')
+TIMING_RATE = _('rate')
+TIMING_SENT = _('sent')
+TIMING_TITLE = _('Time spent in each phase (seconds):')
+TIMING_TOTAL = _('total')
+# NOTE: Tokens are the amount of data transferred and the rate per second
+TIMING_TRANSFER = _('Transferred %s (%s/s)')
+
 # TODO: Includes exception message
 UNEXPECTED_ERR = _('Unexpected error: %s')
 
 # NOTE: Token represents name of the default configuration
 USE_DEFAULT_CONF = _('Using default configuration: %s')
 
+# NOTE: Tokens are the configuration and the missing base configuration
+YML_BAD_BASE = _('configuration "%s" extends unknown configuration "%s"')
+# NOTE: Includes the name of the configuration
+YML_BAD_CONF = _('configuration "%s" is not a mapping')
+# NOTE: Includes the chain of configurations
+YML_CIRCULAR = _('circular inheritance: %s')
 # NOTE: Includes the error message
 YML_ERR = _('Error in deployment file: %s')
+YML_NOT_MAPPING = _('the file does not contain a mapping of configurations')
 # NOTE: Includes the error message
 YML_WRITE_ERR = _('Error writing yaml to deployment file: %s')
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Export of deployment metrics in the Prometheus text format.
+
+When a configuration has a ``metrics-file`` field, the file is rewritten at
+the end of each ``deploy`` and ``stage`` run so that it can be collected by
+the textfile collector of node_exporter. Metrics are computed from the
+deployment history (see ``fumi.history``), so the file always covers every
+configuration and host that has been deployed to from this machine.
+"""
+
+import os
+import tempfile
+
+from fumi import history
+from fumi import messages as m
+from fumi import util
+
+# Upper bounds (in seconds) of the phase duration histogram buckets
+BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def collect(db):
+    """Compute the metrics from the history database.
+
+    Arguments:
+        db (``sqlite3.Connection``): History database.
+
+    Returns:
+        List of lines in the Prometheus text format.
+    """
+    lines = []
+
+    # Phase durations
+    lines += [
+        '# HELP fumi_phase_duration_seconds Duration of deployment phases.',
+        '# TYPE fumi_phase_duration_seconds histogram',
+    ]
+
+    buckets = ', '.join(
+        'SUM(p.seconds <= %r)' % b for b in BUCKETS)
+
+    rows = db.execute(
+        'SELECT r.config, p.phase, %s, COUNT(*), SUM(p.seconds)'
+        ' FROM phases p JOIN runs r ON r.id = p.run_id'
+        ' GROUP BY r.config, p.phase ORDER BY r.config, p.phase' % buckets)
+
+    for row in rows:
+        config, phase = row[:2]
+        counts = row[2:2 + len(BUCKETS)]
+        count, total = row[-2:]
+        labels = 'config=%s,phase=%s' % (_quote(config), _quote(phase))
+
+        for bound, value in zip(BUCKETS, counts):
+            lines.append('fumi_phase_duration_seconds_bucket{%s,le="%s"} %d'
+                         % (labels, bound, value))
+
+        lines.append('fumi_phase_duration_seconds_bucket{%s,le="+Inf"} %d'
+                     % (labels, count))
+        lines.append('fumi_phase_duration_seconds_sum{%s} %f'
+                     % (labels, total))
+        lines.append('fumi_phase_duration_seconds_count{%s} %d'
+                     % (labels, count))
+
+    # Runs
+    lines += [
+        '# HELP fumi_runs_total Deployment runs by result.',
+        '# TYPE fumi_runs_total counter',
+    ]
+
+    rows = db.execute(
+        'SELECT config, ok, COUNT(*) FROM runs'
+        ' GROUP BY config, ok ORDER BY config, ok')
+
+    for config, ok, count in rows:
+        lines.append('fumi_runs_total{config=%s,result="%s"} %d' % (
+            _quote(config), 'ok' if ok else 'failed', count))
+
+    # Hosts
+    host_metrics = (
+        ('fumi_uploaded_bytes_total', 'counter',
+         'Bytes uploaded to the host.',
+         'SELECT r.config, h.host, SUM(h.transferred)'
+         ' FROM hosts h JOIN runs r ON r.id = h.run_id'
+         ' GROUP BY r.config, h.host'),
+        ('fumi_last_success_timestamp_seconds', 'gauge',
+         'Time of the last successful deployment to the host.',
+         'SELECT r.config, h.host, MAX(r.started)'
+         ' FROM hosts h JOIN runs r ON r.id = h.run_id'
+         ' WHERE h.ok = 1 GROUP BY r.config, h.host'),
+        ('fumi_revisions', 'gauge',
+         'Revisions kept in the host after the last deployment.',
+         _latest_usage('u.revisions')),
+        ('fumi_revisions_size_bytes', 'gauge',
+         'Disk usage of the revisions kept in the host.',
+         _latest_usage('u.size')),
+    )
+
+    for name, kind, description, query in host_metrics:
+        lines += [
+            '# HELP %s %s' % (name, description),
+            '# TYPE %s %s' % (name, kind),
+        ]
+
+        for config, host, value in db.execute(query + ' ORDER BY 1, 2'):
+            if value is None:
+                continue
+
+            lines.append('%s{config=%s,host=%s} %s' % (
+                name, _quote(config), _quote(host), _number(value)))
+
+    return lines
+
+def write(path, db_path=None):
+    """Write the metrics file.
+
+    The file is written to a temporary file in the same directory, which then
+    replaces the previous one, so collectors never read a partial file.
+    Errors are reported but never interrupt the program.
+
+    Arguments:
+        path (str): Path to the metrics file (usually ending in ``.prom``).
+        db_path (str): Path to the history database.
+
+    Returns:
+        Boolean indicating result.
+    """
+    import sqlite3
+
+    path = os.path.abspath(os.path.expanduser(path))
+
+    try:
+        db = history.connect(db_path)
+        lines = collect(db)
+        db.close()
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix='.fumi-', suffix='.tmp')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+
+    except (sqlite3.Error, OSError, IOError) as e:
+        util.cprint(m.METRICS_ERR % e, 'red')
+        return False
+
+    return True
+
+def _latest_usage(column):
+    """Build the query of a column of the latest usage of each host.
+
+    Arguments:
+        column (str): Column of the ``usage`` table (aliased as ``u``).
+
+    Returns:
+        SQL query that selects the configuration, host and value.
+    """
+    return (
+        'SELECT r.config, u.host, %s'
+        ' FROM usage u JOIN runs r ON r.id = u.run_id'
+        ' WHERE u.run_id = (SELECT MAX(u2.run_id) FROM usage u2'
+        ' JOIN runs r2 ON r2.id = u2.run_id'
+        ' WHERE u2.host = u.host AND r2.config = r.config)' % column)
+
+def _number(value):
+    """Format a metric value.
+
+    Arguments:
+        value (int or float): Value.
+
+    Returns:
+        String representation.
+    """
+    if isinstance(value, float):
+        return '%f' % value
+
+    return '%d' % value
+
+def _quote(value):
+    """Quote a label value.
+
+    Arguments:
+        value (str): Label value.
+
+    Returns:
+        Quoted and escaped value.
+    """
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return '"%s"' % value.replace('\n', '\\n')
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Profiling of fumi itself.
+
+``--profile`` runs the command under ``cProfile`` and writes the statistics
+to a file that can be loaded with ``pstats`` (or tools such as snakeviz).
+Threads whose target is wrapped with ``profile_thread()`` get their own
+profiler, and their statistics are merged with those of the main thread.
+``--trace-memory`` traces the memory allocated while compressing the source
+in ``local`` deployments and reports the peak and the lines holding the most
+memory at the end of the stage.
+"""
+
+import contextlib
+import threading
+
+from fumi import messages as m
+from fumi import util
+
+# Number of entries shown in reports
+TOP = 15
+
+# Set by ``--trace-memory``
+_TRACE_MEMORY = False
+
+# Profilers of the threads started while profiling, ``None`` if disabled
+_PROFILERS = None
+_PROFILERS_LOCK = threading.Lock()
+
+
+def enable_memory_tracing():
+    """Trace the memory used by the stages wrapped in ``trace_memory()``."""
+    global _TRACE_MEMORY
+    _TRACE_MEMORY = True
+
+def profile(func, path):
+    """Run a function under ``cProfile``.
+
+    The statistics are written to ``path`` even if the function exits the
+    program, and the functions with the highest cumulative time are printed.
+
+    Arguments:
+        func: Function to run (without arguments).
+        path (str): File in which to write the statistics.
+
+    Returns:
+        Value returned by the function.
+    """
+    import cProfile
+    import pstats
+
+    from six import StringIO
+
+    global _PROFILERS
+
+    _PROFILERS = []
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        return func()
+
+    finally:
+        profiler.disable()
+
+        output = StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+
+        with _PROFILERS_LOCK:
+            for thread_profiler in _PROFILERS:
+                stats.add(thread_profiler)
+
+            _PROFILERS = None
+
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(TOP)
+
+        util.cprint('\n' + m.PROF_WRITTEN % path, 'white')
+        util.cprint(output.getvalue().strip())
+
+def profile_thread(func):
+    """Wrap the target of a thread so that it is profiled too.
+
+    ``cProfile`` only profiles the thread in which it is enabled, so each
+    thread gets its own profiler while ``profile()`` is running.
+
+    Arguments:
+        func: Target of the thread.
+
+    Returns:
+        Wrapped target, or ``func`` itself when not profiling.
+    """
+    if _PROFILERS is None:
+        return func
+
+    import cProfile
+
+    def target(*args, **kwargs):
+        profiler = cProfile.Profile()
+
+        try:
+            profiler.enable()
+
+        except ValueError:
+            # Python 3.12+ profiles every thread from the main profiler
+            return func(*args, **kwargs)
+
+        try:
+            return func(*args, **kwargs)
+
+        finally:
+            profiler.disable()
+
+            with _PROFILERS_LOCK:
+                if _PROFILERS is not None:
+                    _PROFILERS.append(profiler)
+
+    return target
+
+@contextlib.contextmanager
+def trace_memory(stage):
+    """Trace the memory allocated within a block, if enabled.
+
+    Arguments:
+        stage (str): Name of the stage, used in the report.
+    """
+    if not _TRACE_MEMORY:
+        yield
+        return
+
+    try:
+        import tracemalloc
+
+    except ImportError:
+        # Python 2
+        util.cprint(m.PROF_NO_TRACEMALLOC, 'red')
+        yield
+        return
+
+    tracemalloc.start()
+
+    try:
+        yield
+
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        _report_memory(stage, peak, snapshot)
+
+def _report_memory(stage, peak, snapshot):
+    """Print the memory peak of a stage and the allocations left at its end.
+
+    The snapshot is taken when the stage ends, so the allocations listed are
+    those still alive then, which may differ from the ones at the peak.
+
+    Arguments:
+        stage (str): Name of the stage.
+        peak (int): Peak of traced memory in bytes.
+        snapshot (``tracemalloc.Snapshot``): Allocations at the end of the
+            stage.
+    """
+    from fumi.timing import format_size
+
+    util.cprint('\n' + m.PROF_MEMORY_PEAK % (stage, format_size(peak)), 'white')
+    util.cprint(m.PROF_MEMORY_END % stage, 'white')
+
+    for stat in snapshot.statistics('lineno')[:TOP]:
+        frame = stat.traceback[0]
+
+        util.cprint('  %10s %6d  %s:%d' % (
+            format_size(stat.size), stat.count, frame.filename, frame.lineno))
+
+    util.cprint('')
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Timing of the phases of a deployment.
+
+Each ``Deployer`` has a ``Timer`` that records how long each phase of the
+deployment took in its host, along with the remote commands that were run and
+the bytes transferred. A summary is printed at the end of the deployment.
+"""
+
+import time
+
+from fumi import events
+from fumi import messages as m
+from fumi import util
+
+
+class Timer(object):
+    """Durations of the phases of a deployment in a host.
+
+    Phases are consecutive: starting a phase ends the previous one.
+
+    Attributes:
+        host (str): Host the timer belongs to.
+        phases (list): ``[name, seconds]`` pairs, in the order they started.
+            A phase that runs several times is only listed once.
+        commands (list): ``(phase, command, seconds)`` tuples of the commands
+            that were run.
+        transferred (int): Bytes transferred to the host.
+        transfer_time (float): Seconds spent transferring those bytes.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.phases = []
+        self.commands = []
+        self.transferred = 0
+        self.transfer_time = 0.0
+
+        self._current = None
+        self._started = None
+
+    def start(self, name):
+        """Start a phase, ending the current one.
+
+        Arguments:
+            name (str): Name of the phase.
+        """
+        self.stop()
+
+        self._current = name
+        self._started = time.time()
+
+        events.emit('phase_start', self.host, phase=name)
+
+    def stop(self):
+        """End the current phase, if any."""
+        if self._current is None:
+            return
+
+        elapsed = time.time() - self._started
+
+        events.emit(
+            'phase_end', self.host, phase=self._current, seconds=elapsed)
+
+        for phase in self.phases:
+            if phase[0] == self._current:
+                phase[1] += elapsed
+                break
+
+        else:
+            self.phases.append([self._current, elapsed])
+
+        self._current = None
+
+    def command(self, command, seconds):
+        """Record a command run during the current phase.
+
+        Arguments:
+            command (str): Command that was run.
+            seconds (float): Time the command took.
+        """
+        self.commands.append((self._current, command, seconds))
+
+        events.emit(
+            'command',
+            self.host,
+            phase=self._current,
+            command=command,
+            seconds=seconds)
+
+    def transfer(self, size, seconds):
+        """Record a file transfer.
+
+        Arguments:
+            size (int): Bytes transferred.
+            seconds (float): Time the transfer took.
+        """
+        self.transferred += size
+        self.transfer_time += seconds
+
+        events.emit('transfer', self.host, bytes=size, seconds=seconds)
+
+    def duration(self, name=None):
+        """Obtain the duration of a phase or of all of them.
+
+        Arguments:
+            name (str): Name of the phase, or ``None`` for the total.
+
+        Returns:
+            Duration in seconds.
+        """
+        return sum(s for n, s in self.phases if name is None or n == name)
+
+    def throughput(self):
+        """Obtain the transfer rate.
+
+        Returns:
+            Bytes per second, or ``None`` if nothing was transferred.
+        """
+        if not self.transferred or not self.transfer_time:
+            return None
+
+        return self.transferred / self.transfer_time
+
+def format_size(size):
+    """Format a size in bytes for display.
+
+    Arguments:
+        size (float): Size in bytes.
+
+    Returns:
+        Formatted string (e.g. ``'1.5 MB'``).
+    """
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+
+        size /= 1024.0
+
+    return '%.1f GB' % size
+
+def report(deployers):
+    """Print the timing summary of a deployment.
+
+    For a single host, each phase is listed along with the commands run in
+    it. For several hosts, a table with a row per host is printed instead.
+
+    Arguments:
+        deployers (list[``Deployer``]): Deployers (one per host).
+    """
+    timers = [d.timer for d in deployers]
+
+    for timer in timers:
+        timer.stop()
+
+    if len(timers) == 1:
+        _report_host(timers[0])
+
+    else:
+        _report_hosts(timers)
+
+def _report_host(timer):
+    """Print the phases of a single host.
+
+    Arguments:
+        timer (``Timer``): Timer of the host.
+    """
+    total = timer.duration()
+
+    util.cprint('\n' + m.TIMING_TITLE, 'white')
+
+    for name, seconds in timer.phases:
+        util.cprint('  %-16s %8.2fs %5.1f%%' % (
+            name, seconds, 100 * seconds / total if total else 0))
+
+        for phase, command, cmd_seconds in timer.commands:
+            if phase == name:
+                util.cprint('    %8.2fs  %s' % (cmd_seconds, command))
+
+    util.cprint('  %-16s %8.2fs' % (m.TIMING_TOTAL, total))
+    _report_transfer(timer)
+
+def _report_hosts(timers):
+    """Print the phases of several hosts as a table.
+
+    Arguments:
+        timers (list[``Timer``]): Timers of the hosts.
+    """
+    names = []
+
+    for timer in timers:
+        for name, seconds in timer.phases:
+            if name not in names:
+                names.append(name)
+
+    width = max([len(m.TIMING_HOST)] + [len(t.host) for t in timers])
+    columns = ['%*s' % (max(len(n), 8), n) for n in names]
+
+    util.cprint('\n' + m.TIMING_TITLE, 'white')
+    util.cprint('  %-*s %s %9s %10s %12s' % (
+        width,
+        m.TIMING_HOST,
+        ' '.join(columns),
+        m.TIMING_TOTAL,
+        m.TIMING_SENT,
+        m.TIMING_RATE))
+
+    for timer in timers:
+        cells = [
+            '%*.2f' % (max(len(n), 8), timer.duration(n)) for n in names]
+        rate = timer.throughput()
+
+        util.cprint('  %-*s %s %9.2f %10s %12s' % (
+            width,
+            timer.host,
+            ' '.join(cells),
+            timer.duration(),
+            format_size(timer.transferred) if timer.transferred else '-',
+            format_size(rate) + '/s' if rate else '-'))
+
+def _report_transfer(timer):
+    """Print the bytes transferred to a host and the transfer rate.
+
+    Arguments:
+        timer (``Timer``): Timer of the host.
+    """
+    rate = timer.throughput()
+
+    if rate:
+        util.cprint('  ' + m.TIMING_TRANSFER % (
+            format_size(timer.transferred), format_size(rate)))
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Connections used to run commands and upload files to the hosts.
+
+Deployments only interact with hosts through a ``Transport``:
+
+- ``SSHTransport`` (the default) uses paramiko and SCP.
+- ``LocalTransport`` runs the commands and copies the files in the local
+  machine, optionally simulating the latency and bandwidth of a network link.
+  It allows measuring (and testing) fumi without remote hosts.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from six.moves import shlex_quote
+
+# Size of the chunks in which local uploads are copied
+CHUNK_SIZE = 64 * 1024
+
+
+class TransportError(Exception):
+    """Error transferring or handling a file in the host."""
+    pass
+
+
+class Transport(object):
+    """Connection to a host.
+
+    Commands are run by a shell in the host, so they may use redirections,
+    pipes and so on.
+    """
+
+    def run(self, command):
+        """Run a command and wait for it to finish.
+
+        Arguments:
+            command (str): Shell command.
+
+        Returns:
+            Exit status, standard output and standard error (as ``str``).
+        """
+        raise NotImplementedError
+
+    def stream(self, command, output):
+        """Run a command, passing its output to a callable as it arrives.
+
+        Arguments:
+            command (str): Shell command.
+            output: Callable that receives each line of standard output.
+
+        Returns:
+            Exit status.
+        """
+        status, stdout, stderr = self.run(command)
+
+        for line in stdout.splitlines(True):
+            output(line)
+
+        return status
+
+    def upload(self, local_path, remote_path, buffer_size=CHUNK_SIZE):
+        """Upload a file to the host.
+
+        Arguments:
+            local_path (str): Path of the local file.
+            remote_path (str): Destination path in the host.
+            buffer_size (int): Size (in bytes) of the transfer buffer.
+
+        Raises:
+            TransportError: if the file could not be uploaded.
+        """
+        raise NotImplementedError
+
+    def upload_stream(self, stream, remote_path, buffer_size=CHUNK_SIZE):
+        """Upload the content of a file object to the host.
+
+        Arguments:
+            stream: Binary file object to read from.
+            remote_path (str): Destination path in the host.
+            buffer_size (int): Size (in bytes) of the transfer buffer.
+
+        Raises:
+            TransportError: if the content could not be uploaded.
+        """
+        raise NotImplementedError
+
+    def isdir(self, path):
+        """Check whether a directory exists in the host.
+
+        Arguments:
+            path (str): Path of the directory.
+
+        Returns:
+            Boolean.
+        """
+        status, stdout, stderr = self.run('[ -d %s ]' % shlex_quote(path))
+
+        return status == 0
+
+    def makedirs(self, path):
+        """Create a directory (and its parents) in the host.
+
+        Arguments:
+            path (str): Path of the directory.
+
+        Raises:
+            TransportError: if the directory could not be created.
+        """
+        status, stdout, stderr = self.run('mkdir -p %s' % shlex_quote(path))
+
+        if status != 0:
+            raise TransportError(stderr.strip())
+
+    def remove(self, path):
+        """Remove a file or directory (recursively) from the host.
+
+        Arguments:
+            path (str): Path of the file or directory.
+
+        Raises:
+            TransportError: if the path could not be removed.
+        """
+        status, stdout, stderr = self.run('rm -rf %s' % shlex_quote(path))
+
+        if status != 0:
+            raise TransportError(stderr.strip())
+
+    def close(self):
+        """Close the connection."""
+        pass
+
+
+class SSHTransport(Transport):
+    """Connection to a host through SSH.
+
+    Attributes:
+        client (``paramiko.SSHClient``): Connected client.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def run(self, command):
+        stdin, stdout, stderr = self.client.exec_command(command)
+
+        # Both streams are read at the same time, otherwise a command that
+        # fills the window of one of them blocks forever
+        err = _read_in_background(stderr)
+        out = stdout.read()
+        status = stdout.channel.recv_exit_status()
+
+        return status, _text(out), _text(err())
+
+    def stream(self, command, output):
+        stdin, stdout, stderr = self.client.exec_command(command)
+
+        err = _read_in_background(stderr)
+
+        for line in iter(stdout.readline, ''):
+            output(line)
+
+        err()
+        return stdout.channel.recv_exit_status()
+
+    def upload(self, local_path, remote_path, buffer_size=CHUNK_SIZE):
+        import scp
+
+        client = self._scp(buffer_size)
+
+        try:
+            client.put(local_path, remote_path)
+
+        except scp.SCPException as e:
+            raise TransportError(str(e))
+
+    def upload_stream(self, stream, remote_path, buffer_size=CHUNK_SIZE):
+        import scp
+
+        client = self._scp(buffer_size)
+
+        try:
+            client.putfo(stream, remote_path)
+
+        except scp.SCPException as e:
+            raise TransportError(str(e))
+
+    def close(self):
+        self.client.close()
+
+    def _scp(self, buffer_size):
+        """Open an SCP session over the connection.
+
+        Arguments:
+            buffer_size (int): Size (in bytes) of the transfer buffer.
+
+        Returns:
+            ``scp.SCPClient`` instance.
+
+        Raises:
+            TransportError: if the session could not be opened.
+        """
+        import scp
+
+        from fumi import messages as m
+
+        try:
+            return scp.SCPClient(
+                self.client.get_transport(), buff_size=buffer_size)
+
+        except Exception:
+            # Failed to initiate SCP
+            raise TransportError(m.DEP_LOCAL_SCPFAIL)
+
+
+class LocalTransport(Transport):
+    """Connection that runs commands in the local machine.
+
+    Attributes:
+        root (str): Working (and home) directory of the commands, or ``None``
+            to use the current ones.
+        latency (float): Seconds to wait before each command or upload, to
+            simulate the round trip time of a network link.
+        bandwidth (int): Maximum upload speed in bytes per second, or
+            ``None`` for no limit.
+    """
+
+    def __init__(self, root=None, latency=0, bandwidth=None):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def run(self, command):
+        process = self._popen(command)
+        out, err = process.communicate()
+
+        return process.returncode, _text(out), _text(err)
+
+    def stream(self, command, output):
+        process = self._popen(command)
+
+        err = _read_in_background(process.stderr)
+
+        for line in iter(process.stdout.readline, b''):
+            output(_text(line))
+
+        err()
+        process.wait()
+        return process.returncode
+
+    def upload(self, local_path, remote_path, buffer_size=CHUNK_SIZE):
+        remote_path = self._path(remote_path)
+
+        if os.path.isdir(remote_path):
+            remote_path = os.path.join(
+                remote_path, os.path.basename(local_path))
+
+        try:
+            with open(local_path, 'rb') as src:
+                self.upload_stream(src, remote_path, buffer_size)
+
+            shutil.copymode(local_path, remote_path)
+
+        except (IOError, OSError) as e:
+            raise TransportError(str(e))
+
+    def upload_stream(self, stream, remote_path, buffer_size=CHUNK_SIZE):
+        self._wait()
+        started = time.time()
+        sent = 0
+
+        try:
+            with open(self._path(remote_path), 'wb') as dst:
+                for chunk in iter(lambda: stream.read(buffer_size), b''):
+                    dst.write(chunk)
+                    sent += len(chunk)
+
+                    if self.bandwidth:
+                        # Time the transfer should have taken so far
+                        ahead = (
+                            float(sent) / self.bandwidth
+                            - (time.time() - started))
+
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+        except (IOError, OSError) as e:
+            raise TransportError(str(e))
+
+    def isdir(self, path):
+        self._wait()
+        return os.path.isdir(self._path(path))
+
+    def makedirs(self, path):
+        self._wait()
+        path = self._path(path)
+
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        except OSError as e:
+            raise TransportError(str(e))
+
+    def remove(self, path):
+        self._wait()
+        path = self._path(path)
+
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+
+            elif os.path.lexists(path):
+                os.remove(path)
+
+        except OSError as e:
+            raise TransportError(str(e))
+
+    def _path(self, path):
+        """Resolve a path the way the commands would.
+
+        Relative paths (and ``~``) refer to ``root`` when it is set.
+
+        Arguments:
+            path (str): Path in the host.
+
+        Returns:
+            Path in the local machine.
+        """
+        if self.root and (path == '~' or path.startswith('~/')):
+            path = self.root + path[1:]
+
+        return os.path.join(self.root or '', os.path.expanduser(path))
+
+    def _popen(self, command):
+        """Start a shell command, after the simulated latency.
+
+        Arguments:
+            command (str): Shell command.
+
+        Returns:
+            ``subprocess.Popen`` instance.
+        """
+        self._wait()
+
+        env = None
+
+        if self.root:
+            env = dict(os.environ, HOME=self.root)
+
+        shell = '/bin/bash' if os.path.exists('/bin/bash') else '/bin/sh'
+
+        return subprocess.Popen(
+            [shell, '-c', command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.root,
+            env=env)
+
+    def _wait(self):
+        """Wait for the simulated latency."""
+        if self.latency:
+            time.sleep(self.latency)
+
+def _read_in_background(stream):
+    """Read a file object to the end in a separate thread.
+
+    Arguments:
+        stream: File object to read.
+
+    Returns:
+        Callable that waits for the thread and returns the data read.
+    """
+    data = []
+
+    thread = threading.Thread(target=lambda: data.append(stream.read()))
+    thread.daemon = True
+    thread.start()
+
+    def result():
+        thread.join()
+        return data[0] if data else b''
+
+    return result
+
+def _text(data):
+    """Decode command output.
+
+    Arguments:
+        data (bytes or str): Output of a command.
+
+    Returns:
+        Decoded string.
+    """
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+
+    return data
@@ -32,25 +32,199 @@ These are common functions used in different deployments.
 
 from __future__ import print_function
 
-import blessings
+import datetime
 import getpass
 import gettext
 import os
-import paramiko
+import random
+import re
 import shutil
+import socket
 import subprocess
-import yaml
+import sys
+import threading
+import time
 
+from fumi import events
 from fumi import messages as m
+from fumi.transport import LocalTransport, SSHTransport, TransportError
 
-COLOR_TERM = blessings.Terminal()
+# Heavy modules (blessings, paramiko, yaml) are imported when first needed to
+# keep the startup time of the command line tool low
+COLOR_TERM = None
 
+# Output state of each thread (used in concurrent deployments)
+_OUTPUT = threading.local()
+_PRINT_LOCK = threading.Lock()
+
+REVISION_LOG = 'revisions.log'
+
+# Commit deployed in each revision (``git-archive`` deployments)
+COMMIT_LOG = 'commits.log'
+
+# Open connections to bastion hosts, shared by all the connections of a run
+_BASTIONS = {}
+_BASTION_LOCK = threading.Lock()
+
+# Limit of SSH handshakes in progress, see ``_handshake_slots()``
+_HANDSHAKES = None
+_HANDSHAKES_LOCK = threading.Lock()
+
+# Format of revision names (timestamps)
+_REVISION_RE = re.compile(r'^\d{14}$')
+
+
+def activate_revision(ssh, deployer, revision=None, previous=False):
+    """Atomically switch the deploy_path/current link to a revision.
+
+    The whole operation (choosing the revision, linking shared paths inside it
+    and swapping the link) is sent as a single remote command. The swap is
+    performed by creating a temporary link and renaming it over ``current``,
+    so the link always points to a valid revision. Shared paths are linked
+    before the swap and a failure there aborts the activation.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        revision (str): Name of the revision to activate. If not provided,
+            the most recent revision is used.
+        previous (bool): Activate the revision previous to the current one
+            instead (``revision`` is ignored).
+
+    Returns:
+        Boolean indicating result and name of the activated revision or
+        ``None``.
+    """
+    cprint('> ' + m.LINK_DIR, 'cyan')
+
+    if revision and not previous and not _REVISION_RE.match(revision):
+        cprint(m.REV_NOT_FOUND % revision, 'red')
+        return False, None
+
+    rev_path = os.path.join(deployer.deploy_path, 'rev')
+    link_path = os.path.join(deployer.deploy_path, 'current')
+
+    if previous:
+        choose = (
+            'rev=$(ls -1 %s | awk -v c="$cur" '
+            '\'$0 == c {print p; exit} {p = $0}\')' % rev_path)
+
+    elif revision:
+        choose = 'rev=%s' % revision
+
+    else:
+        choose = 'rev=$(ls -1 %s | tail -n 1)' % rev_path
+
+    # Selection and existence check of the revision
+    script = [
+        'cur=$(basename "$(readlink %s)")' % link_path,
+        choose,
+        '[ -n "$rev" ] && [ -d %s/"$rev" ] || exit 3' % rev_path,
+    ]
+
+    # Activation, every step depends on the previous one
+    activate = [
+        shared_links_cmd(deployer, '%s/"$rev"' % rev_path),
+        atomic_link_cmd('%s/"$rev"' % rev_path, link_path),
+        'echo "$rev - ok" >> %s' % os.path.join(
+            deployer.deploy_path, REVISION_LOG),
+        'echo "$rev"'
+    ]
+
+    script.append(
+        '{ %s; } || exit 4' % ' && '.join([s for s in activate if s]))
+
+    status, stdout, stderr = ssh.run('; '.join(script))
+
+    if status == 3 and previous:
+        cprint(m.REV_PREV_MISSING, 'red')
+        return False, None
+
+    elif status == 3:
+        cprint(m.REV_NOT_FOUND % (revision or ''), 'red')
+        return False, None
+
+    elif status != 0:
+        cprint(m.LINK_ERR, 'red')
+        cprint(stderr)
+        return False, None
+
+    activated = stdout.strip()
+
+    cprint(m.REV_ACTIVATED % activated, 'magenta')
+    cprint(m.DONE + '\n', 'green')
+    return True, activated
+
+def atomic_link_cmd(target, link_path):
+    """Build a shell command that atomically points a link to a target.
+
+    A temporary link is created next to the final one and then renamed over
+    it, which avoids the window in which ``ln -sfn`` leaves no link at all.
+
+    The rename relies on ``mv -T`` (GNU coreutils). Where it is not available
+    (e.g. BSD systems) the old link is removed before moving the new one into
+    place, which is not atomic but leaves the link pointing to the target.
+
+    Arguments:
+        target (str): Path the link should point to.
+        link_path (str): Path of the link to create or replace.
+
+    Returns:
+        String containing the command.
+    """
+    tmp_link = link_path + '.tmp'
+
+    return (
+        'ln -sfn {target} {tmp} && '
+        '{{ mv -Tf {tmp} {link} 2>/dev/null || '
+        '{{ rm -f {link} && mv -f {tmp} {link}; }}; }}'
+    ).format(target=target, tmp=tmp_link, link=link_path)
+
+def bastion_transport(deployer):
+    """Obtain the connection to the bastion host of a deployer.
+
+    A single connection is opened to each bastion host and then shared by
+    all the hosts behind it (including concurrent deployments), so that only
+    a new ``direct-tcpip`` channel is needed for each of them.
+
+    The bastion host is reached using public key authentication.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        Boolean indicating result and paramiko.Transport instance or ``None``.
+    """
+    import atexit
+
+    user, host, port = deployer.bastion
+    key = (user or deployer.user, host, port)
+
+    with _BASTION_LOCK:
+        client = _BASTIONS.get(key)
+        transport = client.get_transport() if client else None
+
+        if not transport or not transport.is_active():
+            cprint(m.CONN_BASTION % host, 'magenta')
+
+            status, client = handshake(deployer, host, port, key[0])
+            if not status:
+                cprint(m.CONN_BASTION_ERR % host, 'red')
+                return False, None
+
+            atexit.register(client.close)
+            _BASTIONS[key] = client
+
+            transport = client.get_transport()
+            transport.set_keepalive(30)
+
+    return True, transport
 
 def check_dirs(ssh, deployer):
     """Check if all the necessary directories exist in the remote host.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         deployer (``Deployer``): Deployer instance.
 
     Returns:
@@ -84,7 +258,7 @@ def create_dirs(ssh, deployer):
     """Create remote directories.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         deployer (``Deployer``): Deployer instance.
 
     Returns:
@@ -115,99 +289,149 @@ def create_dirs(ssh, deployer):
     return True
 
 def connect(deployer):
-    """Try to connect to the remote host through SSH.
+    """Try to connect to the remote host.
+
+    Hosts are reached through SSH unless the deployer uses the ``local``
+    transport, in which case commands are run in the local machine.
 
     Arguments:
         dep (``Deployer``): Deployer instance.
 
     Returns:
-        Boolean indicating result and paramiko.SSHClient instance or ``None``.
+        Boolean indicating result and ``Transport`` instance or ``None``.
     """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    if not deployer.use_password:
-        # Not using password, rely on public key authentication
-        try:
-            cprint(m.CONN_PUBKEY + '\n', 'magenta')
-            ssh.connect(deployer.host, username=deployer.user)
+    if deployer.transport == 'local':
+        cprint(m.CONN_LOCAL + '\n', 'magenta')
 
-        except paramiko.ssh_exception.AuthenticationException:
-            cprint(m.CONN_AUTH_FAIL, 'red')
-            return False, None
+        return True, LocalTransport(
+            root=deployer.transport_root,
+            latency=deployer.transport_latency,
+            bandwidth=deployer.transport_bandwidth)
 
-        except paramiko.ssh_exception.PasswordRequiredException:
-            cprint(m.CONN_KEYPASS, 'red')
-            return False, None
+    password = None
 
-        except Exception as e:
-            # Unknown exception
-            cprint(m.UNEXPECTED_ERR % e, 'red')
-            return False, None
+    if not deployer.use_password:
+        # Not using password, rely on public key authentication
+        cprint(m.CONN_PUBKEY + '\n', 'magenta')
 
     elif deployer.use_password and not deployer.password:
         # Using password but not supplied in the yml file, ask for it
         cprint(m.CONN_NEEDPASS + '\n', 'magenta')
-        pwd = getpass.getpass(m.CONN_PASS)
-
-        try:
-            ssh.connect(deployer.host, username=deployer.user, password=pwd)
-
-        except:
-            cprint(m.CONN_FAIL, 'red')
-            return False, None
+        password = getpass.getpass(m.CONN_PASS)
 
     elif deployer.use_password and deployer.password:
         # Using password supplied in the yml file
         cprint(m.CONN_TRYPASS + '\n' , 'magenta')
+        password = deployer.password
 
-        try:
-            ssh.connect(
-                deployer.host,
-                username=deployer.user,
-                password=deployer.password)
+    status, ssh = handshake(
+        deployer,
+        deployer.host,
+        22,
+        deployer.user,
+        password,
+        tunnel=bool(deployer.bastion))
 
-        except:
-            cprint(m.CONN_FAIL, 'red')
-            return False, None
+    if not status:
+        return False, None
 
-    return True, ssh
+    return True, SSHTransport(ssh)
 
-def clean_revisions(ssh, keep_max, rev_path):
+def clean_revisions(ssh, deployer):
     """Remove old revisions from the remote server.
 
-    Only the most recent revisions will be kept.
+    Revisions are selected for removal according to the retention fields of
+    the deployer (see ``select_old_revisions()``). Sizes are read from the
+    revision log, so only revisions missing from it are measured. The
+    revision that was current before the deployment is kept as well, so that
+    multi-host deployments can still revert to it.
+
+    Old revisions are moved to the deploy_path/trash directory (and removed
+    from the revision and commit logs) with a single command, and are then
+    deleted by a detached low priority process, so that the deployment does
+    not wait for the files to be removed.
 
     Arguments:
-        ssh: Established SSH connection instance.
-        max_keep (int): Maximum number of revisions to keep.
-        rev_path (str): Path to the revisions directory in remote host.
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
 
     Returns:
         Boolean indicating result.
     """
     cprint('> ' + m.REV_CHECK, 'cyan')
 
-    stdin, stdout, stderr = ssh.exec_command('ls %s' % rev_path)
-    status = stdout.channel.recv_exit_status()
+    status, revisions, current = list_revisions(ssh, deployer)
 
-    if status == 1 or status == 2:
-        cprint(m.REV_LIST_ERR, 'red')
-        cprint(*stderr.readlines())
+    if not status:
         return False
 
-    revisions = stdout.readlines()
+    rev_path = os.path.join(deployer.deploy_path, 'rev')
+    revlog = read_revision_log(ssh, deployer)
+
+    # Measure revisions that are not in the log yet
+    missing = [r for r in revisions if revlog.get(r, (None,))[0] is None]
+
+    if missing and deployer.keep_size:
+        status, stdout, stderr = ssh.run(
+            'cd %s && du -sk %s' % (rev_path, ' '.join(missing)))
+
+        for line in stdout.splitlines():
+            size, name = line.split(None, 1)
+            state = revlog.get(name.strip(), (None, None))[1]
+            revlog[name.strip()] = (int(size) * 1024, state)
+
+    old_revisions = select_old_revisions(
+        deployer, revisions, current, revlog)
+    old_revisions = [
+        r for r in old_revisions if r != deployer.previous_revision]
+
+    for r in old_revisions:
+        cprint(m.REV_RM % r, 'magenta')
+
+    # Rewrite the log with the remaining revisions
+    entries = []
+
+    for r in revisions:
+        if r in old_revisions:
+            continue
+
+        size, state = revlog.get(r, (None, None))
+
+        entries.append("'%s %s %s'" % (
+            r, size if size is not None else '-', state or '-'))
+
+    log_path = os.path.join(deployer.deploy_path, REVISION_LOG)
+    commands = ['printf "%%s\\n" %s > %s.tmp && mv -f %s.tmp %s' % (
+        ' '.join(entries), log_path, log_path, log_path)]
+
+    if old_revisions:
+        # Forget the commits of the removed revisions
+        commit_log = os.path.join(deployer.deploy_path, COMMIT_LOG)
+        commands.append(
+            '{ [ ! -f %s ] || { grep -v %s %s > %s.tmp; '
+            'mv -f %s.tmp %s; }; }' % (
+                commit_log,
+                ' '.join("-e '^%s '" % r for r in old_revisions),
+                commit_log, commit_log, commit_log, commit_log))
+
+        trash_path = os.path.join(deployer.deploy_path, 'trash')
+        batch_path = os.path.join(trash_path, old_revisions[-1])
 
-    if len(revisions) > keep_max:
-        old_revisions = []
+        commands.append('mkdir -p %s && cd %s && mv %s %s' % (
+            batch_path, rev_path, ' '.join(old_revisions), batch_path))
 
-        while len(revisions) > keep_max:
-            old_revisions.append(revisions.pop(0))
+        # Detached removal with lowest CPU and IO priority (when available)
+        commands.append(
+            '{ nohup nice -n 19 $(command -v ionice > /dev/null && '
+            'echo ionice -c 3) rm -rf %s/* > /dev/null 2>&1 < /dev/null & }'
+            % trash_path)
 
-        for r in old_revisions:
-            cprint(m.REV_RM % r.strip(), 'magenta')
-            rm_old = 'rm -rf %s' % os.path.join(rev_path, r.strip())
-            stdin, stdout, stderr = ssh.exec_command(rm_old)
+    status, stdout, stderr = ssh.run(' && '.join(commands))
+
+    if status != 0:
+        cprint(m.RM_ERR_REMOTED, 'red')
+        cprint(stderr)
+        return False
 
     cprint(m.DONE +'\n', 'green')
     return True
@@ -216,39 +440,31 @@ def create_tree(ssh, path):
     """Try to create a remote tree path.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         path (str): Tree path to create.
 
     Returns:
         Boolean indicating whether the tree was created or not.
     """
-    stdin, stdout, stderr = ssh.exec_command(
-        "mkdir -p %s" % path)
+    try:
+        ssh.makedirs(path)
 
-    if stdout.channel.recv_exit_status() == 0:
-        return True
+    except TransportError:
+        return False
 
-    return False
+    return True
 
 def dir_exists(ssh, path):
     """Check whether a remote directory exists or not.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         path (str): Path of the directory to check.
 
     Returns:
         Boolean indicating if the directory exists or not.
     """
-    stdin, stdout, stderr = ssh.exec_command(
-        "[ -d %s ] && echo OK" % path)
-
-    result = stdout.read()
-
-    if result:
-        return True
-
-    return False
+    return ssh.isdir(path)
 
 def cprint(text, color='normal', bold=True):
     """Print the given text using blessings terminal.
@@ -258,6 +474,22 @@ def cprint(text, color='normal', bold=True):
         color (str): Color to print the message in.
         bold (bool): Whether or not the text should be printed in bold.
     """
+    global COLOR_TERM
+
+    if COLOR_TERM is None:
+        import blessings
+        COLOR_TERM = blessings.Terminal()
+
+    label = getattr(_OUTPUT, 'label', None)
+
+    if color == 'red':
+        events.emit('error', label, message=text.strip())
+
+    if label:
+        # Identify the host in concurrent output
+        text = '\n'.join(
+            ['[%s] %s' % (label, l) for l in text.rstrip('\n').split('\n')])
+
     if color == 'cyan':
         to_print = COLOR_TERM.cyan(text)
 
@@ -277,25 +509,235 @@ def cprint(text, color='normal', bold=True):
         # Normal text
         to_print = text
 
-    if bold and color != 'normal':
-        print(COLOR_TERM.bold(to_print))
+    # Standard output is used by the event stream
+    stream = sys.stderr if events.enabled() else sys.stdout
 
-    else:
-        print(to_print)
+    with _PRINT_LOCK:
+        if bold and color != 'normal':
+            print(COLOR_TERM.bold(to_print), file=stream)
+
+        else:
+            print(to_print, file=stream)
+
+def handshake(deployer, host, port, username, password=None, tunnel=False):
+    """Open an authenticated SSH connection.
+
+    Connection errors (timeouts, refused connections, dropped handshakes) are
+    retried up to ``connect-retries`` times, waiting a random time between
+    zero and an exponentially growing limit (``connect-backoff`` seconds,
+    doubled on each retry). The number of handshakes in progress at the same
+    time is limited to ``max-handshakes`` for the whole run.
+
+    When several keys are available, they are tried one after the other over
+    the same connection, so a single handshake is performed per attempt.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        host (str): Host to connect to.
+        port (int): SSH port of the host.
+        username (str): User to authenticate as.
+        password (str): Password to use, or ``None`` for public key
+            authentication.
+        tunnel (bool): Whether to connect through the bastion host of the
+            deployer.
+
+    Returns:
+        Boolean indicating result and paramiko.SSHClient instance or ``None``.
+    """
+    import paramiko
+
+    from fumi import credentials
+
+    # Keys and known hosts are loaded once per run
+    creds = credentials.get()
+
+    # Fall back to paramiko's own key lookup if no keys were loaded
+    keys = [None] if password else creds.candidates(host) or [None]
+    timeout = deployer.connect_timeout
+    error = None
+
+    for attempt in range(deployer.connect_retries + 1):
+        if attempt:
+            delay = random.uniform(
+                0, deployer.connect_backoff * 2 ** (attempt - 1))
+
+            cprint(m.CONN_RETRY % (host, error, delay), 'magenta')
+            time.sleep(delay)
+
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(creds)
+        sock = None
+        key = keys[0]
+
+        try:
+            if tunnel:
+                status, transport = bastion_transport(deployer)
+                if not status:
+                    return False, None
+
+                sock = transport.open_channel(
+                    'direct-tcpip',
+                    (host, port),
+                    ('127.0.0.1', 0),
+                    timeout=timeout)
+
+            with _handshake_slots(deployer):
+                try:
+                    ssh.connect(
+                        host,
+                        port=port,
+                        username=username,
+                        password=password,
+                        pkey=key,
+                        sock=sock,
+                        timeout=timeout,
+                        banner_timeout=timeout,
+                        auth_timeout=timeout,
+                        allow_agent=not password and key is None,
+                        look_for_keys=not password and key is None)
+
+                except paramiko.ssh_exception.AuthenticationException:
+                    # Try the rest of the keys over the same connection
+                    key = _auth_keys(ssh.get_transport(), username, keys[1:])
+
+                    if key is None:
+                        raise
+
+        except paramiko.ssh_exception.BadHostKeyException:
+            cprint(m.CONN_BAD_HOST_KEY % host, 'red')
+            return False, None
+
+        except paramiko.ssh_exception.PasswordRequiredException:
+            cprint(m.CONN_KEYPASS, 'red')
+            return False, None
+
+        except paramiko.ssh_exception.AuthenticationException:
+            # Credentials rejected
+            if password:
+                cprint(m.CONN_FAIL, 'red')
+
+            else:
+                cprint(
+                    m.CONN_KEYPASS if creds.locked else m.CONN_AUTH_FAIL,
+                    'red')
+
+            return False, None
+
+        except (socket.error, EOFError, paramiko.SSHException) as e:
+            # Connection error, retry
+            error = str(e) or type(e).__name__
+            continue
+
+        except Exception as e:
+            # Unknown exception
+            cprint(m.UNEXPECTED_ERR % e, 'red')
+            return False, None
+
+        finally:
+            if ssh.get_transport() is None or not (
+                    ssh.get_transport().is_authenticated()):
+                # Failed attempt, release the connection and the channel
+                ssh.close()
+
+                if sock is not None:
+                    sock.close()
+
+        if key is not None:
+            creds.success(host, key)
+
+        return True, ssh
+
+    cprint(m.CONN_GIVE_UP % (host, error), 'red')
+    return False, None
+
+def list_revisions(ssh, deployer):
+    """Obtain the list of remote revisions and the active one.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        Boolean indicating result, list of revision names (oldest first) and
+        name of the revision linked to ``current`` (or ``None``).
+    """
+    rev_path = os.path.join(deployer.deploy_path, 'rev')
+    link_path = os.path.join(deployer.deploy_path, 'current')
+
+    status, stdout, stderr = ssh.run(
+        'echo "$(readlink %s)"; ls -1 %s' % (link_path, rev_path))
+
+    if status != 0:
+        cprint(m.REV_LIST_ERR, 'red')
+        cprint(stderr)
+        return False, [], None
+
+    lines = [l.strip() for l in stdout.splitlines()]
+
+    current = os.path.basename(lines[0].rstrip('/')) or None
+    revisions = [l for l in lines[1:] if l]
+
+    return True, revisions, current
+
+def read_revision_log(ssh, deployer):
+    """Read the remote revision log.
+
+    The log (deploy_path/revisions.log) contains one line per revision event
+    with the name of the revision, its size in bytes and its state
+    (``ok`` for revisions that have been active, ``staged`` for revisions
+    that were never activated). Unknown values are written as ``-`` and later
+    lines override the values of earlier ones.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        ``dict`` mapping revision names to ``(size, state)`` tuples, where
+        unknown values are ``None``.
+    """
+    log_path = os.path.join(deployer.deploy_path, REVISION_LOG)
+
+    status, stdout, stderr = ssh.run('cat %s 2> /dev/null' % log_path)
+
+    revlog = {}
+
+    for line in stdout.splitlines():
+        fields = line.split()
+
+        if len(fields) != 3:
+            # Malformed line
+            continue
+
+        name, size, state = fields
+        old_size, old_state = revlog.get(name, (None, None))
+
+        revlog[name] = (
+            int(size) if size.isdigit() else old_size,
+            state if state != '-' else old_state)
+
+    return revlog
 
 def read_yaml(path):
     """Reads the given YAML file.
 
+    The libyaml based loader is used when available, as it is much faster
+    than the pure Python implementation for large files.
+
     Arguments:
         path (str): Path to the file to read (fumi.yml).
 
     Returns:
         Boolean indicating result and ``dict`` with the information or ``None``.
     """
+    import yaml
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
     if os.path.isfile(path):
         with open(path, 'r') as fumi_yml:
             try:
-                content = yaml.load(fumi_yml)
+                content = yaml.load(fumi_yml, Loader=loader)
 
             except yaml.YAMLError as e:
                 cprint(m.YML_ERR % e, 'red')
@@ -305,6 +747,30 @@ def read_yaml(path):
 
     return True, None
 
+def record_revision(ssh, deployer, timestamp, state):
+    """Append a revision to the remote revision log, including its size.
+
+    The size is only measured once, when the revision is recorded, and is then
+    reused by ``clean_revisions()``.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+        timestamp (str): Timestamp that identifies the revision.
+        state (str): State of the revision (``ok`` or ``staged``).
+
+    Returns:
+        Boolean indicating result.
+    """
+    log_path = os.path.join(deployer.deploy_path, REVISION_LOG)
+    rev = os.path.join(deployer.deploy_path, 'rev', timestamp)
+
+    status, stdout, stderr = ssh.run(
+        'echo "%s $(( $(du -sk %s | cut -f 1) * 1024 )) %s" >> %s' % (
+            timestamp, rev, state, log_path))
+
+    return status == 0
+
 def remove_local(path):
     """Remove a local file or directory.
 
@@ -341,17 +807,44 @@ def remove_remote(ssh, path):
     """Remove a remote file or directory.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         path (str): Absolute path to the file or directory.
 
     Returns:
         Boolean indicating result.
     """
-    stdin, stdout, stderr = ssh.exec_command('rm -rf %s' % path)
+    try:
+        ssh.remove(path)
+
+    except TransportError:
+        return False
 
     return True
 
-def rollback(ssh, deployer, timestamp, level):
+def revision_usage(ssh, deployer):
+    """Obtain the number of remote revisions and their disk usage.
+
+    Sizes are taken from the revision log, so revisions whose size is unknown
+    are not counted in the disk usage.
+
+    Arguments:
+        ssh (``Transport``): Established connection to the remote host.
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        ``(count, size)`` tuple, or ``None`` if the revisions could not be
+        listed.
+    """
+    status, revisions, current = list_revisions(ssh, deployer)
+    if not status:
+        return None
+
+    revlog = read_revision_log(ssh, deployer)
+    sizes = [revlog.get(r, (None, None))[0] for r in revisions]
+
+    return len(revisions), sum(s for s in sizes if s)
+
+def rollback(ssh, deployer, timestamp, level, previous=None):
     """Perform a rollback based on current deployment.
 
     Rollbacks have several levels:
@@ -361,13 +854,17 @@ def rollback(ssh, deployer, timestamp, level):
         3. Remove remote revision.
         4. Link previous revision.
 
-    All the levels lower to the one provided are executed as well.
+    All the levels lower to the one provided are executed as well. The
+    previous revision is linked before removing the failed one, so that
+    ``current`` never points to a missing directory.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         deployer (``Deployer``): Deployer instance.
         timestamp (str): Timestamp for the revision to rollback.
         level (int): Level of rollback to perform.
+        previous (str): Revision to link again at level 4. If not provided,
+            the most recent revision older than ``timestamp`` is used.
 
     Returns:
         Boolean indicating result of the rollback.
@@ -399,81 +896,70 @@ def rollback(ssh, deployer, timestamp, level):
         remote_file = os.path.join(uload_tmp, comp_file)
 
         # Check if file exists
-        stdin, stdout, stderr = ssh.exec_command(
-            '[ -f %s ] && echo OK' % remote_file)
+        status, stdout, stderr = ssh.run('[ -f %s ] && echo OK' % remote_file)
 
-        result = stdout.read()
-
-        if result:
+        if stdout:
             # File exists
             cprint(m.RM_MSG_REMOTE % remote_file, 'magenta')
 
-            stdin, stdout, stderr = ssh.exec_command(
-                'rm %s' % remote_file)
-
-            status = stdout.channel.recv_exit_status()
+            status, stdout, stderr = ssh.run('rm %s' % remote_file)
 
-            if status < 0:
+            if status != 0:
                 # Could not remove it?
                 cprint(m.RM_ERR_REMOTEF, 'red')
-                cprint(*stderr.readlines())
+                cprint(stderr)
 
         else:
             # File does not exist
             cprint(m.REMOTE_FILE_NOEXIST % remote_file, 'white')
 
-    if level >= 3:
-        # Remove revision
-        stdin, stdout, stderr = ssh.exec_command(
-            '[ -d %s ] && echo OK' % rev_path)
+    if level >= 4 and previous:
+        revs = [previous]
 
-        result = stdout.read()
+    elif level >= 4:
+        status, stdout, stderr = ssh.run('ls %s' % rev_path)
 
-        if result:
-            # Directory exists
-            cprint(m.REV_RM_REMOTE % timestamp, 'magenta')
-
-            stdin, stdout, stderr = ssh.exec_command(
-                'rm -rf %s' % os.path.join(rev_path, timestamp))
-
-            status = stdout.channel.recv_exit_status()
-
-            if status < 0:
-                cprint(m.RM_ERR_REMOTED, 'red')
-                cprint(*stderr.readlines())
-
-        else:
-            # File does not exist
-            cprint(m.REMOTE_REV_NOEXIST, 'white')
+        # Only revisions older than the one being rolled back
+        revs = [r.rstrip() for r in stdout.splitlines()]
+        revs = [r for r in revs if r < timestamp]
 
     if level >= 4:
         # Link previous version
-        stdin, stdout, stderr = ssh.exec_command('ls %s' % rev_path)
-        status = stdout.channel.recv_exit_status()
-
-        revs = [r.rstrip() for r in stdout.readlines()]
-
-        if timestamp in revs:
-            revs.remove(timestamp)
-
         if len(revs) > 0:
             cprint(m.REV_LINK_PREV % revs[-1], 'magenta')
 
             link_path = os.path.join(deployer.deploy_path, 'current')
             previous_rev = os.path.join(deployer.deploy_path, 'rev', revs[-1])
 
-            ln = 'ln -sfn %s %s' % (previous_rev, link_path)
-
-            stdin, stdout, stderr = ssh.exec_command(ln)
+            ssh.run(atomic_link_cmd(previous_rev, link_path))
 
         else:
             # No more revisions
             cprint(m.REV_PREV_MISSING, 'white')
 
+    if level >= 3:
+        # Remove revision
+        status, stdout, stderr = ssh.run('[ -d %s ] && echo OK' % rev_path)
+
+        if stdout:
+            # Directory exists
+            cprint(m.REV_RM_REMOTE % timestamp, 'magenta')
+
+            status, stdout, stderr = ssh.run(
+                'rm -rf %s' % os.path.join(rev_path, timestamp))
+
+            if status != 0:
+                cprint(m.RM_ERR_REMOTED, 'red')
+                cprint(stderr)
+
+        else:
+            # File does not exist
+            cprint(m.REMOTE_REV_NOEXIST, 'white')
+
     cprint(m.DONE, 'green')
     return True
 
-def run_commands(ssh, commands, remote_path=None):
+def run_commands(ssh, commands, remote_path=None, timer=None):
     """Execute pre and post deployment commands (both local and remote).
 
     Remote pre-deployment commands are usually executed in the user's
@@ -482,9 +968,11 @@ def run_commands(ssh, commands, remote_path=None):
     (deploy_path/current).
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         commands (list[str]): List of commands to execute (predep or postdep).
         remote_path (str): Remote path in which to execute commands.
+        timer (``Timer``): Timer in which to record the time each command
+            takes.
 
     Returns:
         Boolean indicating result.
@@ -500,6 +988,7 @@ def run_commands(ssh, commands, remote_path=None):
     for cmd in commands:
         command_type = cmd[0]
         to_run = cmd[1]
+        started = time.time()
 
         if command_type == 'local':
             cprint(m.CMD_LOCAL % to_run, 'magenta')
@@ -514,25 +1003,123 @@ def run_commands(ssh, commands, remote_path=None):
                 pushd = 'pushd %s > /dev/null 2>&1' % remote_path
                 to_run = '%s; %s; %s' % (pushd, to_run, popd)
 
-            stdin, stdout, stderr = ssh.exec_command(to_run)
-
             # Print command output in real-time
-            while not stdout.channel.exit_status_ready():
-                if stdout.channel.recv_ready():
-                    cprint(stdout.readline())
+            ssh.stream(to_run, lambda line: cprint(line.rstrip('\n')))
 
         else:
             # Unknown type, skip
             cprint((m.CMD_SKIP % command_type) + '\n', 'red')
+            continue
+
+        if timer:
+            timer.command(cmd[1], time.time() - started)
 
     cprint(m.DONE + '\n', 'green')
     return True
 
+def select_old_revisions(deployer, revisions, current, revlog, now=None):
+    """Choose the revisions to remove according to the retention fields.
+
+    Revisions are checked from newest to oldest. The revision linked to
+    ``current`` and the ``keep-min`` most recent successful revisions are
+    always kept. Any other revision is removed when keeping it would exceed
+    ``keep-max`` revisions or ``keep-size`` bytes in total, or when it is
+    older than ``keep-days``.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        revisions (list[str]): Revision names, oldest first.
+        current (str): Name of the revision linked to ``current``.
+        revlog (dict): Revision log as returned by ``read_revision_log()``.
+        now (``datetime.datetime``): Reference time for ages (UTC). Defaults
+            to the current time.
+
+    Returns:
+        List of revision names to remove, oldest first.
+    """
+    now = now or datetime.datetime.utcnow()
+
+    protected = set([current])
+    successful = [
+        r for r in revisions if revlog.get(r, (None, None))[1] == 'ok']
+
+    if deployer.keep_min:
+        protected.update(successful[-deployer.keep_min:])
+
+    kept_count = 0
+    kept_size = 0
+    old_revisions = []
+
+    for r in reversed(revisions):
+        size = revlog.get(r, (None,))[0] or 0
+
+        if r not in protected:
+            remove = False
+
+            if deployer.keep_max and kept_count >= deployer.keep_max:
+                remove = True
+
+            if deployer.keep_size and kept_size + size > deployer.keep_size:
+                remove = True
+
+            if deployer.keep_days:
+                try:
+                    created = datetime.datetime.strptime(r, '%Y%m%d%H%M%S')
+
+                except ValueError:
+                    # Not a timestamp, ignore age
+                    created = now
+
+                if (now - created).days >= deployer.keep_days:
+                    remove = True
+
+            if remove:
+                old_revisions.insert(0, r)
+                continue
+
+        kept_count += 1
+        kept_size += size
+
+    return old_revisions
+
+def set_label(label):
+    """Set the label that prefixes the output of the current thread.
+
+    Arguments:
+        label (str): Label to use (usually the host) or ``None`` to remove it.
+    """
+    _OUTPUT.label = label
+
+def shared_links_cmd(deployer, target_path):
+    """Build a shell command that links the shared paths inside a directory.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+        target_path (str): Directory (usually a revision) in which to create
+            the links.
+
+    Returns:
+        String containing the command or empty string if there are no shared
+        paths configured.
+    """
+    shared_path = os.path.join(deployer.deploy_path, 'shared')
+
+    links = []
+    for shared in deployer.shared_paths:
+        links.append('ln -sfn %s %s/%s' % (
+            os.path.join(shared_path, shared), target_path, shared))
+
+    return ' && '.join(links)
+
 def symlink(ssh, deployer, rev_path, timestamp):
     """Symlink the deployed revision to the deploy_path/current directory.
 
+    The link is replaced atomically (see ``atomic_link_cmd()``), so there is
+    no moment in which ``current`` does not exist. The revision it pointed to
+    is stored in ``deployer.previous_revision``.
+
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         deployer (``Deployer``): Deployer instance.
         rev_path (str): Path to the revisions directory in remote host.
         timestamp (str): Timestamp that identifies current revision.
@@ -545,20 +1132,30 @@ def symlink(ssh, deployer, rev_path, timestamp):
     link_path = os.path.join(deployer.deploy_path, 'current')
     current_rev = os.path.join(rev_path, timestamp)
 
-    ln = 'ln -sfn %s %s' % (current_rev, link_path)
+    status, stdout, stderr = ssh.run(
+        'prev=$(readlink %s); %s && basename "$prev"' % (
+            link_path, atomic_link_cmd(current_rev, link_path)))
+
+    if status != 0:
+        cprint(m.LINK_ERR, 'red')
+        cprint(stderr)
+        return False
 
-    stdin, stdout, stderr = ssh.exec_command(ln)
-    # status = stdout.channel.recv_exit_status()
+    deployer.previous_revision = stdout.strip() or None
 
     cprint(m.DONE + '\n', 'green')
     return True
 
-def symlink_shared(ssh, deployer):
-    """Symlink shared files to the deploy_path/current directory.
+def symlink_shared(ssh, deployer, target_path):
+    """Symlink shared files to a revision directory.
+
+    This is done before the revision is linked to deploy_path/current, so
+    that the revision never runs without its shared files.
 
     Arguments:
-        ssh: Established SSH connection instance.
+        ssh (``Transport``): Established connection to the remote host.
         deployer (``Deployer``): Deployer instance.
+        target_path (str): Revision directory in which to create the links.
 
     Returns:
         Boolean indicating result.
@@ -569,19 +1166,15 @@ def symlink_shared(ssh, deployer):
 
     cprint('> ' + m.LINK_SHARED, 'cyan')
 
-    current_path = os.path.join(deployer.deploy_path, 'current')
-    shared_path = os.path.join(deployer.deploy_path, 'shared')
-
     for shared in deployer.shared_paths:
         cprint(m.LINKING % shared, 'magenta')
 
-        src_path = os.path.join(shared_path, shared)
-        dest_path = os.path.join(current_path, shared)
+    status, stdout, stderr = ssh.run(shared_links_cmd(deployer, target_path))
 
-        ln = 'ln -sfn %s %s' % (src_path, dest_path)
-
-        stdin, stdout, stderr = ssh.exec_command(ln)
-        # status = stdout.channel.recv_exit_status()
+    if status != 0:
+        cprint(m.LINK_ERR, 'red')
+        cprint(stderr)
+        return False
 
     cprint(m.DONE + '\n', 'green')
     return True
@@ -596,6 +1189,8 @@ def write_yaml(path, content):
     Returns:
         Boolean indicating result.
     """
+    import yaml
+
     with open(path, 'w') as fumi_yml:
         try:
             yaml.dump(content, fumi_yml, default_flow_style=False)
@@ -605,3 +1200,51 @@ def write_yaml(path, content):
             return False
 
     return True
+
+def _auth_keys(transport, username, keys):
+    """Try public keys over an already established SSH connection.
+
+    Arguments:
+        transport (``paramiko.Transport``): Connection to the remote host.
+        username (str): User to authenticate as.
+        keys (list[``paramiko.PKey``]): Keys to try, in order.
+
+    Returns:
+        The key that was accepted or ``None``.
+    """
+    import paramiko
+
+    for key in keys:
+        if transport is None or not transport.is_active():
+            return None
+
+        try:
+            transport.auth_publickey(username, key)
+
+        except paramiko.ssh_exception.AuthenticationException:
+            continue
+
+        return key
+
+    return None
+
+def _handshake_slots(deployer):
+    """Obtain the semaphore that limits concurrent SSH handshakes.
+
+    The semaphore is created by the first connection of the run, using its
+    ``max-handshakes`` value.
+
+    Arguments:
+        deployer (``Deployer``): Deployer instance.
+
+    Returns:
+        ``threading.BoundedSemaphore`` instance.
+    """
+    global _HANDSHAKES
+
+    with _HANDSHAKES_LOCK:
+        if _HANDSHAKES is None:
+            _HANDSHAKES = threading.BoundedSemaphore(
+                max(1, deployer.max_handshakes))
+
+    return _HANDSHAKES
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# fumi deployment tool
+# https://github.com/rmed/fumi
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Rafael Medina García <rafamedgar@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Regression test for the startup time of the command line tool.
+
+Heavy dependencies must only be imported when a command needs them.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported when loading the launcher
+LAZY_MODULES = ('paramiko', 'scp', 'yaml', 'blessings', 'sqlite3')
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '-X importtime needs Python 3.7')
+class ImportTimeTest(unittest.TestCase):
+
+    def test_heavy_modules_are_lazy(self):
+        process = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-c', 'import fumi.launcher'],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        out, err = process.communicate()
+
+        self.assertEqual(process.returncode, 0, err.decode('utf-8'))
+
+        # Lines look like "import time:   self [us] | cumulative | package"
+        imported = set(
+            line.rsplit('|', 1)[-1].strip().split('.')[0]
+            for line in err.decode('utf-8').splitlines()
+            if line.startswith('import time:'))
+
+        self.assertIn('fumi', imported)
+
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, imported)
+
+
+if __name__ == '__main__':
+    unittest.main()